@@ -0,0 +1,479 @@
+# coding=utf-8
+#
+# Benchmarks of the plugin hot paths, against a fake sysfs GPIO tree and the
+# stub power controller. Runs on any Linux machine with OctoPrint installed
+# (run it with the python of OctoPrint's virtualenv, from the repository
+# root):
+#
+#   python benchmarks/powerbutton_bench.py -o baseline.json
+#   python benchmarks/powerbutton_bench.py --compare baseline.json
+#
+# The results are written as JSON. When comparing against a baseline, every
+# timing that got slower by more than the tolerance is reported, and the
+# exit status is 1.
+
+from __future__ import print_function
+
+import argparse
+import copy
+import json
+import logging
+import os
+import platform
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import octoprint_powerbutton
+from octoprint_powerbutton import raspi_power
+from octoprint_powerbutton.power_ctrl_stub import StubPowerController
+from octoprint_powerbutton.power_meter import PowerHistory
+from octoprint_powerbutton.power_states import *
+from octoprint_powerbutton.scheduler import monotonic
+
+PINS = dict(gpio_relay = 17, gpio_button = 22, gpio_red = 3, gpio_green = 2)
+
+# Result keys ending with these suffixes are timings (lower is better) and
+# are checked when comparing against a baseline
+TIMING_SUFFIXES = ("_us", "_ms", "_cpu_percent")
+
+##~~ Fakes
+
+# A fake /sys/class/gpio tree, with the given pins already exported as
+# inputs. Without edge files, the button thread falls back to polling.
+class FakeSysfsGpio:
+
+    def __init__(self, pins, edge = True):
+        self.path = tempfile.mkdtemp(prefix = "powerbutton-gpio-")
+        open(os.path.join(self.path, "export"), "w").close()
+        open(os.path.join(self.path, "unexport"), "w").close()
+        for pin in pins:
+            pin_dir = os.path.join(self.path, "gpio%d" % pin)
+            os.mkdir(pin_dir)
+            self.write(pin, "direction", "in")
+            self.write(pin, "value", "0")
+            if edge:
+                self.write(pin, "edge", "none")
+
+    def write(self, pin, name, value):
+        with open(os.path.join(self.path, "gpio%d" % pin, name), "w") as f:
+            f.write("%s\n" % value)
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors = True)
+
+class FakeSettings:
+
+    def __init__(self, data):
+        self.data = data
+
+    def get(self, path, **kwargs):
+        value = self.data
+        for key in path:
+            value = value[key]
+        return copy.deepcopy(value)
+
+# Delivers every push message to a number of simulated clients, each
+# serializing it as the socket connection of a browser would
+class FakePluginManager:
+
+    def __init__(self, clients = 1):
+        self.clients = clients
+        self.sent = 0
+
+    def send_plugin_message(self, identifier, message):
+        for _ in range(self.clients):
+            json.dumps(dict(plugin = identifier, data = message))
+        self.sent += 1
+
+class FakePrinter:
+
+    def __init__(self):
+        self.state = "Closed"
+
+    def get_current_connection(self):
+        return (self.state, None, None, None)
+
+    def connect(self, **kwargs):
+        self.state = "Operational"
+
+    def disconnect(self):
+        self.state = "Closed"
+
+    def is_closed_or_error(self):
+        return self.state == "Closed"
+
+def make_plugin(module = "stub", sysfs_gpio = None, clients = 1, auto_power_off_interval = 180):
+    plugin = octoprint_powerbutton.PowerbuttonPlugin()
+    settings = plugin.get_settings_defaults()
+    settings["power_ctrl_module"] = module
+    settings["auto_power_off"]["interval"] = auto_power_off_interval
+    if sysfs_gpio is not None:
+        settings["raspi_power"]["sysfs_gpio"] = sysfs_gpio
+
+    logger = logging.getLogger("powerbutton.bench")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    plugin._settings = FakeSettings(settings)
+    plugin._plugin_manager = FakePluginManager(clients)
+    plugin._printer = FakePrinter()
+    plugin._logger = logger
+    plugin._identifier = "powerbutton"
+    plugin._plugin_version = "bench"
+
+    data_folder = tempfile.mkdtemp(prefix = "powerbutton-data-")
+    plugin.get_plugin_data_folder = lambda: data_folder
+    return plugin
+
+def stop_plugin(plugin):
+    plugin.on_shutdown()
+    shutil.rmtree(plugin.get_plugin_data_folder(), ignore_errors = True)
+
+##~~ Helpers
+
+def summarize(samples, unit = 1e6):
+    samples = sorted(samples)
+    n = len(samples)
+    def pct(p):
+        return samples[min(n - 1, int(p * n))] * unit
+    return dict(n = n, min = samples[0] * unit, median = pct(0.5), p95 = pct(0.95),
+        p99 = pct(0.99), max = samples[-1] * unit, mean = sum(samples) / n * unit)
+
+# CPU time of the whole process. time.process_time is more precise, but
+# is not available on older Python versions.
+if hasattr(time, "process_time"):
+    cpu_time = time.process_time
+else:
+    def cpu_time():
+        t = os.times()
+        return t[0] + t[1]
+
+# CPU used by the process while the calling thread sleeps, in percent of one
+# core
+def idle_cpu_percent(duration):
+    start_cpu, start = cpu_time(), monotonic()
+    time.sleep(duration)
+    return (cpu_time() - start_cpu) / (monotonic() - start) * 100
+
+##~~ Benchmarks
+
+def bench_set_power_state(iterations):
+    results = {}
+
+    def run(ctrl):
+        samples = []
+        state = POWER_STATE_OFF
+        for _ in range(iterations):
+            state = POWER_STATE_ON if state == POWER_STATE_OFF else POWER_STATE_OFF
+            t = monotonic()
+            ctrl.set_power_state(state)
+            samples.append(monotonic() - t)
+
+        # Setting the current state again is a no-op
+        unchanged = []
+        for _ in range(iterations):
+            t = monotonic()
+            ctrl.set_power_state(state)
+            unchanged.append(monotonic() - t)
+
+        return dict(toggle_us = summarize(samples), unchanged_us = summarize(unchanged))
+
+    ctrl = StubPowerController()
+    results["stub"] = run(ctrl)
+    ctrl.shutdown()
+
+    gpio = FakeSysfsGpio(PINS.values())
+    try:
+        ctrl = raspi_power.RaspiPowerControl(None, dict(PINS, sysfs_gpio = gpio.path))
+        results["raspi_power"] = run(ctrl)
+        ctrl.shutdown()
+    finally:
+        gpio.remove()
+
+    return results
+
+def bench_button_thread_idle(duration):
+    results = dict(baseline_cpu_percent = idle_cpu_percent(duration))
+
+    for mode, edge in (("edge", True), ("polling", False)):
+        gpio = FakeSysfsGpio(PINS.values(), edge = edge)
+        try:
+            ctrl = raspi_power.RaspiPowerControl(None, dict(PINS, sysfs_gpio = gpio.path))
+            assert(ctrl.button_edge == edge)
+            results[mode + "_cpu_percent"] = idle_cpu_percent(duration)
+            ctrl.shutdown()
+        finally:
+            gpio.remove()
+
+    return results
+
+def bench_notify(clients, calls):
+    plugin = make_plugin(clients = clients)
+    plugin.on_after_startup()
+    try:
+        # Let the startup notifications go out
+        time.sleep(0.2)
+        sent_before = plugin._plugin_manager.sent
+
+        t = monotonic()
+        for i in range(calls):
+            plugin.notify_power_state(force = (i % 2 == 0))
+        elapsed = monotonic() - t
+
+        time.sleep(plugin.notifier.window * 4)
+        return dict(clients = clients, calls = calls,
+            calls_per_second = calls / elapsed,
+            per_call_us = elapsed / calls * 1e6,
+            messages_sent = plugin._plugin_manager.sent - sent_before)
+    finally:
+        stop_plugin(plugin)
+
+def bench_startup(repeat):
+    results = {}
+
+    samples = []
+    for _ in range(repeat):
+        plugin = make_plugin()
+        t = monotonic()
+        plugin.on_after_startup()
+        samples.append(monotonic() - t)
+        stop_plugin(plugin)
+    results["stub_ms"] = summarize(samples, 1e3)
+
+    # The first start exports and configures the pins, the following ones
+    # find them already configured (as after an OctoPrint restart)
+    gpio = FakeSysfsGpio(PINS.values())
+    try:
+        samples = []
+        for _ in range(repeat):
+            plugin = make_plugin("raspi_power", gpio.path)
+            t = monotonic()
+            plugin.on_after_startup()
+            samples.append(monotonic() - t)
+            stop_plugin(plugin)
+        results["raspi_power_first_ms"] = samples[0] * 1e3
+        results["raspi_power_restart_ms"] = summarize(samples[1:] or samples, 1e3)
+    finally:
+        gpio.remove()
+
+    return results
+
+def bench_print_cycle(auto_off_interval):
+    counts = dict(before_startup = threading.active_count())
+
+    gpio = FakeSysfsGpio(PINS.values())
+    try:
+        plugin = make_plugin("raspi_power", gpio.path, auto_power_off_interval = auto_off_interval)
+        plugin.on_after_startup()
+        counts["after_startup"] = threading.active_count()
+
+        plugin.power_ctrl.set_power_state(POWER_STATE_ON)
+        plugin.on_event("PrintStarted", {})
+        counts["printing"] = threading.active_count()
+
+        plugin.on_event("PrintDone", {})
+        counts["auto_off_countdown"] = threading.active_count()
+
+        # Wait for the auto-power-off to expire
+        deadline = monotonic() + auto_off_interval + 5
+        while plugin.power_ctrl.get_power_state() != POWER_STATE_OFF and monotonic() < deadline:
+            time.sleep(0.05)
+        counts["powered_off"] = threading.active_count()
+        counts["max"] = max(counts.values())
+
+        stop_plugin(plugin)
+    finally:
+        gpio.remove()
+
+    return counts
+
+# Round trip of the control socket requests: reading the state, and
+# queueing a power command
+def bench_control_socket(iterations):
+    plugin = make_plugin()
+    plugin._settings.data["control_socket"]["enabled"] = True
+    plugin.on_after_startup()
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(os.path.join(plugin.get_plugin_data_folder(), "control.sock"))
+        stream = client.makefile("rwb")
+
+        def request(line):
+            t = monotonic()
+            stream.write(line + b"\n")
+            stream.flush()
+            while not stream.readline().startswith((b"OK", b"ERR")):
+                pass
+            return monotonic() - t
+
+        results = dict(get_us = summarize([request(b"GET") for _ in range(iterations)]))
+        results["set_us"] = summarize([request(b"SET on" if i % 2 else b"SET off") for i in range(iterations)])
+        return results
+    finally:
+        client.close()
+        stop_plugin(plugin)
+
+# Cost of adding a power sample, and of the chart queries over windows of
+# five minutes to a month, after a month of samples. Neither should depend
+# on how long the history is. (As the history is bounded, a month of
+# sparse samples followed by 20 minutes at the default interval fills it
+# as a month at the default interval would.)
+def bench_power_history(iterations):
+    history = PowerHistory()
+    interval = 0.25
+    t = time.time() - 30 * 86400
+    for i in range(int((30 * 86400 - 1200) / 15)):
+        history.add(t, 100 + i % 50)
+        t += 15
+    for i in range(int(1200 / interval)):
+        history.add(t, 100 + i % 50)
+        t += interval
+
+    samples = []
+    for i in range(iterations):
+        start = monotonic()
+        history.add(t, 100 + i % 50)
+        samples.append(monotonic() - start)
+        t += interval
+    results = dict(add_us = summarize(samples))
+
+    for name, window in (("5min", 300), ("hour", 3600), ("day", 86400), ("month", 30 * 86400)):
+        samples = []
+        for _ in range(max(1, iterations // 100)):
+            start = monotonic()
+            history.query(t - window, t)
+            samples.append(monotonic() - start)
+        results["query_%s_us" % name] = summarize(samples)
+    return results
+
+# The time from the plugin shutdown call until it returns, and until all
+# the threads it started have exited. The plugin is shut down in its
+# busiest state: during an auto-power-off countdown (with its LED
+# animation), with a serial port watch waiting for an auto-connect.
+def bench_shutdown(repeat):
+    results = {}
+
+    def run(module, sysfs_gpio = None):
+        returned, exited = [], []
+        left = 0
+        for _ in range(repeat):
+            before = set(threading.enumerate())
+            plugin = make_plugin(module, sysfs_gpio)
+            plugin._settings.data["auto_connect"]["enabled"] = True
+            plugin.on_after_startup()
+            plugin.on_event("PrintStarted", {})
+            plugin.power_ctrl.set_power_state(POWER_STATE_ON)
+            plugin.on_event("PrintDone", {})
+
+            t = monotonic()
+            stop_plugin(plugin)
+            returned.append(monotonic() - t)
+
+            deadline = t + 5
+            while set(threading.enumerate()) - before and monotonic() < deadline:
+                time.sleep(0.001)
+            exited.append(monotonic() - t)
+            left = max(left, len(set(threading.enumerate()) - before))
+        return dict(returned_ms = summarize(returned, 1e3), threads_exited_ms = summarize(exited, 1e3),
+            threads_left = left)
+
+    results["stub"] = run("stub")
+    for mode, edge in (("edge", True), ("polling", False)):
+        gpio = FakeSysfsGpio(PINS.values(), edge = edge)
+        try:
+            results["raspi_power_" + mode] = run("raspi_power", gpio.path)
+        finally:
+            gpio.remove()
+
+    return results
+
+##~~ Baselines
+
+def flatten(results, prefix = ""):
+    flat = {}
+    for key, value in results.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+# Of the distribution summaries, only the stable statistics are compared,
+# the extremes are too noisy
+def is_timing(name):
+    parts = name.split(".")
+    return any(part.endswith(TIMING_SUFFIXES) for part in parts) and parts[-1] not in ("n", "min", "max", "p99")
+
+def compare(results, baseline, tolerance):
+    current = flatten(results["results"])
+    regressions = []
+    for name, old in sorted(flatten(baseline["results"]).items()):
+        new = current.get(name)
+        if new is None or not is_timing(name):
+            continue
+        # Ignore sub-microsecond noise
+        if new > old * tolerance and new - old > 1:
+            regressions.append((name, old, new))
+
+    # Any additional thread is a regression
+    name = "print_cycle_threads.max"
+    old, new = flatten(baseline["results"]).get(name), current.get(name)
+    if old is not None and new is not None and new > old:
+        regressions.append((name, old, new))
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the PowerButton plugin hot paths")
+    parser.add_argument("-o", "--output", help = "write the results (JSON) to this file")
+    parser.add_argument("--compare", metavar = "BASELINE", help = "compare the results with a baseline file")
+    parser.add_argument("--tolerance", type = float, default = 1.5,
+        help = "slowdown factor reported as a regression (default: 1.5)")
+    parser.add_argument("--iterations", type = int, default = 2000)
+    parser.add_argument("--idle", type = float, default = 2.0, help = "idle CPU measurement time, in seconds")
+    parser.add_argument("--clients", type = int, default = 50)
+    args = parser.parse_args()
+
+    results = dict(
+        set_power_state = bench_set_power_state(args.iterations),
+        button_thread_idle = bench_button_thread_idle(args.idle),
+        notify = bench_notify(args.clients, args.iterations),
+        startup = bench_startup(10),
+        print_cycle_threads = bench_print_cycle(1.0),
+        shutdown = bench_shutdown(10),
+        control_socket = bench_control_socket(args.iterations),
+        power_history = bench_power_history(args.iterations)
+    )
+    report = dict(
+        python = platform.python_version(),
+        platform = platform.platform(),
+        machine = platform.machine(),
+        time = time.strftime("%Y-%m-%dT%H:%M:%S"),
+        results = results
+    )
+
+    text = json.dumps(report, indent = 2, sort_keys = True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        for name, old, new in regressions:
+            print("REGRESSION %s: %.3f -> %.3f" % (name, old, new), file = sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,582 @@
+# coding=utf-8
+#
+# Soak simulator of the power and print lifecycle. Runs the plugin with the
+# stub power controller, a simulated printer (and its serial device) and a
+# virtual clock, replaying a trace of thousands of print cycles: power on,
+# auto-connect, printing, auto-power-off, with API requests and button
+# presses thrown in. The invariants checked along the way are:
+#
+# - The power is never cut while locked (printing), other than by the
+#   forced power off of a long button press
+# - The printer's power is never cut while it is connected
+# - Whenever the plugin is idle, the last push message of every channel
+#   matches its state, as does the status served by the API
+# - No timers or threads are leaked: every pending task is referenced by
+#   the plugin state, and no thread is started after the startup
+#
+# Runs on any machine with OctoPrint installed (run it with the python of
+# OctoPrint's virtualenv, from the repository root):
+#
+#   python benchmarks/powerbutton_soak.py --cycles 5000 --seed 1
+#   python benchmarks/powerbutton_soak.py --cycles 100 --record trace.json
+#   python benchmarks/powerbutton_soak.py --replay trace.json
+#
+# The report (throughput, state convergence latency) is written as JSON.
+# The exit status is 1 if an invariant was violated.
+
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import flask
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import octoprint_powerbutton
+from octoprint_powerbutton.power_hub import PRIMARY_CHANNEL
+from octoprint_powerbutton.power_states import *
+from octoprint_powerbutton.scheduler import Scheduler
+from powerbutton_bench import FakeSettings
+
+# Wall time of the start of the simulation
+WALL_EPOCH = 1.5e9
+
+# Simulated printer and device timing, in (virtual) seconds
+ENUMERATION_TIME = (0.5, 5.0)   # From power on to the serial device appearing
+CONNECT_TIME = 0.5              # From a connect request to the Connected event
+CONNECT_FAILURE_RATE = 0.1      # Connections failing while the device is present
+EVENT_DELAY = 0.01              # Events are delivered asynchronously
+SHORT_PRESS = 0.2
+LONG_PRESS = 3.0
+
+# The plugin is considered idle when nothing is scheduled for this long,
+# which is when the invariants are checked
+QUIET_TIME = 0.5
+
+# Actions that may happen while printing
+PRINT_NOISE = ["api_off", "api_on", "button_short", "refresh", "cancel_auto_off"]
+
+# Number of violations printed
+MAX_REPORTED = 20
+
+##~~ Traces
+
+# Generate a trace of print cycles. A trace is a list of (time, action)
+# pairs; actions are not conditional (a print started while the printer is
+# not connected is ignored by the printer, as it would be by OctoPrint), so
+# a trace replays the same way whatever the plugin does.
+def generate_trace(rng, cycles, auto_off_interval):
+    actions = []
+    t = 1.0
+    for _ in range(cycles):
+        actions.append((t, rng.choice(["api_on", "button_short"])))
+        t += rng.uniform(3, 30)
+
+        for _ in range(1 + (rng.random() < 0.2)):
+            actions.append((t, "print_start"))
+            duration = rng.uniform(60, 7200)
+            for _ in range(rng.randint(0, 3)):
+                actions.append((t + rng.uniform(0, duration), rng.choice(PRINT_NOISE)))
+            if rng.random() < 0.02:
+                # The user forces the power off
+                actions.append((t + rng.uniform(0, duration), "button_long"))
+            t += duration
+            actions.append((t, "print_failed" if rng.random() < 0.1 else "print_done"))
+
+            # The next print may start while counting down
+            t += rng.uniform(1, auto_off_interval * 1.5)
+
+        # Cancel the countdown, power off, or let the countdown expire
+        r = rng.random()
+        if r < 0.2:
+            actions.append((t, "cancel_auto_off"))
+            t += rng.uniform(1, 60)
+        if r < 0.4:
+            actions.append((t, rng.choice(["api_off", "button_short", "button_long"])))
+        t += auto_off_interval + rng.uniform(10, 600)
+
+    actions.sort(key = lambda a: a[0])
+    return actions
+
+##~~ Simulated environment
+
+# Reports the errors logged (including the exceptions of the scheduled
+# tasks) as violations
+class ViolationHandler(logging.Handler):
+
+    def __init__(self, sim):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.sim = sim
+
+    def emit(self, record):
+        message = record.getMessage()
+        if record.exc_info:
+            message += "\n" + logging.Formatter().formatException(record.exc_info)
+        self.sim.violation("Error logged: %s" % message)
+
+class VirtualClock:
+
+    def __init__(self):
+        self.t = 0.0
+
+    def __call__(self):
+        return self.t
+
+class SimulatedPlugin(octoprint_powerbutton.PowerbuttonPlugin):
+
+    def __init__(self, sim):
+        octoprint_powerbutton.PowerbuttonPlugin.__init__(self)
+        self.sim = sim
+
+    # The scheduler is not started: the simulator runs its tasks
+    def create_scheduler(self):
+        return Scheduler(clock = self.sim.clock, logger = self._logger)
+
+    def wall_time(self):
+        return WALL_EPOCH + self.sim.clock()
+
+    # The serial port is watched on the simulated device
+    def create_serial_port_watch(self, channel_state):
+        return DeviceWatch(self.sim.device, lambda ready: self.on_auto_connect(channel_state, ready),
+            self.config.auto_connect_delay)
+
+    def on_power_state(self, new_state, channel = PRIMARY_CHANNEL, old_state = None, cause = CAUSE_UNKNOWN):
+        self.sim.on_transition(channel, old_state, new_state, cause)
+        octoprint_powerbutton.PowerbuttonPlugin.on_power_state(self, new_state, channel, old_state, cause)
+
+class SimulatedPluginManager:
+
+    def __init__(self, sim):
+        self.sim = sim
+
+    def send_plugin_message(self, identifier, message):
+        self.sim.on_message(message)
+
+# The serial device of the printer. Appears some time after the power is
+# turned on, and disappears when it is turned off.
+class SimulatedDevice:
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.present = False
+        self.appear_task = None
+        self.watches = set()
+
+    def power(self, on):
+        if on and not self.present and self.appear_task is None:
+            self.appear_task = self.sim.scheduler.call_later(self.sim.rng.uniform(*ENUMERATION_TIME), self.appear)
+        elif not on:
+            if self.appear_task is not None:
+                self.appear_task.cancel()
+                self.appear_task = None
+            self.present = False
+
+    def appear(self):
+        self.appear_task = None
+        self.present = True
+        for watch in list(self.watches):
+            watch.appeared()
+
+# Stands in for SerialPortWatch: calls on_ready(True) when the device is
+# present, or on_ready(False) after the timeout
+class DeviceWatch:
+
+    def __init__(self, device, on_ready, timeout):
+        self.device = device
+        self.on_ready = on_ready
+        self.task = device.sim.scheduler.call_later(0 if device.present else timeout, self.fire)
+        device.watches.add(self)
+
+    def appeared(self):
+        self.task.cancel()
+        self.task = self.device.sim.scheduler.call_later(0, self.fire)
+
+    def fire(self):
+        self.device.watches.discard(self)
+        self.on_ready(self.device.present)
+
+    def cancel(self):
+        self.task.cancel()
+        self.device.watches.discard(self)
+
+    # Runs on the simulator's scheduler, there's no thread to wait for
+    def join(self, timeout = None):
+        return True
+
+# The printer, as seen through OctoPrint: connects (asynchronously) only
+# if its serial device is present (and even then fails sometimes), and
+# fires the connection and print events. A failed connection is reported
+# with an Error, and then closed.
+class SimulatedPrinter:
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.state = "Closed"
+        self.connect_task = None
+
+    def get_current_connection(self):
+        if self.state == "Closed":
+            return (self.state, None, None, None)
+        return (self.state, "/dev/ttySIM0", 115200, dict(id = "_default"))
+
+    def is_printing(self):
+        return self.state == "Printing"
+
+    def is_closed_or_error(self):
+        return self.state == "Closed"
+
+    def connect(self, port = None, baudrate = None, profile = None):
+        if self.connect_task is None:
+            self.connect_task = self.sim.scheduler.call_later(CONNECT_TIME, self.connected)
+
+    def connected(self):
+        self.connect_task = None
+        if self.state != "Closed":
+            return
+        self.sim.connects += 1
+        if self.sim.device.present and self.sim.rng.random() >= CONNECT_FAILURE_RATE:
+            self.state = "Operational"
+            self.sim.fire("Connected", dict(port = "/dev/ttySIM0", baudrate = 115200))
+        else:
+            self.sim.connect_failures += 1
+            self.sim.fire("Error", dict(error = "No such device"))
+            self.sim.fire("Disconnected", None)
+
+    def disconnect(self):
+        if self.state == "Printing":
+            self.sim.fire("PrintFailed", dict(reason = "error"))
+        if self.state != "Closed":
+            self.state = "Closed"
+            self.sim.fire("Disconnected", None)
+
+    def start_print(self):
+        if self.state == "Operational":
+            self.state = "Printing"
+            self.sim.fire("PrintStarted", {})
+
+    def end_print(self, success):
+        if self.state == "Printing":
+            self.state = "Operational"
+            self.sim.fire("PrintDone" if success else "PrintFailed", {})
+
+##~~ Simulator
+
+class Simulator:
+
+    def __init__(self, seed, auto_off_interval):
+        self.rng = random.Random(seed)
+        self.clock = VirtualClock()
+
+        logger = logging.getLogger("powerbutton.soak")
+        logger.addHandler(ViolationHandler(self))
+        logger.propagate = False
+
+        # Runs the simulated environment (trace actions, printer, device).
+        # The plugin has its own scheduler, on the same clock.
+        self.scheduler = Scheduler(clock = self.clock, logger = logger)
+
+        self.device = SimulatedDevice(self)
+        self.app = flask.Flask("powerbutton-soak")
+
+        self.violations = []
+        self.actions = 0
+        self.transitions = 0
+        self.messages = 0
+        self.connects = 0
+        self.connect_failures = 0
+        self.last_message = {}      # channel -> last power state message
+        self.unconverged = {}       # channel -> time of the first transition not notified yet
+        self.convergence = []
+        self.button_task = None
+
+        plugin = SimulatedPlugin(self)
+        settings = plugin.get_settings_defaults()
+        settings["power_ctrl_module"] = "stub"
+        settings["auto_power_off"]["interval"] = auto_off_interval
+        settings["auto_connect"]["enabled"] = True
+        plugin._settings = FakeSettings(settings)
+        plugin._plugin_manager = SimulatedPluginManager(self)
+        plugin._printer = SimulatedPrinter(self)
+        plugin._logger = logger
+        plugin._identifier = "powerbutton"
+        plugin._plugin_version = "soak"
+
+        self.data_folder = tempfile.mkdtemp(prefix = "powerbutton-soak-")
+        plugin.get_plugin_data_folder = lambda: self.data_folder
+        self.plugin = plugin
+        self.printer = plugin._printer
+
+        self.baseline_threads = set(threading.enumerate())
+        plugin.on_after_startup()
+        self.startup_threads = set(threading.enumerate())
+        self.run_until(self.clock() + QUIET_TIME)
+
+    def stop(self):
+        plugin = self.plugin
+        plugin.on_shutdown()
+        if plugin.scheduler.pending() or self.device.watches:
+            self.violation("Timers left after the shutdown: %d tasks, %d serial port watches" %
+                (plugin.scheduler.pending(), len(self.device.watches)))
+        shutil.rmtree(self.data_folder, ignore_errors = True)
+
+    def violation(self, message):
+        self.violations.append("%.2f: %s" % (self.clock(), message))
+
+    ##~~ Hooks
+
+    def on_transition(self, channel, old_state, new_state, cause):
+        self.transitions += 1
+        if channel not in self.unconverged:
+            self.unconverged[channel] = self.clock()
+
+        if new_state == POWER_STATE_OFF and cause != CAUSE_BUTTON:
+            if old_state == POWER_STATE_LOCKED:
+                self.violation("%s powered off while locked (%s)" % (channel, str_cause(cause)))
+            elif channel == PRIMARY_CHANNEL and self.printer.is_printing():
+                self.violation("%s powered off while printing (%s)" % (channel, str_cause(cause)))
+
+        if channel == PRIMARY_CHANNEL and new_state == POWER_STATE_OFF and self.printer.state != "Closed":
+            self.violation("%s powered off while the printer was connected (%s)" % (channel, str_cause(cause)))
+
+        if channel == PRIMARY_CHANNEL:
+            self.device.power(new_state != POWER_STATE_OFF)
+            if new_state == POWER_STATE_OFF:
+                self.printer.disconnect()
+
+    def on_message(self, message):
+        self.messages += 1
+        channel = message.get("channel")
+        if channel is None or "powerState" not in message:
+            return
+
+        self.last_message[channel] = message
+        start = self.unconverged.get(channel)
+        if start is not None and message["powerState"] == self.expected_state(channel):
+            self.convergence.append(self.clock() - start)
+            del self.unconverged[channel]
+
+    # An event from OctoPrint, delivered asynchronously
+    def fire(self, event, payload):
+        self.scheduler.call_later(EVENT_DELAY, self.plugin.on_event, event, payload)
+
+    ##~~ Actions
+
+    def run_action(self, action):
+        self.actions += 1
+        if action == "api_on" or action == "api_off":
+            self.api_command("power", dict(newState = action[4:]))
+            self.plugin.command_queue.wait_idle(5.0)
+        elif action == "refresh" or action == "cancel_auto_off":
+            self.api_command(action, {})
+        elif action == "button_short":
+            self.press_button(SHORT_PRESS)
+        elif action == "button_long":
+            self.press_button(LONG_PRESS)
+        elif action == "print_start":
+            self.printer.start_print()
+        elif action == "print_done" or action == "print_failed":
+            self.printer.end_print(action == "print_done")
+        else:
+            raise ValueError("Unknown action: %s" % action)
+
+    def api_command(self, command, data):
+        with self.app.test_request_context():
+            self.plugin.on_api_command(command, data)
+
+    def press_button(self, duration):
+        now = self.clock()
+        self.button_edge(True, now)
+        self.scheduler.call_at(now + duration, self.button_edge, False, now + duration)
+
+    # The input thread of a power controller: reports the edges, and polls
+    # for the time based gestures
+    def button_edge(self, pressed, t):
+        power_ctrl = self.plugin.power_ctrl
+        power_ctrl._button_changed(power_ctrl.channel(PRIMARY_CHANNEL), pressed, t)
+        self.button_poll()
+
+    def button_poll(self):
+        if self.button_task is not None:
+            self.button_task.cancel()
+        delay = self.plugin.power_ctrl._button_check(self.clock())
+        self.button_task = self.scheduler.call_later(delay, self.button_poll) if delay is not None else None
+
+    ##~~ Running
+
+    # Run the tasks of both schedulers up to the given time, checking the
+    # invariants whenever the plugin is idle
+    def run_until(self, end):
+        schedulers = (self.scheduler, self.plugin.scheduler)
+        while True:
+            deadlines = [deadline for deadline in [s.run_pending() for s in schedulers] if deadline is not None]
+
+            # The power commands queued by the tasks (auto-power-off, button)
+            # are applied by the plugin's worker thread
+            if not self.plugin.command_queue.wait_idle(0):
+                self.plugin.command_queue.wait_idle(5.0)
+                continue
+
+            if any(deadline <= self.clock() for deadline in deadlines):
+                # One scheduler's tasks scheduled tasks on the other
+                continue
+
+            next_deadline = min(deadlines) if deadlines else None
+            if next_deadline is None or next_deadline - self.clock() >= QUIET_TIME:
+                self.check_idle()
+            if next_deadline is None or next_deadline > end:
+                self.clock.t = max(self.clock.t, end)
+                return
+            self.clock.t = next_deadline
+
+    def replay(self, actions):
+        for t, action in actions:
+            self.run_until(t)
+            self.run_action(action)
+
+        # Let the last countdown expire, and everything settle
+        self.run_until(self.clock() + 3600)
+
+    ##~~ Invariants
+
+    def expected_state(self, channel):
+        state = self.plugin.power_ctrl.channel(channel).get_power_state()
+        return str_power_state(state) if state is not None else "unknown"
+
+    def check_idle(self):
+        plugin = self.plugin
+        for channel, channel_state in plugin.channel_states.items():
+            expected = self.expected_state(channel)
+            deadline = channel_state.auto_power_off_wall_deadline
+
+            message = self.last_message.get(channel)
+            if message is None or message["powerState"] != expected:
+                self.violation("%s is %s, but the last message says %s" % (channel, expected,
+                    message and message["powerState"]))
+            elif message.get("autoOffDeadline") != deadline:
+                self.violation("%s auto-off deadline is %s, but the last message says %s" % (channel, deadline,
+                    message.get("autoOffDeadline")))
+
+            # A transition may not need a message (when the state changed
+            # back before it was sent)
+            if message is not None and message["powerState"] == expected:
+                self.unconverged.pop(channel, None)
+
+            status = plugin.status.get(channel) or {}
+            if status.get("powerState") != expected or status.get("autoOffDeadline") != deadline:
+                self.violation("%s status %r does not match its state (%s, deadline %s)" % (channel, status, expected, deadline))
+
+            if deadline is not None and expected != "on":
+                self.violation("%s is counting down to auto-off while %s" % (channel, expected))
+
+        # Every pending task must belong to the plugin state
+        with plugin.scheduler.cond:
+            tasks = [t for t in plugin.scheduler.heap if not t.cancelled]
+        for task in tasks:
+            name = getattr(task.fn, "__name__", repr(task.fn))
+            channel_state = task.args[0] if task.args else None
+            if name == "on_timer" and channel_state.auto_power_off_task is task:
+                continue
+            if name == "on_auto_connect_retry" and channel_state.auto_connect_task is task:
+                continue
+            if name == "update_led_pattern":
+                error_deadline = plugin.channel_states[task.args[0]].command_error_deadline
+                if error_deadline is not None and task.deadline <= error_deadline + 1e-6:
+                    continue
+            self.violation("Leaked timer: %s%r at %.2f" % (name, task.args, task.deadline))
+            task.cancel()
+
+        watches = set(cs.auto_connect_watch for cs in plugin.channel_states.values())
+        for watch in list(self.device.watches):
+            if watch not in watches:
+                self.violation("Leaked serial port watch")
+                watch.cancel()
+
+        threads = set(threading.enumerate()) - self.startup_threads
+        if threads:
+            self.violation("Threads started after the startup: %s" % ", ".join(t.name for t in threads))
+            self.startup_threads.update(threads)
+
+##~~ Main
+
+def summarize(samples):
+    samples = sorted(samples)
+    if not samples:
+        return None
+    n = len(samples)
+    return dict(n = n, median = samples[n // 2], p99 = samples[min(n - 1, int(n * 0.99))],
+        max = samples[-1], mean = sum(samples) / n)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Soak test the PowerButton plugin on a virtual clock")
+    parser.add_argument("--cycles", type = int, default = 1000, help = "number of power cycles (default: 1000)")
+    parser.add_argument("--seed", type = int, default = None, help = "random seed of the trace")
+    parser.add_argument("--auto-off", type = float, default = 180, help = "auto-power-off interval, in seconds")
+    parser.add_argument("--record", metavar = "FILE", help = "write the trace (JSON) to this file")
+    parser.add_argument("--replay", metavar = "FILE", help = "replay a recorded trace")
+    parser.add_argument("-o", "--output", help = "write the report (JSON) to this file")
+    args = parser.parse_args()
+
+    if args.replay:
+        with open(args.replay) as f:
+            trace = json.load(f)
+    else:
+        seed = args.seed if args.seed is not None else random.randrange(1 << 32)
+        actions = generate_trace(random.Random(seed), args.cycles, args.auto_off)
+        trace = dict(seed = seed, cycles = args.cycles, autoOff = args.auto_off, actions = actions)
+        if args.record:
+            with open(args.record, "w") as f:
+                json.dump(trace, f)
+
+    sim = Simulator(trace["seed"], trace["autoOff"])
+    start = time.time()
+    try:
+        sim.replay(trace["actions"])
+    finally:
+        elapsed = time.time() - start
+        sim.stop()
+
+    time.sleep(0.1)
+    leaked = set(threading.enumerate()) - sim.baseline_threads
+    if leaked:
+        sim.violation("Threads left after the shutdown: %s" % ", ".join(t.name for t in leaked))
+
+    report = dict(
+        seed = trace["seed"],
+        cycles = trace["cycles"],
+        actions = sim.actions,
+        transitions = sim.transitions,
+        messages = sim.messages,
+        connects = sim.connects,
+        connect_failures = sim.connect_failures,
+        virtual_seconds = sim.clock(),
+        real_seconds = elapsed,
+        speedup = sim.clock() / elapsed,
+        cycles_per_second = trace["cycles"] / elapsed,
+        actions_per_second = sim.actions / elapsed,
+        convergence_seconds = summarize(sim.convergence),
+        violations = len(sim.violations)
+    )
+
+    text = json.dumps(report, indent = 2, sort_keys = True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    for violation in sim.violations[:MAX_REPORTED]:
+        print("VIOLATION %s" % violation, file = sys.stderr)
+    if sim.violations:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
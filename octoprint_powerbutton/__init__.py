@@ -2,22 +2,95 @@
 from __future__ import absolute_import
 import flask
 import octoprint_powerbutton.raspi_power as raspi_power
+import octoprint_powerbutton.gpiochip_power as gpiochip_power
+import os
 import time
+from functools import partial
 from octoprint_powerbutton.power_ctrl_stub import StubPowerController 
 from octoprint_powerbutton.power_states import *
-from threading import Timer, Lock
+from octoprint_powerbutton.scheduler import Scheduler, monotonic
+from octoprint_powerbutton.notifier import StateNotifier
+from octoprint_powerbutton.command_queue import PowerCommandQueue
+from octoprint_powerbutton.config import load_config, controller_key, control_socket_key, power_meter_key, \
+	extra_channel_pins
+from octoprint_powerbutton.power_hub import PRIMARY_CHANNEL
+from octoprint_powerbutton.metrics import MetricsRegistry
+from octoprint_powerbutton.journal import PowerJournal
+from octoprint_powerbutton.leds import LedAnimator, BlinkPattern, BreathePattern, CountdownPattern
+from octoprint_powerbutton.power_hub import LED_COLOR_RED, LED_COLOR_GREEN, LED_COLOR_YELLOW
+from octoprint_powerbutton.serial_watch import SerialPortWatch
+from octoprint_powerbutton.connection_cache import ConnectionCache
+from octoprint_powerbutton.control_socket import ControlSocketServer
+from octoprint_powerbutton.power_meter import PowerMeter, create_sensor
+from threading import Lock
 
-# The state check interval in auto-power-off mode
-AUTO_POWER_OFF_INTERVAL = 10
+# How long the LED shows a failed power command, in seconds
+COMMAND_ERROR_LED_TIME = 3.0
+
+# Shortest interval between two push messages for the power drawn by the
+# printer, in seconds. (A printer's draw changes all the time, with its
+# heaters.) The clients get the full history with the power GET query.
+POWER_NOTIFY_INTERVAL = 5.0
+
+# Maximal time to wait for the printer connection to close before powering
+# it off, and the interval it is checked at, in seconds
+DISCONNECT_TIMEOUT = 5.0
+DISCONNECT_POLL_INTERVAL = 0.02
+
+# Delays before retrying a failed auto-connect, in seconds. The delay
+# doubles after each failure, and the retries stop when auto_connect.delay
+# has run out since the power was turned on.
+AUTO_CONNECT_RETRY_INITIAL = 2.0
+AUTO_CONNECT_RETRY_MAX = 16.0
+
+# Maximal time the plugin shutdown waits for its threads to exit, in
+# seconds, in total
+SHUTDOWN_TIMEOUT = 2.0
 
 import octoprint.plugin
 
+# The runtime state the plugin keeps for each power channel
+class ChannelState:
+
+	def __init__(self, name):
+		self.name = name
+
+		# Holds the auto-power-off countdown. The deadline is in scheduler
+		# (monotonic) time, and is None when the countdown is not engaged.
+		self.auto_power_off_deadline = None
+		self.auto_power_off_interval = None
+		self.auto_power_off_task = None
+		self.auto_power_off_lock = Lock()
+
+		# The countdown deadline in wall time, for the clients
+		self.auto_power_off_wall_deadline = None
+
+		# The cause of the current lock (None when not locked)
+		self.lock_cause = None
+
+		# Will hold the watch of the serial port, waiting for it to be ready
+		# for an auto-connect. Then the retry of a failed auto-connect, and
+		# the delay of the next one. The deadline (scheduler time) is when
+		# auto_connect.delay runs out.
+		self.auto_connect_watch = None
+		self.auto_connect_task = None
+		self.auto_connect_retry_delay = None
+		self.auto_connect_deadline = None
+
+		# The LED pattern shown (see update_led_pattern), the ids of the
+		# power commands not completed yet, and the time until which a
+		# failed command is shown
+		self.led_pattern = None
+		self.pending_commands = set()
+		self.command_error_deadline = None
+
 class PowerbuttonPlugin(octoprint.plugin.SettingsPlugin,
                         octoprint.plugin.AssetPlugin,
                         octoprint.plugin.TemplatePlugin,
                         octoprint.plugin.StartupPlugin,
                         octoprint.plugin.SimpleApiPlugin,
-						octoprint.plugin.EventHandlerPlugin):
+						octoprint.plugin.EventHandlerPlugin,
+						octoprint.plugin.ShutdownPlugin):
 
 	##~~ SettingsPlugin mixin
 
@@ -31,7 +104,21 @@ class PowerbuttonPlugin(octoprint.plugin.SettingsPlugin,
 				gpio_green = 2,
 				led_polarity = False,
 				button_polarity = True,
-				relay_polarity = True
+				relay_polarity = True,
+				keep_relay_state = True,
+				sysfs_gpio = "/sys/class/gpio",
+				# Unexporting the pins on shutdown leaves the relay undriven
+				unexport_on_shutdown = False
+			),
+			# Show the auto-power-off countdown, pending and failed
+			# commands with LED animations
+			led_animations = True,
+			# Breathe the LED while printing (instead of the static locked
+			# color). Software PWM, which writes the LED pins about 150 times
+			# a second.
+			led_breathe = False,
+			gpiochip = dict(
+				chip = "/dev/gpiochip0"
 			),
 			auto_power_off = dict(
 				interval = 180,
@@ -41,8 +128,53 @@ class PowerbuttonPlugin(octoprint.plugin.SettingsPlugin,
 				enabled = False,
 				port = "",
 				baud = "",
-				delay = 30,
+				delay = 60,
 				profile = ""
+			),
+			# Button gestures timing (in milliseconds), and the action
+			# (toggle, on, off or none) of each gesture
+			button = dict(
+				debounce_ms = 50,
+				short_max_ms = 750,
+				long_ms = 2500,
+				double_press_ms = 0,
+				repeat_ms = 0,
+				actions = dict(
+					short = "toggle",
+					double = "none",
+					long = "off",
+					hold_repeat = "none"
+				)
+			),
+			# Additional power channels (relays), each a dict with a name,
+			# the raspi_power pin settings, follow_print and auto_power_off
+			channels = [],
+			# The action (lock, unlock, auto_off, on or off) taken when an
+			# event fires. A rule without "channels" applies to the channels
+			# that follow the print.
+			event_rules = [
+				dict(event = "PrintStarted", action = "lock"),
+				dict(event = "PrintFailed", action = "unlock"),
+				dict(event = "PrintCancelled", action = "unlock"),
+				dict(event = "PrintDone", action = "auto_off")
+			],
+			# Local control through a Unix domain socket (see
+			# control_socket.py), created in the plugin data folder if no
+			# path is set. Its (octal) mode sets who can use it.
+			control_socket = dict(
+				enabled = False,
+				path = "",
+				mode = "660"
+			),
+			# Power sensor of the printer (see power_meter.py): the sensor
+			# type, the file it reads, the factor from its unit to watts, and
+			# the sampling interval (seconds)
+			power_meter = dict(
+				enabled = False,
+				sensor = "file",
+				path = "",
+				scale = 1.0,
+				interval = 0.25
 			)
 		)
 
@@ -85,181 +217,993 @@ class PowerbuttonPlugin(octoprint.plugin.SettingsPlugin,
 			)
 		)
 
+	def on_settings_save(self, data):
+		octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+
+		if not hasattr(self, "config"):
+			return
+
+		try:
+			new_config = load_config(self._settings)
+		except ValueError as e:
+			self._logger.error("Invalid settings, keeping the previous configuration: %s" % e)
+			return
+
+		# Replace the configuration snapshot, and rebuild the power controller
+		# if its pin settings have changed (the button settings are applied to
+		# the running controller)
+		old_config = self.config
+		self.config = new_config
+
+		self.update_channel_states()
+		self.update_event_handlers()
+		self.update_status()
+
+		if control_socket_key(new_config) != control_socket_key(old_config):
+			self.update_control_server()
+		if power_meter_key(new_config) != power_meter_key(old_config):
+			self.update_power_meter()
+
+		if controller_key(new_config) != controller_key(old_config):
+			self._logger.info("Power controller settings changed, reloading the controller")
+			self.reload_power_controller(old_config)
+		else:
+			self.power_ctrl.set_button(new_config.button)
+			self.update_led_patterns()
+
 	def on_after_startup(self):
-		# Create a lock for state notfication
-		self.state_notif_lock = Lock()
-
-	    # Create a Power controller module instance
-		power_module_name = self._settings.get(["power_ctrl_module"])
-		if power_module_name == "raspi_power":
-			raspi_power_settings = self._settings.get(['raspi_power'])
-			self.power_ctrl = raspi_power.RaspiPowerControl(self.on_power_state, raspi_power_settings)
-		elif power_module_name == "stub":
-			self.power_ctrl = StubPowerController(self._logger, self.on_power_state)
+		# Load the configuration
+		try:
+			self.config = load_config(self._settings)
+		except ValueError as e:
+			self._logger.error("Invalid settings: %s" % e)
+			raise RuntimeError("Invalid settings")
+
+		# Latency and throughput metrics of all the plugin components
+		self.metrics = MetricsRegistry()
+		self.timer_lateness = self.metrics.histogram("powerbutton_timer_lateness_seconds",
+			"Delay between an auto-power-off deadline and the time its timer ran")
+
+		# All the timed work of the plugin (auto-power-off countdown,
+		# auto-connect, notifications) runs on this scheduler
+		self.scheduler = self.create_scheduler()
+
+		# Sends (coalesced) power state notifications to the clients
+		self.notifier = StateNotifier(self.scheduler, self.get_power_state_message, self.send_power_state_message,
+			metrics = self.metrics)
+
+		# The status of all the channels served by the GET API, and its
+		# version, which changes whenever the status does. The epoch makes
+		# versions of different runs distinct.
+		self.status_lock = Lock()
+		self.status = {}
+		self.status_version = 0
+		self.status_epoch = "%x" % int(time.time())
+
+		# Runtime state of each channel
+		self.channel_states = {}
+		self.update_channel_states()
+
+		# Runs the LED animations
+		self.led_animator = LedAnimator(self.scheduler, self.set_led_color)
+		self.led_pattern_lock = Lock()
+
+		# Journal of all the power state transitions
+		self.journal = PowerJournal(os.path.join(self.get_plugin_data_folder(), "journal.bin"), clock = self.wall_time)
+
+		# The connection parameters of the devices the printer was connected
+		# to. The channel of the auto-connect waiting for its result, and if
+		# it was made with cached parameters, (device identity, fallback port,
+		# baudrate, profile).
+		self.connection_cache = ConnectionCache(os.path.join(self.get_plugin_data_folder(), "connections.json"),
+			logger = self._logger)
+		self.auto_connect_channel = None
+		self.cached_connect = None
+		self.connect_failed = False
+		self.control_server = None
+		self.power_meter = None
+		self.power_notified = None
+
+		# Create a Power controller module instance
+		self.power_ctrl = self.create_power_controller(self.config)
+		self.update_status()
+		self.update_led_patterns()
+
+		# The handlers of the OctoPrint events
+		self.update_event_handlers()
+
+		# Power commands from the API are applied by this queue's worker
+		self.command_queue = PowerCommandQueue(self.apply_power_states, self.on_power_command_complete, self._logger,
+			metrics = self.metrics)
+
+		# Serves the local control socket, if enabled
+		self.update_control_server()
+
+		# Samples the printer's power sensor, if enabled
+		self.update_power_meter()
+
+	##~~ ShutdownPlugin mixin
+
+	# Stop all the plugin threads and timers and release the GPIO, waiting
+	# for at most SHUTDOWN_TIMEOUT seconds in total
+	def on_shutdown(self):
+		if not hasattr(self, "command_queue"):
+			return
+		start = monotonic()
+		deadline = start + SHUTDOWN_TIMEOUT
+		remaining = lambda: max(0, deadline - monotonic())
+
+		# The components whose threads didn't exit in time
+		running = []
+
+		# No more power commands
+		if self.control_server is not None and not self.control_server.stop(remaining()):
+			running.append("control socket")
+		if not self.command_queue.stop(remaining()):
+			running.append("command queue")
+
+		if self.power_meter is not None and not self.power_meter.stop(remaining()):
+			running.append("power meter")
+
+		# Cancel the countdowns and the serial port watches
+		watches = []
+		for channel_state in list(self.channel_states.values()):
+			with channel_state.auto_power_off_lock:
+				self.stop_auto_power_off(channel_state)
+			if channel_state.auto_connect_watch is not None:
+				watches.append(channel_state.auto_connect_watch)
+			self.stop_auto_connect(channel_state)
+
+		# Stop the animations (restoring the power state colors), and then
+		# all the timers still pending
+		self.led_animator.stop()
+		if not self.scheduler.stop(remaining()):
+			running.append("scheduler")
+
+		if not self.power_ctrl.shutdown(remaining(), unexport = self.config.unexport_on_shutdown):
+			running.append("power controller")
+		for watch in watches:
+			if not watch.join(remaining()):
+				running.append("serial port watch")
+		self.journal.close()
+
+		if running:
+			self._logger.warn("Still running after the shutdown: %s" % ", ".join(running))
+		self._logger.info("Shut down in %.0f ms" % ((monotonic() - start) * 1000))
+
+	# The scheduler and the wall clock (of the times sent to the clients).
+	# Replaced by the soak simulator, to run the plugin on a virtual clock.
+	def create_scheduler(self):
+		scheduler = Scheduler(logger = self._logger)
+		scheduler.start()
+		return scheduler
+
+	def wall_time(self):
+		return time.time()
+
+	# Create states for new channels, and drop the states of channels that
+	# no longer exist
+	def update_channel_states(self):
+		states = dict(self.channel_states)
+		for name in self.config.channels:
+			if name not in states:
+				states[name] = ChannelState(name)
+
+		for name in list(states.keys()):
+			if name not in self.config.channels:
+				channel_state = states.pop(name)
+				with channel_state.auto_power_off_lock:
+					self.stop_auto_power_off(channel_state)
+				self.stop_auto_connect(channel_state)
+				self.led_animator.set_pattern(name, None)
+
+		self.channel_states = states
+
+	# Create the power controller of a configuration. initial_states are the
+	# power states of the channels taken over from a previous controller.
+	def create_power_controller(self, config, initial_states = None):
+		channels = extra_channel_pins(config)
+
+		if config.power_ctrl_module == "raspi_power":
+			raspi_power_settings = dict(config.raspi_power, button = config.button)
+			return raspi_power.RaspiPowerControl(self.on_power_state, raspi_power_settings, channels,
+				metrics = self.metrics, power_off = self.power_off, initial_states = initial_states)
+		elif config.power_ctrl_module == "gpiochip":
+			# Uses the same pin settings as raspi_power, with line offsets
+			# on the given chip
+			gpiochip_settings = dict(config.raspi_power, button = config.button)
+			gpiochip_settings["chip"] = config.gpiochip
+			return gpiochip_power.GpiochipPowerControl(self.on_power_state, gpiochip_settings, channels,
+				metrics = self.metrics, power_off = self.power_off, initial_states = initial_states)
 		else:
-			self._logger.error("Only raspi_power or stub power control modules are supported")
-			raise RuntimeError("Unsupported power control module")
+			return StubPowerController(self._logger, self.on_power_state, channels, metrics = self.metrics,
+				power_off = self.power_off, initial_states = initial_states)
 
-		# Holds the auto-power-off countdown
-		self.auto_power_off = None
-		self.auto_power_off_lock = Lock()
+	# Replace the power controller with one built from the current
+	# configuration. The new controller takes over the power states of the
+	# channels, and starts with its outputs at their levels: nothing is
+	# switched (e.g. mid-print), and no transition is reported. If it can't
+	# be created, the controller of the previous configuration is created
+	# again, so the channels can still be switched.
+	def reload_power_controller(self, old_config):
+		old_ctrl = self.power_ctrl
 
-		# Will hold the auto connect timer
-		self.auto_connect_timer = None
+		# Stop the old controller's threads and release its pins, so the new
+		# controller can take them, and then take its power states. The
+		# changes made on the old controller from then on (by an event rule,
+		# a queued command, a timer) wait for the new one, and are made on it.
+		old_ctrl.shutdown()
+		power_states = old_ctrl.retire()
+
+		new_ctrl = None
+		try:
+			try:
+				new_ctrl = self.create_power_controller(self.config, power_states)
+			except Exception:
+				self._logger.exception("Failed creating the power controller, restoring the previous one")
+				new_ctrl = self.create_power_controller(old_config, power_states)
+		except Exception:
+			self._logger.exception("Failed restoring the power controller, the channels can't be switched")
+		finally:
+			if new_ctrl is not None:
+				self.power_ctrl = new_ctrl
+			old_ctrl.hand_over(new_ctrl)
+		if new_ctrl is None:
+			return
+
+		# Restart the LED animations on the new controller
+		with self.led_pattern_lock:
+			self.led_animator.stop()
+			for channel_state in self.channel_states.values():
+				channel_state.led_pattern = None
+		self.update_led_patterns()
+		for name in new_ctrl.channel_names():
+			self.notify_power_state(name)
+
+	# Apply the power commands of the queue. A channel that is locked
+	# (printing) is not changed by the API, and its commands fail.
+	def apply_power_states(self, states, causes):
+		power_ctrl = self.power_ctrl
+		errors = {}
+		for name in list(states.keys()):
+			if causes[name] == CAUSE_API and power_ctrl.channel(name).get_power_state() == POWER_STATE_LOCKED:
+				errors[name] = "Locked while printing"
+				del states[name]
+
+		# Make sure the serial link is closed before the printer's power
+		# drops
+		if states.get(PRIMARY_CHANNEL) == POWER_STATE_OFF:
+			self.disconnect_printer()
+
+		for cause in set(causes[name] for name in states):
+			power_ctrl.set_power_states(dict((name, state) for name, state in states.items() if causes[name] == cause),
+				cause = cause)
+		return errors
+
+	# Queue a power command. Returns its id.
+	def submit_power_command(self, channel, new_state, cause = CAUSE_API):
+		# The command is pending until completed, which may happen before
+		# submit returns
+		command_id = self.command_queue.submit(channel, new_state, cause,
+			on_submit = self.channel_states[channel].pending_commands.add)
+		self.update_led_pattern(channel)
+		return command_id
+
+	# Turn a channel off, for the button, the auto-power-off and the event
+	# rules. If the channel powers the printer and it is connected, the
+	# command is queued, as the printer is disconnected first. started is
+	# the (monotonic) time of the button press.
+	def power_off(self, channel, cause, started = None):
+		if channel == PRIMARY_CHANNEL and not self._printer.is_closed_or_error():
+			self.submit_power_command(channel, POWER_STATE_OFF, cause)
+		else:
+			self.power_ctrl.set_power_states({ channel: POWER_STATE_OFF }, started, cause)
+
+	# Disconnect the printer, and wait for at most timeout seconds for the
+	# connection to close. Returns True if it has closed.
+	def disconnect_printer(self, timeout = DISCONNECT_TIMEOUT):
+		# A connection being made is not retried
+		self.auto_connect_channel = None
+		self.cached_connect = None
+		printer = self._printer
+		if printer.is_closed_or_error():
+			return True
+
+		self._logger.info("Disconnecting the printer before powering it off")
+		printer.disconnect()
+		deadline = monotonic() + timeout
+		while not printer.is_closed_or_error():
+			if monotonic() >= deadline:
+				self._logger.warn("The printer connection did not close within %.0f seconds, powering off anyway" % timeout)
+				return False
+			time.sleep(DISCONNECT_POLL_INTERVAL)
+		return True
+
+	# Get the name of the channel an API request refers to, or None if
+	# there's no such channel
+	def get_request_channel(self, data):
+		name = data.get("channel", PRIMARY_CHANNEL)
+		return name if name in self.channel_states else None
 
     ## SimpleApiPlugin
+
+	def on_api_get(self, request):
+		if "journal" in request.values:
+			return self.get_journal_response(request.values)
+		elif "daily" in request.values:
+			return flask.jsonify(daily = self.journal.daily_totals(request.values.get("channel")))
+		elif "power" in request.values:
+			return self.get_power_response(request.values)
+		elif "metrics" in request.values:
+			# Return the plugin metrics, as JSON or in the Prometheus text
+			# format (?metrics=prometheus)
+			if request.values.get("metrics") == "prometheus":
+				response = flask.make_response(self.metrics.to_prometheus())
+				response.headers["Content-Type"] = "text/plain; version=0.0.4"
+				return response
+			return flask.jsonify(metrics = self.metrics.to_json())
+
+		return self.get_status_response(request)
+
+	# Return the status of all the channels. The response has an ETag, and
+	# a request with a matching If-None-Match header (or the version number
+	# as the "version" parameter) gets a 304 if nothing has changed. The
+	# request never waits for a change (the Flask handlers run on the web
+	# server's thread); the changes are pushed to the clients.
+	def get_status_response(self, request):
+		try:
+			known_version = request.values.get("version")
+			known_version = int(known_version) if known_version else None
+		except ValueError:
+			return flask.make_response("Illegal status query parameter", 400)
+
+		if_none_match = request.headers.get("If-None-Match")
+		if if_none_match:
+			for tag in if_none_match.split(","):
+				tag = tag.strip()
+				if tag.startswith("W/"):
+					tag = tag[2:]
+				prefix = '"%s-' % self.status_epoch
+				if tag.startswith(prefix) and tag.endswith('"') and tag[len(prefix):-1].isdigit():
+					known_version = int(tag[len(prefix):-1])
+
+		with self.status_lock:
+			version = self.status_version
+			status = self.status
+
+		if known_version == version:
+			response = flask.make_response("", 304)
+		else:
+			response = flask.jsonify(version = version, channels = status, serverTime = self.wall_time())
+		response.headers["ETag"] = '"%s-%d"' % (self.status_epoch, version)
+		response.headers["Cache-Control"] = "no-cache"
+		return response
+
+	# Recalculate the status of a channel (or of all the channels), and
+	# update its version if it has changed
+	def update_status(self, channel = None):
+		if not hasattr(self, "power_ctrl"):
+			return
+
+		with self.status_lock:
+			if channel is None:
+				status = {}
+				names = self.channel_states.keys()
+			else:
+				status = dict(self.status)
+				names = [channel]
+
+			for name in names:
+				channel_state = self.channel_states.get(name)
+				if channel_state is None or name not in self.power_ctrl.channels:
+					status.pop(name, None)
+					continue
+
+				power_state = self.power_ctrl.channel(name).get_power_state()
+				status[name] = dict(
+					powerState = str_power_state(power_state) if power_state is not None else "unknown",
+					autoOffDeadline = channel_state.auto_power_off_wall_deadline,
+					autoOffInterval = channel_state.auto_power_off_interval if channel_state.auto_power_off_wall_deadline else None,
+					lockCause = channel_state.lock_cause
+				)
+
+			if status != self.status:
+				self.status = status
+				self.status_version += 1
+
+	# Query the power transitions journal. Takes an optional wall time range
+	# (from, to), channel, page size (limit) and the cursor returned with the
+	# previous page (after).
+	def get_journal_response(self, values):
+		try:
+			start = float(values["from"]) if values.get("from") else None
+			end = float(values["to"]) if values.get("to") else None
+			after = int(values["after"]) if values.get("after") else None
+			limit = int(values.get("limit") or 100)
+		except ValueError:
+			return flask.make_response("Illegal journal query parameter", 400)
+
+		return flask.jsonify(self.journal.query(start, end, values.get("channel"), after, limit))
         
+	# Query the power samples of the printer: a wall time range (from, to,
+	# by default the last hour) and the maximal number of points. The
+	# points are (time, min, mean, max), at the resolution returned.
+	def get_power_response(self, values):
+		power_meter = self.power_meter
+		if power_meter is None:
+			return flask.make_response("Power meter not enabled", 404)
+
+		try:
+			end = float(values["to"]) if values.get("to") else self.wall_time()
+			start = float(values["from"]) if values.get("from") else end - 3600
+			points = int(values.get("points") or 300)
+		except ValueError:
+			return flask.make_response("Illegal power query parameter", 400)
+
+		result = power_meter.history.query(start, end, points)
+		return flask.jsonify(power = power_meter.value, resolution = result["resolution"], points = result["points"])
+
 	def get_api_commands(self):
+		# All the commands take an optional "channel" parameter, which
+		# defaults to the primary channel
 		return dict(
 				power = ['newState'],
+				power_off = [],
 				refresh_state = [],
 				cancel_auto_off = []
 				)
 
 	def on_api_command(self, command, data):
+		try:
+			result = self.run_command(command, data)
+		except ValueError as e:
+			return flask.make_response(str(e), 400)
+		if result is not None:
+			return flask.jsonify(**result)
+
+	# Run an API command, from the API or from the control socket. Returns
+	# the result (a dict) or None, and raises ValueError if the command is
+	# invalid.
+	def run_command(self, command, data):
+		channel = self.get_request_channel(data)
+		if channel is None:
+			raise ValueError("Unknown channel")
+
 		if command == "power":
 			# Set the power mode (on/off)
 			#############################
-			if data["newState"] == "on":
+			if data.get("newState") == "on":
 				new_state = POWER_STATE_ON
-			elif data["newState"] == "off":
+			elif data.get("newState") == "off":
 				new_state = POWER_STATE_OFF
 			else:
-				return flask.make_response("Illegal power state parameter", 400)
+				raise ValueError("Illegal power state parameter")
+
+			# Queue the command and return immediately. Its completion is
+			# reported with a push message.
+			self._logger.info("Setting power of %s to %s", channel, "On" if new_state else "Off")
+			return dict(commandId = self.submit_power_command(channel, new_state))
 
-			#time.sleep(5)  # For testing
-			self._logger.info("Setting power to %s", "On" if new_state else "Off")
-			self.power_ctrl.set_power_state(new_state)
+		elif command == "power_off":
+			# Disconnect the printer (if powered by the channel), wait for
+			# the connection to close, and switch off
+			#################################################################
+			self._logger.info("Powering off %s", channel)
+			return dict(commandId = self.submit_power_command(channel, POWER_STATE_OFF))
 		
 		elif command == "refresh_state":
-			# Resend the power state to the client
-			######################################
-			self.notify_power_state()
+			# Resend the power state of all the channels to the client
+			##########################################################
+			for name in self.channel_states:
+				self.notify_power_state(name, force = True)
 
 		elif command == "cancel_auto_off":
 			# Cancel auto-power-off (if engaged) and set
 			# the power state to "on"
-			if (self.power_ctrl.get_power_state() == POWER_STATE_ON and self.auto_power_off > 0):
-				self.auto_power_off_lock.acquire()
-				self._logger.info("Canceling auto-power-off mode")
-				self.auto_power_off = 0
-				self.notify_power_state()
-				self.auto_power_off_lock.release()
+			channel_state = self.channel_states[channel]
+			if (self.power_ctrl.channel(channel).get_power_state() == POWER_STATE_ON and channel_state.auto_power_off_deadline is not None):
+				channel_state.auto_power_off_lock.acquire()
+				self._logger.info("Canceling auto-power-off mode of %s" % channel)
+				self.stop_auto_power_off(channel_state)
+				self.notify_power_state(channel)
+				channel_state.auto_power_off_lock.release()
 
 			else:
 				self._logger.warn("Auto-power-off cancel request, but not in that mode")
 
+		else:
+			raise ValueError("Unknown command: %s" % command)
+
+	##~~ Power meter
+
+	# Start the power meter if enabled, replacing the running one (and
+	# keeping its history)
+	def update_power_meter(self):
+		history = None
+		if self.power_meter is not None:
+			self.power_meter.stop(SHUTDOWN_TIMEOUT)
+			history = self.power_meter.history
+			self.power_meter = None
+
+		config = self.config
+		if not config.power_meter_enabled:
+			return
+		sensor = create_sensor(config.power_meter_sensor, config.power_meter_path, config.power_meter_scale)
+		self.power_meter = PowerMeter(sensor, config.power_meter_interval, clock = self.wall_time,
+			on_sample = self.on_power_sample, logger = self._logger, history = history)
+
+	# Called from the power meter thread after every sample. The new power
+	# is pushed at most every POWER_NOTIFY_INTERVAL seconds.
+	def on_power_sample(self, value):
+		now = self.scheduler.now()
+		if self.power_notified is None or now - self.power_notified >= POWER_NOTIFY_INTERVAL:
+			self.power_notified = now
+			self.notifier.notify(PRIMARY_CHANNEL)
+
+	##~~ Control socket
+
+	# Start the control socket server if enabled, replacing the running one
+	def update_control_server(self):
+		if self.control_server is not None:
+			self.control_server.stop(SHUTDOWN_TIMEOUT)
+			self.control_server = None
+
+		config = self.config
+		if not config.control_socket_enabled:
+			return
+		path = config.control_socket_path or os.path.join(self.get_plugin_data_folder(), "control.sock")
+		try:
+			self.control_server = ControlSocketServer(path, self.handle_control_request, config.control_socket_mode,
+				logger = self._logger)
+		except (IOError, OSError) as e:
+			self._logger.error("Cannot create the control socket %s: %s" % (path, e))
+
+	# Handle a control socket request. The channel is the last argument,
+	# and defaults to the primary channel:
+	#   GET [<channel>]         "STATE <state> <channel>" for the channel, or
+	#                           for all the channels
+	#   SET on|off [<channel>]  set the power state, "OK <command id>"
+	#   CANCEL [<channel>]      cancel the auto-power-off countdown
+	# Subscribers get a STATE line on every power state change.
+	def handle_control_request(self, command, arguments):
+		if command == "GET":
+			with self.status_lock:
+				status = self.status
+			if arguments:
+				if arguments not in status:
+					raise ValueError("Unknown channel")
+				names = [arguments]
+			else:
+				names = [name for name in self.config.channels if name in status]
+			return ["STATE %s %s" % (status[name]["powerState"], name) for name in names] + ["OK"]
+
+		elif command == "SET":
+			parts = arguments.split(None, 1)
+			if not parts:
+				raise ValueError("Usage: SET on|off [<channel>]")
+			data = dict(newState = parts[0].lower())
+			if len(parts) > 1:
+				data["channel"] = parts[1]
+			return ["OK %d" % self.run_command("power", data)["commandId"]]
+
+		elif command == "CANCEL":
+			self.run_command("cancel_auto_off", dict(channel = arguments) if arguments else {})
+			return ["OK"]
+
+		raise ValueError("Unknown command: %s" % command)
+
+	def on_power_command_complete(self, channel, ids, new_state, error):
+		channel_state = self.channel_states.get(channel)
+		if channel_state is not None:
+			channel_state.pending_commands.difference_update(ids)
+			if error is not None:
+				channel_state.command_error_deadline = self.scheduler.now() + COMMAND_ERROR_LED_TIME
+				self.scheduler.call_later(COMMAND_ERROR_LED_TIME, self.update_led_pattern, channel)
+			self.update_led_pattern(channel)
+
+		self._plugin_manager.send_plugin_message("powerbutton", { "commandResult": dict(
+			channel = channel,
+			ids = ids,
+			success = error is None,
+			error = error,
+			powerState = str_power_state(new_state)
+		)})
+
 	##
 
-	def on_power_state(self, new_state):
-		self._logger.info("Power state changed")
-		self.notify_power_state()
+	def on_power_state(self, new_state, channel = PRIMARY_CHANNEL, old_state = None, cause = CAUSE_UNKNOWN):
+		self._logger.info("Power state of %s changed to %s (%s)" % (channel, str_power_state(new_state), str_cause(cause)))
+		self.journal.append(channel, old_state, new_state, cause)
+
+		channel_state = self.channel_states.get(channel)
+		if channel_state is not None:
+			channel_state.lock_cause = str_cause(cause) if new_state == POWER_STATE_LOCKED else None
+
+			# The countdown only runs while on: it ends when a new print locks
+			# the channel, or when it is turned off by other means. (The
+			# countdown's own timer clears it before turning off.)
+			if new_state != POWER_STATE_ON and channel_state.auto_power_off_deadline is not None:
+				with channel_state.auto_power_off_lock:
+					self.stop_auto_power_off(channel_state)
 
-		# If state has changed to "ON", and auto-connect is enabled,
-		# start a timer to do the auto-connect
-		auto_connect_enabled = self._settings.get_boolean(["auto_connect", "enabled"])
-		auto_connect_delay = self._settings.get_int(["auto_connect", "delay"])
-		if (new_state == POWER_STATE_ON and auto_connect_enabled == True and auto_connect_delay > 0):
-			# Create a timer to perform the auto-connect
-			self.auto_connect_timer = Timer(auto_connect_delay, self.on_auto_connect_timer)
-			self.auto_connect_timer.start()
+		self.notify_power_state(channel)
+		self.update_led_pattern(channel)
+		control_server = self.control_server
+		if control_server is not None:
+			control_server.publish("STATE %s %s" % (str_power_state(new_state), channel))
 
-		# If te state has changed to "OFF" and an auto-connect timer is pending,
+		channel_config = self.config.channels.get(channel)
+		if channel_state is None or channel_config is None:
+			return
+
+		# If the power has been turned on, and auto-connect is enabled, wait
+		# for the serial port to be ready and connect
+		if (new_state == POWER_STATE_ON and old_state not in (POWER_STATE_ON, POWER_STATE_LOCKED)
+				and channel_config.auto_connect_enabled):
+			self.start_auto_connect(channel_state)
+
+		# If te state has changed to "OFF" and an auto-connect is pending,
 		# cancel it
-		if (new_state == POWER_STATE_OFF and hasattr(self, "auto_connect_timer") and self.auto_connect_timer is not None):
-			self.auto_connect_timer.cancel()
+		if new_state == POWER_STATE_OFF:
+			self.stop_auto_connect(channel_state)
 
 
-	def notify_power_state(self):
-		self.state_notif_lock.acquire()
+	# Request a power state notification for a channel. Returns immediately,
+	# the message is sent from the scheduler thread.
+	def notify_power_state(self, channel = PRIMARY_CHANNEL, force = False):
+		self.update_status(channel)
+		self.notifier.notify(channel, force)
 
-		auto_off_progress = None
+	# Build the power state notification message of a channel
+	def get_power_state_message(self, channel):
+		if not hasattr(self, 'power_ctrl') or channel not in self.power_ctrl.channels:
+			return None
 
-		if (hasattr(self, 'power_ctrl')):
-			raw_power_state = self.power_ctrl.get_power_state()
-			if raw_power_state == POWER_STATE_OFF:
-				power_state = "off"
-			elif raw_power_state == POWER_STATE_LOCKED:
-				power_state = "locked"
-			elif raw_power_state == POWER_STATE_ON:
-				power_state = "on"
-			else:
-				power_state = "unknown"
+		raw_power_state = self.power_ctrl.channel(channel).get_power_state()
+		if raw_power_state == POWER_STATE_OFF:
+			power_state = "off"
+		elif raw_power_state == POWER_STATE_LOCKED:
+			power_state = "locked"
+		elif raw_power_state == POWER_STATE_ON:
+			power_state = "on"
+		else:
+			power_state = "unknown"
 
-			if self.auto_power_off > 0:
-				auto_off_progress = self.get_auto_power_off_time_percent()
+		# The auto-power-off deadline (wall time) and interval are sent once,
+		# when the countdown starts; the clients animate it by themselves
+		auto_off_deadline = None
+		auto_off_interval = None
+		channel_state = self.channel_states.get(channel)
+		if channel_state is not None and channel_state.auto_power_off_wall_deadline is not None:
+			auto_off_deadline = channel_state.auto_power_off_wall_deadline
+			auto_off_interval = channel_state.auto_power_off_interval
 
-			self._plugin_manager.send_plugin_message("powerbutton", 
-				{ "powerState": power_state, "autoOffProgress": auto_off_progress })
+		message = { "channel": channel, "powerState": power_state,
+			"autoOffDeadline": auto_off_deadline, "autoOffInterval": auto_off_interval }
 
-		self.state_notif_lock.release()
+		# The power drawn by the printer, in whole watts (see
+		# on_power_sample for how often it is pushed)
+		power_meter = self.power_meter
+		if channel == PRIMARY_CHANNEL and power_meter is not None:
+			message["power"] = int(round(power_meter.value)) if power_meter.value is not None else None
+		return message
+
+	def send_power_state_message(self, message):
+		# The server time lets the clients tell the remaining time of a
+		# deadline. It is added here, so it doesn't defeat the notifier's
+		# duplicate check.
+		message = dict(message, serverTime = self.wall_time())
+		self._plugin_manager.send_plugin_message("powerbutton", message)
 
 	##
 
 	def on_event(self, event, payload):
-		if (event == "PrintStarted"):
-			self.power_ctrl.set_power_state(POWER_STATE_LOCKED)
-		elif (event == "PrintFailed"):
-			# Get the current power state. If it's not "locked", leave
-			# it alone
-			if (self.power_ctrl.get_power_state() == POWER_STATE_LOCKED):
-				self.power_ctrl.set_power_state(POWER_STATE_ON)
-		elif (event == "PrintDone"):
-			if (self.power_ctrl.get_power_state() == POWER_STATE_LOCKED):
+		# OctoPrint calls this for every event, most of which (e.g. ZChange)
+		# have no handler and cost a single lookup
+		handlers = self.event_handlers.get(event) if hasattr(self, "event_handlers") else None
+		if handlers is None:
+			return
+		for handler in handlers:
+			handler(payload or {})
+
+	# Compile the handlers of each event: the connection events used by the
+	# auto-connect, followed by the event rules. Rebuilt when the settings
+	# are saved.
+	def update_event_handlers(self):
+		handlers = {
+			"Connected": [self.on_printer_connected],
+			"Error": [lambda payload: self.on_printer_connect_failed()],
+			"Disconnected": [lambda payload: self.on_printer_disconnected()]
+		}
+		for event, rules in self.config.event_rules.items():
+			handlers.setdefault(event, []).extend(partial(self.apply_event_rule, rule) for rule in rules)
+		self.event_handlers = handlers
+
+	# Apply the action of an event rule to its channels
+	def apply_event_rule(self, rule, payload):
+		power_states = dict((name, self.power_ctrl.channel(name).get_power_state()) for name in rule.channels
+			if name in self.power_ctrl.channels)
+
+		if rule.action == "lock":
+			new_states = dict((name, POWER_STATE_LOCKED) for name in power_states)
+		elif rule.action == "unlock":
+			new_states = dict((name, POWER_STATE_ON) for name, state in power_states.items()
+				if state == POWER_STATE_LOCKED)
+		elif rule.action == "auto_off":
+			new_states = {}
+			for name, state in power_states.items():
+				if state not in (POWER_STATE_ON, POWER_STATE_LOCKED):
+					continue
 
 				# If auto-power-off is enabled, set the countdown timer
-				auto_power_off_time = self._settings.get_int(["auto_power_off", "interval"])
-				auto_power_off_enabled = self._settings.get_boolean(["auto_power_off", "enabled"])
-				if auto_power_off_enabled and auto_power_off_time > 0:
-					# Set the auto power off countdown
-					self.auto_power_off_lock.acquire()
-					self.auto_power_off = auto_power_off_time
-					self.auto_power_off_timer = Timer(AUTO_POWER_OFF_INTERVAL, self.on_timer)
-					self.auto_power_off_timer.start()
-					self.auto_power_off_lock.release()
+				channel_config = self.config.channels.get(name)
+				channel_state = self.channel_states.get(name)
+				if (channel_config is not None and channel_state is not None and
+						channel_config.auto_power_off_enabled and channel_config.auto_power_off_interval > 0):
+					with channel_state.auto_power_off_lock:
+						self.start_auto_power_off(channel_state, channel_config.auto_power_off_interval)
+
+				# Set power state to "On" (will send a notification with
+				# auto-off/on state), or just notify the countdown
+				if state == POWER_STATE_LOCKED:
+					new_states[name] = POWER_STATE_ON
+				else:
+					self.notify_power_state(name)
+		elif rule.action == "on":
+			new_states = dict((name, POWER_STATE_ON) for name, state in power_states.items()
+				if state not in (POWER_STATE_ON, POWER_STATE_LOCKED))
+		else:
+			new_states = {}
+			for name, state in power_states.items():
+				if state != POWER_STATE_OFF:
+					self._logger.info("%s: off %s" % (rule.event, name))
+					self.power_off(name, CAUSE_EVENT)
+
+		if new_states:
+			self._logger.info("%s: %s %s" % (rule.event, rule.action, ", ".join(sorted(new_states))))
+			self.power_ctrl.set_power_states(new_states, cause = CAUSE_EVENT)
+
+	# Start the auto-power-off countdown of a channel. Must be called with
+	# the channel's auto_power_off_lock held.
+	def start_auto_power_off(self, channel_state, interval):
+		self.stop_auto_power_off(channel_state)
 
-				# Set power state to "On" (will send a notification with auto-off/on state)
-				self.power_ctrl.set_power_state(POWER_STATE_ON)
+		now = self.scheduler.now()
+		channel_state.auto_power_off_interval = interval
+		channel_state.auto_power_off_deadline = now + interval
+		channel_state.auto_power_off_wall_deadline = self.wall_time() + interval
+		channel_state.auto_power_off_task = self.scheduler.call_at(channel_state.auto_power_off_deadline,
+			self.on_timer, channel_state)
+		self.update_led_pattern(channel_state.name)
 
+	# Stop the auto-power-off countdown of a channel. Must be called with
+	# the channel's auto_power_off_lock held.
+	def stop_auto_power_off(self, channel_state):
+		if channel_state.auto_power_off_task is not None:
+			channel_state.auto_power_off_task.cancel()
+			channel_state.auto_power_off_task = None
+		channel_state.auto_power_off_deadline = None
+		channel_state.auto_power_off_wall_deadline = None
+		self.update_led_pattern(channel_state.name)
 
-	def on_timer(self):
-		self.auto_power_off_lock.acquire()
+	def on_timer(self, channel_state):
+		channel_state.auto_power_off_lock.acquire()
+		channel = self.power_ctrl.channel(channel_state.name)
 
 		# Make sure wer'e still in auto-power-off mode
-		if (self.power_ctrl.get_power_state() == POWER_STATE_ON and self.auto_power_off > 0):
-			self.auto_power_off -= AUTO_POWER_OFF_INTERVAL
-
-			if self.auto_power_off <= 0:
-				self._logger.info("Auto-power-off timer expired, turning off printer")
-				self._printer.disconnect()
-				self.auto_power_off = 0
-				self.power_ctrl.set_power_state(POWER_STATE_OFF)
+		if (channel.get_power_state() == POWER_STATE_ON and channel_state.auto_power_off_deadline is not None):
+			now = self.scheduler.now()
+			self.timer_lateness.observe(max(0, now - channel_state.auto_power_off_deadline))
+
+			if now >= channel_state.auto_power_off_deadline:
+				self._logger.info("Auto-power-off timer of %s expired, turning it off" % channel_state.name)
+				channel_state.auto_power_off_task = None
+				channel_state.auto_power_off_deadline = None
+				channel_state.auto_power_off_wall_deadline = None
+				self.power_off(channel_state.name, CAUSE_AUTO_OFF)
 			else:
-				# Re-arm the timer
-				self.auto_power_off_timer = Timer(AUTO_POWER_OFF_INTERVAL, self.on_timer)
-				self.auto_power_off_timer.start()
+				# Woken up early, re-arm the timer
+				channel_state.auto_power_off_task = self.scheduler.call_at(channel_state.auto_power_off_deadline,
+					self.on_timer, channel_state)
+
+		self.notify_power_state(channel_state.name)
+		channel_state.auto_power_off_lock.release()
 
-		self.notify_power_state()
-		self.auto_power_off_lock.release()
+	# Select the LED pattern of a channel from its state. Channels without
+	# LEDs, and all the channels when animations are disabled, show the
+	# static color of their power state.
+	def update_led_pattern(self, channel):
+		channel_state = self.channel_states.get(channel)
+		if channel_state is None or not hasattr(self, "power_ctrl") or channel not in self.power_ctrl.channels:
+			return
 
-	def get_auto_power_off_time_percent(self):
+		with self.led_pattern_lock:
+			power_channel = self.power_ctrl.channel(channel)
+			power_state = power_channel.get_power_state()
+			pattern = None
+			if self.config.led_animations and power_channel.has_leds():
+				error_deadline = channel_state.command_error_deadline
+				if error_deadline is not None and self.scheduler.now() < error_deadline:
+					pattern = "error"
+				elif channel_state.pending_commands:
+					pattern = "pending"
+				elif power_state == POWER_STATE_ON and channel_state.auto_power_off_deadline is not None:
+					pattern = "countdown"
+				elif power_state == POWER_STATE_LOCKED and self.config.led_breathe:
+					pattern = "locked"
+
+			# Keep the running animation if the pattern hasn't changed
+			if pattern == channel_state.led_pattern:
+				return
+			channel_state.led_pattern = pattern
+
+			if pattern == "error":
+				animation = BlinkPattern(LED_COLOR_RED, period = 0.2)
+			elif pattern == "pending":
+				animation = BlinkPattern(LED_COLOR_YELLOW, period = 0.4)
+			elif pattern == "countdown":
+				animation = CountdownPattern(LED_COLOR_GREEN, lambda: self.get_auto_power_off_time_percent(channel_state))
+			elif pattern == "locked":
+				animation = BreathePattern(LED_COLOR_YELLOW)
+			else:
+				animation = None
+			self.led_animator.set_pattern(channel, animation)
+
+	def update_led_patterns(self):
+		for name in list(self.channel_states.keys()):
+			self.update_led_pattern(name)
+
+	def set_led_color(self, channel, color):
+		power_ctrl = self.power_ctrl
+		if channel in power_ctrl.channels:
+			power_ctrl.set_led_color(channel, color)
+
+	def get_auto_power_off_time_percent(self, channel_state):
 		# Return the current auto-power-off timer state as percent
-		auto_power_off_time = self._settings.get_int(["auto_power_off", "interval"])
-		return self.auto_power_off*100/auto_power_off_time
+		deadline = channel_state.auto_power_off_deadline
+		if deadline is None:
+			return None
+		remaining = max(0, deadline - self.scheduler.now())
+		return remaining*100/channel_state.auto_power_off_interval
 
-	def on_auto_connect_timer(self):
-		self._logger.info("Trying auto-connect")
-		
-		# Extract settings
-		str_or_none = lambda s: None if s == "" else s
-		port = str_or_none(self._settings.get(["auto_connect", "port"]))
-		baud = str_or_none(self._settings.get(["auto_connect", "baud"]))
-		profile = str_or_none(self._settings.get(["auto_connect", "profile"]))
-
-		# Connect if not already connected
-		conn_state, _, _, _ = self._printer.get_current_connection()
-		if (conn_state == 'Closed'):
+	# Watch the serial port, and connect as soon as it is ready. The delay
+	# setting is the longest wait: the connection is then tried anyway, as
+	# the port may not be detectable (auto-detection of a port that isn't
+	# a USB device).
+	def start_auto_connect(self, channel_state):
+		self.stop_auto_connect(channel_state)
+		channel_state.auto_connect_deadline = self.scheduler.now() + self.config.auto_connect_delay
+		channel_state.auto_connect_retry_delay = AUTO_CONNECT_RETRY_INITIAL
+		channel_state.auto_connect_watch = self.create_serial_port_watch(channel_state)
+
+	# The watch of the serial port. When the port is auto-detected, the
+	# devices the printer was connected to are ready as soon as they are
+	# there. Replaced by the soak simulator, to watch a simulated device.
+	def create_serial_port_watch(self, channel_state):
+		port = self.config.auto_connect_port
+		return SerialPortWatch(port, lambda port, ready: self.on_auto_connect(channel_state, ready),
+			self.config.auto_connect_delay, logger = self._logger,
+			known_devices = self.connection_cache.devices() if port is None else ())
+
+	def stop_auto_connect(self, channel_state):
+		watch = channel_state.auto_connect_watch
+		if watch is not None:
+			watch.cancel()
+			channel_state.auto_connect_watch = None
+		if channel_state.auto_connect_task is not None:
+			channel_state.auto_connect_task.cancel()
+			channel_state.auto_connect_task = None
+		channel_state.auto_connect_deadline = None
+
+		# A connection being made is not retried
+		if self.auto_connect_channel == channel_state.name:
+			self.auto_connect_channel = None
+			self.cached_connect = None
+
+	# Called from the serial port watch thread
+	def on_auto_connect(self, channel_state, ready):
+		if ready:
+			self._logger.info("Serial port ready, trying auto-connect")
+		else:
+			self._logger.warn("Serial port not ready after %.0f seconds, trying auto-connect anyway" % self.config.auto_connect_delay)
+		self.auto_connect(channel_state)
+
+	# Connect the printer, if it isn't connected (a failed connection
+	# leaves it in the error state)
+	def auto_connect(self, channel_state):
+		config = self.config
+		port = config.auto_connect_port
+		baud = config.auto_connect_baud
+		profile = config.auto_connect_profile
+
+		if not self._printer.is_closed_or_error():
+			return
+		self.auto_connect_channel = channel_state.name
+
+		# The settings that are not set (auto-detected) are first taken from
+		# the last successful connection to the device, if any. If that
+		# connection fails, the auto-detection is used.
+		if port is None or baud is None:
+			cached = self.connection_cache.lookup(port)
+			if cached is not None:
+				identity, cached_port, cached_baud, cached_profile = cached
+				self.cached_connect = (identity, port, baud, profile)
+				self._logger.info("Connecting to %s at %s baud (cached)" % (cached_port, cached_baud))
+				self._printer.connect(port = cached_port, baudrate = baud or cached_baud, profile = profile or cached_profile)
+				return
+
+		self._printer.connect(port = port, baudrate = baud, profile = profile)
+
+	# Retry a failed auto-connect after a delay, if auto_connect.delay
+	# hasn't run out by then
+	def retry_auto_connect(self, channel_state):
+		delay = channel_state.auto_connect_retry_delay
+		deadline = channel_state.auto_connect_deadline
+		if deadline is None or self.scheduler.now() + delay > deadline:
+			self._logger.warn("Auto-connect failed, giving up")
+			return
+
+		self._logger.info("Auto-connect failed, retrying in %.0f seconds" % delay)
+		channel_state.auto_connect_retry_delay = min(delay * 2, AUTO_CONNECT_RETRY_MAX)
+		channel_state.auto_connect_task = self.scheduler.call_later(delay, self.on_auto_connect_retry, channel_state)
+
+	def on_auto_connect_retry(self, channel_state):
+		channel_state.auto_connect_task = None
+		if self.is_powered(channel_state.name):
+			self.auto_connect(channel_state)
+
+	# Return True if a channel exists and is on (or locked)
+	def is_powered(self, channel):
+		power_ctrl = self.power_ctrl
+		return (channel in power_ctrl.channels and
+			power_ctrl.channel(channel).get_power_state() in (POWER_STATE_ON, POWER_STATE_LOCKED))
+
+	# Remember the parameters of a successful connection
+	def on_printer_connected(self, payload):
+		self.auto_connect_channel = None
+		self.cached_connect = None
+		port = payload.get("port")
+		if not port:
+			return
+
+		_, _, _, printer_profile = self._printer.get_current_connection()
+		profile = printer_profile.get("id") if printer_profile else None
+		self.connection_cache.connected(port, payload.get("baudrate"), profile)
+
+	# A connection failed. If it was an auto-connect with cached parameters,
+	# count the failure and fall back to auto-detection. Other auto-connects
+	# are retried with a backoff. Neither is done if the channel has been
+	# switched off meanwhile.
+	def on_printer_connect_failed(self):
+		self.connect_failed = True
+		channel = self.auto_connect_channel
+		pending = self.cached_connect
+		self.auto_connect_channel = None
+		self.cached_connect = None
+
+		channel_state = self.channel_states.get(channel)
+		if channel_state is None or not self.is_powered(channel):
+			return
+
+		if pending is not None:
+			identity, port, baud, profile = pending
+			self._logger.info("Connection with the cached parameters of %s failed, auto-detecting" % identity)
+			self.connection_cache.failed(identity)
+			self.auto_connect_channel = channel
 			self._printer.connect(port = port, baudrate = baud, profile = profile)
+		else:
+			self.retry_auto_connect(channel_state)
+
+	# The connection was closed. A failed connection reports an Error first,
+	# and its close doesn't stop the retry. A connection being made that is
+	# closed otherwise (e.g. disconnected by the user) is not retried, nor
+	# counted as a failure.
+	def on_printer_disconnected(self):
+		if self.connect_failed:
+			self.connect_failed = False
+			return
+		self.auto_connect_channel = None
+		self.cached_connect = None
 
 # If you want your plugin to be registered within OctoPrint under a different name than what you defined in setup.py
 # ("OctoPrint-PluginSkeleton"), you may define that here. Same goes for the other metadata derived from setup.py that
@@ -0,0 +1,122 @@
+import itertools
+from threading import Thread, Condition
+from octoprint_powerbutton.metrics import MetricsRegistry
+from octoprint_powerbutton.scheduler import monotonic
+
+# Applies power state commands on a dedicated worker thread, so the caller
+# (typically an HTTP worker) does not wait for the hardware. There is a
+# single pending slot per channel: a command submitted while another one
+# for the same channel is still waiting replaces it, so a burst of on/off/on
+# requests results in only the final state being applied (with the cause of
+# the final command). The pending commands of all the channels are applied
+# together. Every submitted command is completed, with the result of the
+# command that was actually applied.
+class PowerCommandQueue:
+
+    def __init__(self, apply, on_complete, logger = None, name = "powerbutton-commands", metrics = None):
+        # apply(states, causes) performs the commands, given as dicts of
+        # channel name to new state and to the cause of the command, and may
+        # return a dict of channel name to error message for the channels it
+        # refused. on_complete(channel, ids, new_state, error) is called
+        # after it for each channel, with the ids of all the commands that
+        # were merged, and an error message (or None).
+        self.apply = apply
+        self.on_complete = on_complete
+        self.logger = logger
+
+        metrics = metrics or MetricsRegistry()
+        self.submitted = metrics.counter("powerbutton_commands_total",
+            "Number of power commands submitted")
+        self.coalesced = metrics.counter("powerbutton_commands_coalesced_total",
+            "Number of power commands replaced by a later command before being applied")
+        self.relay_latency = metrics.histogram("powerbutton_command_to_relay_seconds",
+            "Time from a power command being submitted to the relay being written")
+        self.complete_latency = metrics.histogram("powerbutton_command_to_notification_seconds",
+            "Time from a power command being submitted to its completion being pushed")
+
+        self.cond = Condition()
+        self.ids = itertools.count(1)
+        self.pending = {}   # channel -> (new state, [ids], [submit times], cause)
+        self.busy = False
+
+        self.running = True
+        self.thread = Thread(target = self.__thread, name = name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Queue a command. Returns its id. on_submit(id), if given, is called
+    # before the worker can see the command (so before it completes).
+    def submit(self, channel, new_state, cause = None, on_submit = None):
+        with self.cond:
+            command_id = next(self.ids)
+            if on_submit is not None:
+                on_submit(command_id)
+            _, ids, times, _ = self.pending.get(channel, (None, [], [], None))
+            self.pending[channel] = (new_state, ids + [command_id], times + [monotonic()], cause)
+            self.cond.notify()
+
+        self.submitted.inc()
+        if ids:
+            self.coalesced.inc()
+        return command_id
+
+    # Wait until all the submitted commands have been applied, for at most
+    # timeout seconds. Returns True if the queue is idle.
+    def wait_idle(self, timeout = None):
+        with self.cond:
+            if timeout is None:
+                while self.pending or self.busy:
+                    self.cond.wait()
+            elif self.pending or self.busy:
+                self.cond.wait(timeout)
+            return not (self.pending or self.busy)
+
+    # Stop the worker thread. Commands that are still pending are dropped.
+    def stop(self, timeout = None):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def __thread(self):
+        while True:
+            with self.cond:
+                while self.running and not self.pending:
+                    self.cond.wait()
+                if not self.running:
+                    return
+
+                pending = self.pending
+                self.pending = {}
+                self.busy = True
+
+            error = None
+            errors = {}
+            try:
+                errors = self.apply(dict((channel, state) for channel, (state, _, _, _) in pending.items()),
+                    dict((channel, cause) for channel, (_, _, _, cause) in pending.items())) or {}
+            except Exception as e:
+                if self.logger:
+                    self.logger.exception("Failed applying power command")
+                error = str(e) or e.__class__.__name__
+
+            applied = monotonic()
+            for channel, (_, _, times, _) in pending.items():
+                for t in times:
+                    self.relay_latency.observe(applied - t)
+
+            for channel, (new_state, ids, times, _) in pending.items():
+                try:
+                    self.on_complete(channel, ids, new_state, errors.get(channel, error))
+                except Exception:
+                    if self.logger:
+                        self.logger.exception("Exception in power command completion")
+
+                completed = monotonic()
+                for t in times:
+                    self.complete_latency.observe(completed - t)
+
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
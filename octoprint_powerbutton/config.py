@@ -0,0 +1,283 @@
+from collections import namedtuple, OrderedDict
+from octoprint_powerbutton.power_hub import PRIMARY_CHANNEL, BUTTON_ACTIONS
+from octoprint_powerbutton.gestures import GESTURES, DEFAULT_TIMING
+from octoprint_powerbutton.power_meter import SENSORS, SAMPLE_INTERVAL
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+POWER_CTRL_MODULES = ("raspi_power", "gpiochip", "stub")
+
+# An immutable snapshot of the plugin settings. A new snapshot is built
+# whenever the settings are saved, and replaces the previous one as a
+# whole, so readers never see a partially updated configuration.
+PluginConfig = namedtuple("PluginConfig", [
+    "power_ctrl_module",
+    "raspi_power",              # Pin settings (dict), as passed to the controller
+    "gpiochip",                 # GPIO character device path
+    "auto_power_off_enabled",
+    "auto_power_off_interval",  # Seconds
+    "auto_connect_enabled",
+    "auto_connect_port",        # None for auto-detection
+    "auto_connect_baud",        # None for auto-detection
+    "auto_connect_profile",     # None for the default profile
+    "auto_connect_delay",       # Longest wait for the port to be ready, in seconds
+    "button",                   # Gesture timing (ms) and "actions", as passed to the controller
+    "led_animations",           # Animate the LEDs (countdown, pending command, etc.)
+    "led_breathe",              # Breathe the LED while locked (software PWM)
+    "unexport_on_shutdown",     # Unexport the sysfs GPIO pins when OctoPrint shuts down
+    "event_rules",              # dict of event name to a tuple of the EventRules it triggers
+    "control_socket_enabled",
+    "control_socket_path",      # None for the default (in the plugin data folder)
+    "control_socket_mode",      # File mode (int) of the socket
+    "power_meter_enabled",
+    "power_meter_sensor",       # One of power_meter.SENSORS
+    "power_meter_path",         # The file the sensor reads
+    "power_meter_scale",        # Factor from the sensor's unit to watts
+    "power_meter_interval",     # Sampling interval, in seconds
+    "channels"                  # OrderedDict of channel name to ChannelConfig
+])
+
+# The configuration of a single power channel. The primary channel is
+# configured by the top-level settings, other channels by the "channels"
+# settings list.
+ChannelConfig = namedtuple("ChannelConfig", [
+    "name",
+    "pins",                     # Pin settings (dict), as passed to the controller
+    "follow_print",             # Lock while printing, and auto-power-off after
+    "auto_power_off_enabled",
+    "auto_power_off_interval",  # Seconds
+    "auto_connect_enabled"      # Connect the printer when switched on
+])
+
+# An action taken on a number of channels when an OctoPrint event fires
+EventRule = namedtuple("EventRule", [
+    "event",
+    "action",                   # One of EVENT_ACTIONS
+    "channels"                  # Tuple of channel names
+])
+
+# The actions of the event rules:
+# - lock: lock the channels (they can't be switched off)
+# - unlock: switch locked channels back to on
+# - auto_off: switch locked channels back to on, and start the
+#   auto-power-off countdown of the channels that are on
+# - on, off: switch the channels on or off (off even if locked)
+EVENT_ACTIONS = ("lock", "unlock", "auto_off", "on", "off")
+
+RASPI_POWER_PINS = ("gpio_relay", "gpio_button", "gpio_red", "gpio_green")
+RASPI_POWER_FLAGS = ("led_polarity", "button_polarity", "relay_polarity", "keep_relay_state")
+
+# Parse and validate the pin settings of a channel
+def _load_pins(raw_pins, prefix):
+    pins = {}
+    for name in RASPI_POWER_PINS:
+        pin = _int_or_none(raw_pins.get(name), prefix + name)
+        if pin is not None and pin < 0:
+            raise ValueError("%s%s must be a non-negative number" % (prefix, name))
+        pins[name] = pin
+    for name in RASPI_POWER_FLAGS:
+        if name in raw_pins:
+            pins[name] = _bool(raw_pins[name])
+    return pins
+
+def _load_channel(raw, index):
+    name = raw.get("name")
+    if not name or not isinstance(name, string_types):
+        raise ValueError("channels[%d].name must be set" % index)
+
+    auto_power_off = raw.get("auto_power_off") or {}
+    return ChannelConfig(
+        name = name,
+        pins = _load_pins(raw, "channels[%d]." % index),
+        follow_print = _bool(raw.get("follow_print", False)),
+        auto_power_off_enabled = _bool(auto_power_off.get("enabled", False)),
+        auto_power_off_interval = _seconds(auto_power_off.get("interval", 0), "channels[%d].auto_power_off.interval" % index),
+        auto_connect_enabled = False
+    )
+
+# Parse and validate the button settings: the gesture timing, and the
+# action of each gesture
+def _load_button(raw):
+    button = {}
+    for name in DEFAULT_TIMING:
+        value = _int_or_none(raw.get(name), "button." + name)
+        if value is not None and value < 0:
+            raise ValueError("button.%s must be a non-negative number" % name)
+        button[name] = DEFAULT_TIMING[name] if value is None else value
+
+    actions = {}
+    for gesture, action in (raw.get("actions") or {}).items():
+        if gesture not in GESTURES:
+            raise ValueError("Unknown button gesture: %s" % gesture)
+        if action not in BUTTON_ACTIONS:
+            raise ValueError("Unknown action of button gesture %s: %s" % (gesture, action))
+        actions[gesture] = action
+    button["actions"] = actions
+    return button
+
+# Parse and validate the event rules, and compile them into a dict keyed by
+# event name. A rule without channels applies to the channels that follow
+# the print.
+def _load_rules(raw_rules, channels):
+    follow_print = tuple(channel.name for channel in channels.values() if channel.follow_print)
+    rules = {}
+    for index, raw in enumerate(raw_rules):
+        event = raw.get("event")
+        if not event or not isinstance(event, string_types):
+            raise ValueError("event_rules[%d].event must be set" % index)
+        action = raw.get("action")
+        if action not in EVENT_ACTIONS:
+            raise ValueError("Unknown action of event_rules[%d]: %s" % (index, action))
+
+        names = raw.get("channels")
+        if names is None:
+            names = follow_print
+        elif isinstance(names, string_types):
+            names = (names,)
+        for name in names:
+            if name not in channels:
+                raise ValueError("Unknown channel of event_rules[%d]: %s" % (index, name))
+
+        rules.setdefault(event, []).append(EventRule(event, action, tuple(names)))
+    return dict((event, tuple(event_rules)) for event, event_rules in rules.items())
+
+# A file mode, as an octal string (e.g. "660")
+def _file_mode(v, name):
+    try:
+        mode = int(str(v), 8)
+    except ValueError:
+        mode = -1
+    if not 0 <= mode <= 0o777:
+        raise ValueError("%s must be an octal file mode" % name)
+    return mode
+
+def _str_or_none(s):
+    return None if s is None or s == "" else s
+
+def _int_or_none(v, name):
+    if v is None or v == "":
+        return None
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        raise ValueError("%s must be a number" % name)
+
+def _bool(v):
+    if isinstance(v, string_types):
+        return v.lower() in ("true", "yes", "y", "1", "on")
+    return bool(v)
+
+def _seconds(v, name):
+    try:
+        v = float(v)
+    except (TypeError, ValueError):
+        v = -1
+    if v < 0:
+        raise ValueError("%s must be a non-negative number of seconds" % name)
+    return v
+
+# Parse and validate the power meter settings. Returns (enabled, sensor,
+# path, scale, interval).
+def _load_power_meter(raw):
+    enabled = _bool(raw.get("enabled", False))
+    sensor = raw.get("sensor") or "file"
+    if sensor not in SENSORS:
+        raise ValueError("Unknown power_meter.sensor: %s" % sensor)
+    path = _str_or_none(raw.get("path"))
+    if enabled and path is None:
+        raise ValueError("power_meter.path must be set")
+    try:
+        scale = float(raw.get("scale", 1.0))
+    except (TypeError, ValueError):
+        raise ValueError("power_meter.scale must be a number")
+    interval = _seconds(raw.get("interval", SAMPLE_INTERVAL), "power_meter.interval")
+    if interval == 0:
+        raise ValueError("power_meter.interval must be positive")
+    return enabled, sensor, path, scale, interval
+
+# Build a configuration snapshot from the plugin settings. Raises ValueError
+# if the settings are invalid.
+def load_config(settings):
+    module = settings.get(["power_ctrl_module"])
+    if module not in POWER_CTRL_MODULES:
+        raise ValueError("Unsupported power control module: %s" % module)
+
+    raw_raspi_power = settings.get(["raspi_power"]) or {}
+    raspi_power = _load_pins(raw_raspi_power, "raspi_power.")
+    sysfs_gpio = _str_or_none(raw_raspi_power.get("sysfs_gpio"))
+    if sysfs_gpio is not None:
+        raspi_power["sysfs_gpio"] = sysfs_gpio
+    auto_power_off_enabled = _bool(settings.get(["auto_power_off", "enabled"]))
+    auto_power_off_interval = _seconds(settings.get(["auto_power_off", "interval"]), "auto_power_off.interval")
+    auto_connect_enabled = _bool(settings.get(["auto_connect", "enabled"]))
+    power_meter = _load_power_meter(settings.get(["power_meter"]) or {})
+
+    # The primary channel, followed by the additional channels
+    channels = OrderedDict()
+    channels[PRIMARY_CHANNEL] = ChannelConfig(
+        name = PRIMARY_CHANNEL,
+        pins = raspi_power,
+        follow_print = True,
+        auto_power_off_enabled = auto_power_off_enabled,
+        auto_power_off_interval = auto_power_off_interval,
+        auto_connect_enabled = auto_connect_enabled
+    )
+    for index, raw in enumerate(settings.get(["channels"]) or []):
+        channel = _load_channel(raw, index)
+        if channel.name in channels:
+            raise ValueError("Duplicate channel name: %s" % channel.name)
+        channels[channel.name] = channel
+
+    return PluginConfig(
+        power_ctrl_module = module,
+        raspi_power = raspi_power,
+        gpiochip = settings.get(["gpiochip", "chip"]),
+        auto_power_off_enabled = auto_power_off_enabled,
+        auto_power_off_interval = auto_power_off_interval,
+        auto_connect_enabled = auto_connect_enabled,
+        auto_connect_port = _str_or_none(settings.get(["auto_connect", "port"])),
+        auto_connect_baud = _int_or_none(settings.get(["auto_connect", "baud"]), "auto_connect.baud"),
+        auto_connect_profile = _str_or_none(settings.get(["auto_connect", "profile"])),
+        auto_connect_delay = _seconds(settings.get(["auto_connect", "delay"]), "auto_connect.delay"),
+        button = _load_button(settings.get(["button"]) or {}),
+        led_animations = _bool(settings.get(["led_animations"])),
+        led_breathe = _bool(settings.get(["led_breathe"])),
+        unexport_on_shutdown = _bool(raw_raspi_power.get("unexport_on_shutdown", False)),
+        event_rules = _load_rules(settings.get(["event_rules"]) or [], channels),
+        control_socket_enabled = _bool(settings.get(["control_socket", "enabled"])),
+        control_socket_path = _str_or_none(settings.get(["control_socket", "path"])),
+        control_socket_mode = _file_mode(settings.get(["control_socket", "mode"]), "control_socket.mode"),
+        power_meter_enabled = power_meter[0],
+        power_meter_sensor = power_meter[1],
+        power_meter_path = power_meter[2],
+        power_meter_scale = power_meter[3],
+        power_meter_interval = power_meter[4],
+        channels = channels
+    )
+
+# The pin settings of the additional (non-primary) channels, as passed to
+# the power controller
+def extra_channel_pins(config):
+    return [dict(channel.pins, name = channel.name) for channel in config.channels.values()
+        if channel.name != PRIMARY_CHANNEL]
+
+# The part of the configuration that requires rebuilding the power
+# controller when changed. (The button settings are applied to the running
+# controller.)
+def controller_key(config):
+    return (config.power_ctrl_module, config.gpiochip,
+        [(channel.name, sorted(channel.pins.items())) for channel in config.channels.values()])
+
+# The part of the configuration that requires restarting the control
+# socket server when changed
+def control_socket_key(config):
+    return (config.control_socket_enabled, config.control_socket_path, config.control_socket_mode)
+
+# The part of the configuration that requires restarting the power meter
+# when changed
+def power_meter_key(config):
+    return (config.power_meter_enabled, config.power_meter_sensor, config.power_meter_path,
+        config.power_meter_scale, config.power_meter_interval)
@@ -0,0 +1,115 @@
+import json
+import os
+import time
+from threading import Lock
+from octoprint_powerbutton.serial_watch import SERIAL_BY_ID
+
+# Consecutive failed connections after which an entry is dropped
+MAX_FAILURES = 3
+
+# Maximal number of devices remembered
+MAX_ENTRIES = 16
+
+# The stable identity of the serial device behind a port: its name in the
+# by-id directory (e.g. "usb-Prusa_Original_Prusa_i3_MK3_CZPX1234-if00"),
+# which does not depend on the order the devices were enumerated in. A
+# port without a by-id link (e.g. a UART) is identified by its path.
+def device_identity(port, by_id_dir = SERIAL_BY_ID):
+    device = os.path.realpath(port)
+    try:
+        names = sorted(os.listdir(by_id_dir))
+    except OSError:
+        names = []
+    for name in names:
+        if os.path.realpath(os.path.join(by_id_dir, name)) == device:
+            return name
+    return port
+
+# Remembers the connection parameters (port, baud rate, printer profile)
+# of the successful printer connections, by device identity, so the next
+# connection to the same device can skip OctoPrint's port and baud rate
+# auto-detection. Kept in a JSON file.
+class ConnectionCache:
+
+    def __init__(self, path, by_id_dir = SERIAL_BY_ID, max_failures = MAX_FAILURES, logger = None):
+        self.path = path
+        self.by_id_dir = by_id_dir
+        self.max_failures = max_failures
+        self.logger = logger
+        self.lock = Lock()
+
+        self.entries = {}
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+            if isinstance(entries, dict):
+                self.entries = entries
+        except (IOError, OSError, ValueError):
+            pass
+
+    # Record a successful connection
+    def connected(self, port, baudrate, profile):
+        identity = device_identity(port, self.by_id_dir)
+        with self.lock:
+            self.entries[identity] = dict(port = port, baudrate = baudrate, profile = profile,
+                failures = 0, lastSuccess = time.time())
+
+            # Forget the devices not seen for the longest time
+            while len(self.entries) > MAX_ENTRIES:
+                del self.entries[min(self.entries, key = lambda k: self.entries[k]["lastSuccess"])]
+            self.__save()
+
+    # Record a failed connection with the parameters of an entry. The entry
+    # is dropped after max_failures consecutive failures.
+    def failed(self, identity):
+        with self.lock:
+            entry = self.entries.get(identity)
+            if entry is None:
+                return
+            entry["failures"] += 1
+            if entry["failures"] >= self.max_failures:
+                if self.logger:
+                    self.logger.info("Forgetting the connection parameters of %s after %d failures" % (identity, entry["failures"]))
+                del self.entries[identity]
+            self.__save()
+
+    # Find the connection parameters to try. With a port, returns those of
+    # its device; without, those of the most recently connected device that
+    # is present. Returns (identity, port, baudrate, profile), or None.
+    def lookup(self, port = None):
+        with self.lock:
+            if port is not None:
+                identity = device_identity(port, self.by_id_dir)
+                entry = self.entries.get(identity)
+                if entry is None:
+                    return None
+                return identity, port, entry["baudrate"], entry["profile"]
+
+            for identity, entry in sorted(self.entries.items(), key = lambda e: -e[1]["lastSuccess"]):
+                device = self.__present(identity)
+                if device is not None:
+                    return identity, device, entry["baudrate"], entry["profile"]
+            return None
+
+    # The identities of the devices with a by-id name
+    def devices(self):
+        with self.lock:
+            return set(identity for identity in self.entries if not os.path.isabs(identity))
+
+    # The port of a device, if it is present
+    def __present(self, identity):
+        if os.path.isabs(identity):
+            return identity if os.path.exists(identity) else None
+        path = os.path.join(self.by_id_dir, identity)
+        return os.path.realpath(path) if os.path.exists(path) else None
+
+    # Write the entries to the file. Must be called with the lock held.
+    def __save(self):
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(self.entries, f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            if self.logger:
+                self.logger.warn("Cannot save the connection cache: %s" % e)
@@ -0,0 +1,240 @@
+import errno
+import fcntl
+import os
+import select
+import socket
+import stat
+from threading import Thread, Lock
+
+# Longest request line, in bytes. A client sending a longer one is dropped.
+MAX_LINE = 1024
+
+# Most output queued for a client, in bytes. A subscriber that stops
+# reading is dropped when it is reached.
+MAX_OUTPUT = 64 * 1024
+
+class _Client:
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.input = b""
+        self.output = b""
+        self.subscribed = False
+        self.closed = False
+
+# Serves local clients (scripts, cron jobs, UPS hooks) on a Unix domain
+# socket, without going through the web server. Who may connect is set by
+# the socket's file mode. The protocol is line based: each request is a
+# line, "<COMMAND> [<arguments>]", answered with any number of lines and
+# then "OK [<result>]" or "ERR <message>". Besides the commands run by
+# handler(command, arguments), which returns the response lines (raising
+# ValueError for an invalid request), the server implements:
+#   SUB     push the lines published from now on to this client
+#   UNSUB   stop pushing
+# All the clients are served by one thread, which never blocks on a
+# client: the output is queued and written when the socket is writable.
+class ControlSocketServer:
+
+    def __init__(self, path, handler, mode = 0o660, logger = None):
+        self.path = path
+        self.handler = handler
+        self.logger = logger
+
+        # Remove the socket left by a previous run, but nothing else
+        try:
+            if stat.S_ISSOCK(os.lstat(path).st_mode):
+                os.unlink(path)
+        except OSError:
+            pass
+
+        # Set the mode before listening, so no client can connect to a socket
+        # with the wrong permissions
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.bind(path)
+            os.chmod(path, mode)
+            self.inode = os.lstat(path).st_ino
+            self.sock.listen(8)
+        except Exception:
+            self.sock.close()
+            raise
+        self.sock.setblocking(False)
+
+        self.lock = Lock()
+        self.clients = {}   # fd -> _Client
+        self.running = True
+
+        # Wakes the thread up when output is queued, or when stopped
+        self.wake_r, self.wake_w = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            _set_nonblocking(fd)
+
+        self.thread = Thread(target = self.__thread, name = "powerbutton-control")
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Push a line to all the subscribed clients
+    def publish(self, line):
+        data = (line + "\n").encode("utf-8")
+        with self.lock:
+            subscribers = [client for client in self.clients.values() if client.subscribed]
+            for client in subscribers:
+                client.output += data
+            if subscribers:
+                self.__wake()
+
+    # Stop the server, waiting for its thread for at most timeout seconds.
+    # Returns True if the thread has exited.
+    def stop(self, timeout = None):
+        with self.lock:
+            if self.running:
+                self.running = False
+                self.__wake()
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    # Must be called with the lock held
+    def __wake(self):
+        if self.wake_w is None:
+            return
+        try:
+            os.write(self.wake_w, b"x")
+        except OSError as e:
+            # The pipe is full, the thread is woken up anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def __accept(self):
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except (socket.error, OSError) as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+            sock.setblocking(False)
+            client = _Client(sock)
+            with self.lock:
+                self.clients[client.fd] = client
+
+    def __drop(self, client):
+        with self.lock:
+            self.clients.pop(client.fd, None)
+            client.closed = True
+        client.sock.close()
+
+    def __read(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except (socket.error, OSError) as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = b""
+        if not data:
+            self.__drop(client)
+            return
+
+        client.input += data
+        while b"\n" in client.input:
+            line, client.input = client.input.split(b"\n", 1)
+            response = self.__handle(client, line.decode("utf-8", "replace").strip())
+            if response:
+                with self.lock:
+                    client.output += ("\n".join(response) + "\n").encode("utf-8")
+        if len(client.input) > MAX_LINE:
+            self.__drop(client)
+        elif client.output:
+            # Answer right away, without waiting for the next select
+            self.__write(client)
+
+    def __handle(self, client, line):
+        if not line:
+            return None
+        parts = line.split(None, 1)
+        command = parts[0].upper()
+        arguments = parts[1] if len(parts) > 1 else ""
+
+        if command in ("SUB", "UNSUB"):
+            with self.lock:
+                client.subscribed = command == "SUB"
+            return ["OK"]
+
+        try:
+            return self.handler(command, arguments)
+        except ValueError as e:
+            return ["ERR %s" % e]
+        except Exception:
+            if self.logger:
+                self.logger.exception("Control socket request failed: %s" % line)
+            return ["ERR Internal error"]
+
+    def __write(self, client):
+        with self.lock:
+            output = client.output
+        try:
+            sent = client.sock.send(output)
+        except (socket.error, OSError) as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self.__drop(client)
+            return
+        with self.lock:
+            client.output = client.output[sent:]
+
+    def __thread(self):
+        try:
+            while self.running:
+                with self.lock:
+                    stalled = [client for client in self.clients.values() if len(client.output) > MAX_OUTPUT]
+                for client in stalled:
+                    if self.logger:
+                        self.logger.warn("Dropping a control socket client that doesn't read")
+                    self.__drop(client)
+
+                with self.lock:
+                    clients = list(self.clients.values())
+                    writers = [client.sock for client in clients if client.output]
+
+                try:
+                    readable, writable, _ = select.select([self.sock, self.wake_r] + [client.sock for client in clients],
+                        writers, [])
+                except (select.error, OSError) as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if self.wake_r in readable:
+                    os.read(self.wake_r, 4096)
+                if self.sock in readable:
+                    self.__accept()
+
+                by_sock = dict((client.sock, client) for client in clients)
+                for sock in writable:
+                    self.__write(by_sock[sock])
+                for sock in readable:
+                    client = by_sock.get(sock)
+                    if client is not None and not client.closed:
+                        self.__read(client)
+        except Exception:
+            if self.logger:
+                self.logger.exception("Control socket server failed")
+        finally:
+            with self.lock:
+                self.running = False
+                for client in self.clients.values():
+                    client.sock.close()
+                self.clients = {}
+                os.close(self.wake_r)
+                os.close(self.wake_w)
+                self.wake_r = self.wake_w = None
+
+            # Remove the socket, unless it has been replaced meanwhile
+            try:
+                if os.lstat(self.path).st_ino == self.inode:
+                    os.unlink(self.path)
+            except OSError:
+                pass
+            self.sock.close()
+
+def _set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
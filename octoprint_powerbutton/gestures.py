@@ -0,0 +1,143 @@
+from octoprint_powerbutton.scheduler import monotonic
+
+GESTURE_SHORT = "short"
+GESTURE_DOUBLE = "double"
+GESTURE_LONG = "long"
+GESTURE_HOLD_REPEAT = "hold_repeat"
+
+GESTURES = (GESTURE_SHORT, GESTURE_DOUBLE, GESTURE_LONG, GESTURE_HOLD_REPEAT)
+
+# Default gesture timing, in milliseconds. A zero double_press_ms or
+# repeat_ms disables the double press or the hold-repeat gesture.
+DEFAULT_TIMING = dict(
+    debounce_ms = 50,       # Shorter presses and releases are contact bounce
+    short_max_ms = 750,     # Longest press that is a short press
+    long_ms = 2500,         # Holding the button this long is a long press
+    double_press_ms = 0,    # Maximal gap between the presses of a double press
+    repeat_ms = 0           # Interval of the hold-repeat gesture, after a long press
+)
+
+_IDLE = 0
+_PRESSED = 1
+_RELEASED = 2       # Released, but not for longer than the debounce time yet
+_WAIT_DOUBLE = 3    # A short press was made, waiting for a second one
+
+# Recognizes button gestures from timestamped press and release edges. The
+# edges can come from any input source (edge events or polling); timing is
+# based on the edge timestamps only, so the classification does not depend
+# on how often the input is read. Time based gestures (long press, repeat,
+# the end of a double press window) are detected by poll(), which returns
+# when it has to be called next.
+#
+# The recognizer is not thread safe: the edges and polls of a button must
+# all come from the same thread.
+class GestureRecognizer:
+
+    def __init__(self, on_gesture, timing = None, clock = monotonic):
+        # on_gesture(gesture, detected) is called with one of the GESTURE_*
+        # constants and the time the gesture was detected
+        self.on_gesture = on_gesture
+        self.clock = clock
+        self.set_timing(timing)
+
+        self.state = _IDLE
+        self.press_time = None
+        self.release_time = None
+        self.long_reported = False
+        self.next_repeat = None
+        self.second_press = False   # The current press is the second of a double press
+
+    # Change the gesture timing. Takes effect from the next edge or poll.
+    def set_timing(self, timing):
+        timing = dict(DEFAULT_TIMING, **(timing or {}))
+        self.debounce = timing["debounce_ms"] / 1000.0
+        self.short_max = timing["short_max_ms"] / 1000.0
+        self.long = timing["long_ms"] / 1000.0
+        self.double_gap = timing["double_press_ms"] / 1000.0
+        self.repeat = timing["repeat_ms"] / 1000.0
+
+    # Report an edge. pressed is the new (logical) button state, t the time
+    # of the edge (defaults to now).
+    def edge(self, pressed, t = None):
+        if t is None:
+            t = self.clock()
+
+        # Complete a release that is past its debounce time first
+        self.poll(t)
+
+        if pressed:
+            if self.state == _IDLE:
+                self.__press(t, False)
+            elif self.state == _RELEASED:
+                # A bounce: the button is still held
+                self.state = _PRESSED
+            elif self.state == _WAIT_DOUBLE:
+                self.__press(t, True)
+        elif self.state == _PRESSED:
+            self.state = _RELEASED
+            self.release_time = t
+
+    # Detect the time based gestures. Returns the time (in seconds) until
+    # poll should be called again, or None if there's nothing to wait for.
+    def poll(self, now = None):
+        if now is None:
+            now = self.clock()
+
+        if self.state == _RELEASED and now >= self.release_time + self.debounce:
+            self.__release(self.release_time)
+
+        if self.state == _WAIT_DOUBLE and now >= self.release_time + self.double_gap:
+            self.state = _IDLE
+            self.on_gesture(GESTURE_SHORT, self.release_time + self.double_gap)
+
+        if self.state == _PRESSED:
+            if not self.long_reported:
+                if now >= self.press_time + self.long:
+                    self.long_reported = True
+                    self.second_press = False
+                    if self.repeat > 0:
+                        self.next_repeat = self.press_time + self.long + self.repeat
+                    self.on_gesture(GESTURE_LONG, self.press_time + self.long)
+            while self.next_repeat is not None and now >= self.next_repeat:
+                detected = self.next_repeat
+                self.next_repeat += self.repeat
+                self.on_gesture(GESTURE_HOLD_REPEAT, detected)
+
+        return self.__next_deadline(now)
+
+    def __press(self, t, second):
+        self.state = _PRESSED
+        self.press_time = t
+        self.long_reported = False
+        self.next_repeat = None
+        self.second_press = second
+
+    def __release(self, t):
+        self.state = _IDLE
+        self.next_repeat = None
+        duration = t - self.press_time
+        if self.long_reported or duration < self.debounce or duration > self.short_max:
+            return
+
+        if self.second_press:
+            self.on_gesture(GESTURE_DOUBLE, t)
+        elif self.double_gap > 0:
+            # Could be the first press of a double press
+            self.state = _WAIT_DOUBLE
+            self.release_time = t
+        else:
+            self.on_gesture(GESTURE_SHORT, t)
+
+    def __next_deadline(self, now):
+        deadlines = []
+        if self.state == _RELEASED:
+            deadlines.append(self.release_time + self.debounce)
+        elif self.state == _WAIT_DOUBLE:
+            deadlines.append(self.release_time + self.double_gap)
+        elif self.state == _PRESSED:
+            if not self.long_reported:
+                deadlines.append(self.press_time + self.long)
+            elif self.next_repeat is not None:
+                deadlines.append(self.next_repeat)
+
+        return max(0, min(deadlines) - now) if deadlines else None
@@ -0,0 +1,96 @@
+import os
+from threading import Lock
+
+# An in-memory replacement for gpiochip_power.GpioChip, for running the
+# gpiochip power controller on machines without GPIO hardware. Event file
+# descriptors are real pipes, so the controller can poll() them.
+class FakeGpioChip:
+
+    def __init__(self, num_lines = 64):
+        self.lock = Lock()
+        self.values = [False] * num_lines
+
+        # The lines configured as outputs. They stay so when released.
+        self.outputs = set()
+        self.handles = {}
+        self.events = {}
+
+        # Number of set-values calls, and the values of each call
+        self.set_count = 0
+        self.history = []
+
+    def close(self):
+        for fd in list(self.handles.keys()) + list(self.events.keys()):
+            self.release(fd)
+
+    def request_outputs(self, offsets, defaults, label):
+        for offset in offsets:
+            assert(self.__is_free(offset))
+
+        # Use a real (unused) file descriptor as the handle
+        r, w = os.pipe()
+        os.close(w)
+        with self.lock:
+            self.handles[r] = list(offsets)
+            for offset, v in zip(offsets, defaults):
+                self.values[offset] = bool(v)
+                self.outputs.add(offset)
+        return r
+
+    def get_output_level(self, offset):
+        assert(self.__is_free(offset))
+        with self.lock:
+            return self.values[offset] if offset in self.outputs else None
+
+    def set_values(self, handle_fd, values):
+        offsets = self.handles[handle_fd]
+        assert(len(values) == len(offsets))
+        with self.lock:
+            for offset, v in zip(offsets, values):
+                self.values[offset] = bool(v)
+            self.set_count += 1
+            self.history.append(list(values))
+
+    def request_events(self, offset, label):
+        assert(self.__is_free(offset))
+        r, w = os.pipe()
+        with self.lock:
+            self.events[r] = (offset, w)
+        return r
+
+    def get_value(self, event_fd):
+        offset, _ = self.events[event_fd]
+        return self.values[offset]
+
+    def read_event(self, event_fd):
+        return os.read(event_fd, 1) == b'1'
+
+    def release(self, fd):
+        with self.lock:
+            if fd in self.handles:
+                del self.handles[fd]
+            elif fd in self.events:
+                _, w = self.events.pop(fd)
+                os.close(w)
+        os.close(fd)
+
+    # Get the level of a line
+    def get_line(self, offset):
+        return self.values[offset]
+
+    # Drive an input line to a level, generating an event if it has
+    # changed
+    def set_line(self, offset, value):
+        value = bool(value)
+        with self.lock:
+            if self.values[offset] == value:
+                return
+            self.values[offset] = value
+            for event_offset, w in self.events.values():
+                if event_offset == offset:
+                    os.write(w, b'1' if value else b'0')
+
+    def __is_free(self, offset):
+        with self.lock:
+            return (all(offset not in offsets for offsets in self.handles.values()) and
+                all(offset != o for o, _ in self.events.values()))
@@ -0,0 +1,310 @@
+import os
+import select
+import ctypes
+import fcntl
+from threading import Thread
+import time
+from octoprint_powerbutton.power_states import *
+from octoprint_powerbutton.scheduler import monotonic
+from octoprint_powerbutton.power_hub import PowerHub, prop_or_default
+from octoprint_powerbutton.raspi_power import SHUTDOWN_TIMEOUT
+
+# Power controller based on the GPIO character device (/dev/gpiochipN).
+# All the output lines (relay, red, green) of all the channels are requested
+# together, so a power state change is applied with a single bulk set-values
+# ioctl.
+
+DEFAULT_CHIP = '/dev/gpiochip0'
+
+# Definitions from linux/gpio.h (v1 ABI)
+GPIOHANDLES_MAX = 64
+
+GPIOLINE_FLAG_IS_OUT = (1 << 1)
+
+GPIOHANDLE_REQUEST_INPUT = (1 << 0)
+GPIOHANDLE_REQUEST_OUTPUT = (1 << 1)
+
+GPIOEVENT_REQUEST_RISING_EDGE = (1 << 0)
+GPIOEVENT_REQUEST_FALLING_EDGE = (1 << 1)
+GPIOEVENT_REQUEST_BOTH_EDGES = GPIOEVENT_REQUEST_RISING_EDGE | GPIOEVENT_REQUEST_FALLING_EDGE
+
+GPIOEVENT_EVENT_RISING_EDGE = 0x01
+GPIOEVENT_EVENT_FALLING_EDGE = 0x02
+
+class gpioline_info(ctypes.Structure):
+    _fields_ = [
+        ('line_offset', ctypes.c_uint32),
+        ('flags', ctypes.c_uint32),
+        ('name', ctypes.c_char * 32),
+        ('consumer', ctypes.c_char * 32)
+    ]
+
+class gpiohandle_request(ctypes.Structure):
+    _fields_ = [
+        ('lineoffsets', ctypes.c_uint32 * GPIOHANDLES_MAX),
+        ('flags', ctypes.c_uint32),
+        ('default_values', ctypes.c_uint8 * GPIOHANDLES_MAX),
+        ('consumer_label', ctypes.c_char * 32),
+        ('lines', ctypes.c_uint32),
+        ('fd', ctypes.c_int)
+    ]
+
+class gpiohandle_data(ctypes.Structure):
+    _fields_ = [
+        ('values', ctypes.c_uint8 * GPIOHANDLES_MAX)
+    ]
+
+class gpioevent_request(ctypes.Structure):
+    _fields_ = [
+        ('lineoffset', ctypes.c_uint32),
+        ('handleflags', ctypes.c_uint32),
+        ('eventflags', ctypes.c_uint32),
+        ('consumer_label', ctypes.c_char * 32),
+        ('fd', ctypes.c_int)
+    ]
+
+class gpioevent_data(ctypes.Structure):
+    _fields_ = [
+        ('timestamp', ctypes.c_uint64),
+        ('id', ctypes.c_uint32)
+    ]
+
+def _IOWR(type, nr, size):
+    return (3 << 30) | (size << 16) | (type << 8) | nr
+
+GPIO_GET_LINEINFO_IOCTL = _IOWR(0xB4, 0x02, ctypes.sizeof(gpioline_info))
+GPIO_GET_LINEHANDLE_IOCTL = _IOWR(0xB4, 0x03, ctypes.sizeof(gpiohandle_request))
+GPIO_GET_LINEEVENT_IOCTL = _IOWR(0xB4, 0x04, ctypes.sizeof(gpioevent_request))
+GPIOHANDLE_GET_LINE_VALUES_IOCTL = _IOWR(0xB4, 0x08, ctypes.sizeof(gpiohandle_data))
+GPIOHANDLE_SET_LINE_VALUES_IOCTL = _IOWR(0xB4, 0x09, ctypes.sizeof(gpiohandle_data))
+
+# Create a ctypes structure backed by a bytearray, so it can be passed
+# as a mutable buffer to fcntl.ioctl
+def _new_struct(cls):
+    buf = bytearray(ctypes.sizeof(cls))
+    return buf, cls.from_buffer(buf)
+
+# The ioctl layer. Each method maps to a single ioctl (or read) on the chip
+# or on a line file descriptor. Replaced by FakeGpioChip for testing.
+class GpioChip:
+
+    def __init__(self, path = DEFAULT_CHIP):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    # Request a set of lines as outputs. Returns the line handle fd
+    def request_outputs(self, offsets, defaults, label):
+        buf, req = _new_struct(gpiohandle_request)
+        for i, offset in enumerate(offsets):
+            req.lineoffsets[i] = offset
+            req.default_values[i] = 1 if defaults[i] else 0
+        req.flags = GPIOHANDLE_REQUEST_OUTPUT
+        req.consumer_label = label.encode('ascii')
+        req.lines = len(offsets)
+
+        fcntl.ioctl(self.fd, GPIO_GET_LINEHANDLE_IOCTL, buf, True)
+        return req.fd
+
+    # Get the level of a line that is configured as an output (e.g. left
+    # driven by a previous run), or None if it is an input. The line is
+    # requested without a direction, so its configuration is left as is.
+    def get_output_level(self, offset):
+        buf, info = _new_struct(gpioline_info)
+        info.line_offset = offset
+        fcntl.ioctl(self.fd, GPIO_GET_LINEINFO_IOCTL, buf, True)
+        if not info.flags & GPIOLINE_FLAG_IS_OUT:
+            return None
+
+        buf, req = _new_struct(gpiohandle_request)
+        req.lineoffsets[0] = offset
+        req.flags = 0
+        req.consumer_label = b"powerbutton"
+        req.lines = 1
+        fcntl.ioctl(self.fd, GPIO_GET_LINEHANDLE_IOCTL, buf, True)
+        try:
+            return self.get_value(req.fd)
+        finally:
+            os.close(req.fd)
+
+    # Set the values of all the lines of a handle at once
+    def set_values(self, handle_fd, values):
+        buf, data = _new_struct(gpiohandle_data)
+        for i, v in enumerate(values):
+            data.values[i] = 1 if v else 0
+
+        fcntl.ioctl(handle_fd, GPIOHANDLE_SET_LINE_VALUES_IOCTL, buf, True)
+
+    # Request edge events on a single input line. Returns the event fd
+    def request_events(self, offset, label):
+        buf, req = _new_struct(gpioevent_request)
+        req.lineoffset = offset
+        req.handleflags = GPIOHANDLE_REQUEST_INPUT
+        req.eventflags = GPIOEVENT_REQUEST_BOTH_EDGES
+        req.consumer_label = label.encode('ascii')
+
+        fcntl.ioctl(self.fd, GPIO_GET_LINEEVENT_IOCTL, buf, True)
+        return req.fd
+
+    # Get the current value of a line handle or an event line
+    def get_value(self, event_fd):
+        buf, data = _new_struct(gpiohandle_data)
+        fcntl.ioctl(event_fd, GPIOHANDLE_GET_LINE_VALUES_IOCTL, buf, True)
+        return data.values[0] != 0
+
+    # Read a pending event from an event fd. Returns True for a rising edge
+    # and False for a falling edge
+    def read_event(self, event_fd):
+        data = gpioevent_data.from_buffer_copy(os.read(event_fd, ctypes.sizeof(gpioevent_data)))
+        return data.id == GPIOEVENT_EVENT_RISING_EDGE
+
+    def release(self, fd):
+        os.close(fd)
+
+class GpiochipPowerControl(PowerHub):
+
+    def __init__(self, cb = None, settings = {}, channels = (), chip = None, metrics = None, power_off = None,
+            initial_states = None):
+        PowerHub.__init__(self, cb, settings, channels, metrics, power_off, initial_states)
+        self.keep_relay_state = prop_or_default(settings, "keep_relay_state", True)
+
+        if chip is None:
+            chip = GpioChip(prop_or_default(settings, "chip", DEFAULT_CHIP))
+        self.chip = chip
+
+        # Request all the output lines with a single handle. The position of
+        # each channel's lines in the handle is kept in the channel object.
+        # The lines start at the levels of the initial power states, so a
+        # channel taken over from a previous controller is not switched. A
+        # relay already driven on (e.g. OctoPrint was restarted) is kept on,
+        # unless keep_relay_state is off.
+        offsets = []
+        values = []
+        for channel in self.channels.values():
+            channel.relay_index = None
+            channel.led_index = None
+            channel.relay_was_on = False
+            if (channel.gpio_relay is not None and self.keep_relay_state and
+                    channel.name not in self.initial_states):
+                level = self.chip.get_output_level(channel.gpio_relay)
+                channel.relay_was_on = level is not None and level != (not channel.relay_polarity)
+
+            relay, red, green = self._initial_levels(channel,
+                POWER_STATE_ON if channel.relay_was_on else POWER_STATE_OFF)
+            if channel.gpio_relay is not None:
+                channel.relay_index = len(offsets)
+                offsets.append(channel.gpio_relay)
+                values.append(relay)
+            if channel.has_leds():
+                channel.led_index = len(offsets)
+                offsets.extend([channel.gpio_red, channel.gpio_green])
+                values.extend([red, green])
+
+        self.output_fd = None
+        self.output_values = values
+        if offsets:
+            self.output_fd = self.chip.request_outputs(offsets, self.output_values, "powerbutton")
+
+        # Request events for all the buttons
+        self.button_fds = {}
+        for channel in self.channels.values():
+            if channel.gpio_button is not None:
+                self.button_fds[self.chip.request_events(channel.gpio_button, "powerbutton")] = channel
+
+        # A pipe used for waking the button thread up on shutdown
+        self.wake_r, self.wake_w = os.pipe()
+
+        # Set the initial power state to OFF, unless the relay is kept on (or
+        # the state is taken over from a previous controller)
+        self._set_initial_states(dict((channel.name, POWER_STATE_ON if channel.relay_was_on else POWER_STATE_OFF)
+            for channel in self.channels.values()))
+
+        # Start the button thread
+        self.running = True
+        self.button_thread = Thread(target = self.__button_thread, name = "powerbutton-button")
+        self.button_thread.daemon = True
+        self.button_thread.start()
+
+    # Stop the button thread, waiting for it for at most timeout seconds,
+    # and release the lines. Released lines are returned to the kernel, so
+    # unexport makes no difference. Returns True if the thread has exited.
+    def shutdown(self, timeout = SHUTDOWN_TIMEOUT, unexport = False):
+        if not self.running:
+            return not self.button_thread.is_alive()
+        self.running = False
+
+        # Wake the button thread if it's blocked waiting for an event
+        os.write(self.wake_w, b'x')
+
+        # Release the lines, so they can be requested by a new controller
+        self.button_thread.join(timeout)
+        stopped = not self.button_thread.is_alive()
+        if stopped:
+            for fd in [self.output_fd] + list(self.button_fds.keys()):
+                if fd is not None:
+                    self.chip.release(fd)
+            self.button_fds = {}
+            os.close(self.wake_r)
+            os.close(self.wake_w)
+        elif self.output_fd is not None:
+            self.chip.release(self.output_fd)
+        self.output_fd = None
+        self.chip.close()
+        return stopped
+
+    # Calculate the levels of all the output lines and set them with one
+    # ioctl. Nothing is done if no level has changed.
+    def _write_outputs(self, outputs):
+        if self.output_fd is None:
+            return
+
+        values = list(self.output_values)
+        for channel, (relay, red, green) in outputs:
+            if channel.relay_index is not None:
+                values[channel.relay_index] = relay
+            if channel.led_index is not None:
+                values[channel.led_index] = red
+                values[channel.led_index + 1] = green
+
+        if values != self.output_values:
+            self.chip.set_values(self.output_fd, values)
+            self.output_values = values
+
+    # Read the (logical) button state of a channel
+    def __button_value(self, fd, channel):
+        return (not self.chip.get_value(fd)) ^ (not channel.button_polarity)
+
+    # Wait for button events. The thread sleeps in poll() while the buttons
+    # are idle, and only uses a timeout while a gesture is in progress (e.g.
+    # to detect a long press).
+    def __button_thread(self):
+        if not self.button_fds:
+            return
+
+        poller = select.poll()
+        for fd in self.button_fds:
+            poller.register(fd, select.POLLIN | select.POLLPRI)
+        poller.register(self.wake_r, select.POLLIN)
+
+        now = monotonic()
+        for fd, channel in self.button_fds.items():
+            self._button_changed(channel, self.__button_value(fd, channel), now)
+
+        timeout = self._button_check(now)
+        while(self.running):
+            events = poller.poll(None if timeout is None else max(0, timeout) * 1000)
+            if not self.running:
+                break
+
+            now = monotonic()
+            for fd, _ in events:
+                if fd in self.button_fds:
+                    channel = self.button_fds[fd]
+                    v = (not self.chip.read_event(fd)) ^ (not channel.button_polarity)
+                    self._button_changed(channel, v, now)
+
+            timeout = self._button_check(now)
@@ -0,0 +1,255 @@
+import datetime
+import mmap
+import os
+import struct
+import time
+from threading import Lock
+from octoprint_powerbutton.power_states import *
+from octoprint_powerbutton.scheduler import monotonic
+
+# Default number of transition records kept in the journal
+JOURNAL_CAPACITY = 32768
+
+# Default number of (day, channel) on-time totals kept in the journal
+DAILY_CAPACITY = 1024
+
+# Maximal number of records returned by a single query
+QUERY_LIMIT = 1000
+
+# Header: magic, version, record capacity, daily capacity, next record
+# sequence number, next daily slot
+HEADER = struct.Struct("<4sIIIQI")
+HEADER_SIZE = 64
+MAGIC = b"PBJ1"
+VERSION = 1
+
+# Record: sequence number, monotonic time, wall time, channel, old state,
+# new state, cause
+RECORD = struct.Struct("<Qdd24sBBB5x")
+
+# Daily total: day (proleptic Gregorian ordinal, local time), channel,
+# number of transitions, seconds powered (on or locked), seconds locked
+DAILY = struct.Struct("<I24sIdd")
+
+# Stored for a missing old state (the first state of a channel)
+NO_STATE = 0xff
+
+def _is_powered(state):
+    return state == POWER_STATE_ON or state == POWER_STATE_LOCKED
+
+def _encode_name(name):
+    return name.encode("utf-8")[:24]
+
+def _decode_name(data):
+    return data.rstrip(b"\0").decode("utf-8", "replace")
+
+# Split a (wall time) interval at local midnights. Yields (day, seconds)
+# pairs, day being the date's ordinal.
+def _split_days(start, end):
+    day = datetime.date.fromtimestamp(start)
+    while start < end:
+        next_day = day + datetime.timedelta(days = 1)
+        split = min(end, time.mktime(next_day.timetuple()))
+        yield day.toordinal(), split - start
+        start, day = split, next_day
+
+# An append-only journal of power state transitions, kept in a fixed-size
+# memory-mapped file. Transitions are written to a ring of fixed-size
+# records, so appending is O(1) and the file never grows; the oldest
+# records are overwritten once the ring is full. The journal also keeps
+# per-day totals of the time each channel was powered, updated on every
+# transition, so they outlive the records they were computed from.
+class PowerJournal:
+
+    def __init__(self, path, capacity = JOURNAL_CAPACITY, daily_capacity = DAILY_CAPACITY, clock = time.time):
+        self.path = path
+        self.capacity = capacity
+        self.daily_capacity = daily_capacity
+        self.clock = clock
+        self.lock = Lock()
+
+        self.records_offset = HEADER_SIZE
+        self.daily_offset = self.records_offset + capacity * RECORD.size
+        size = self.daily_offset + daily_capacity * DAILY.size
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # A file of another layout (or a corrupt one) is started over
+            if os.fstat(fd).st_size != size or not self.__valid_header(fd):
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                self.mm = mmap.mmap(fd, size)
+                self.next_seq = 0
+                self.next_daily = 0
+                self.__write_header()
+            else:
+                self.mm = mmap.mmap(fd, size)
+                _, _, _, _, self.next_seq, self.next_daily = HEADER.unpack_from(self.mm, 0)
+        finally:
+            os.close(fd)
+
+        # Index of the daily totals: (day, channel) -> slot
+        self.daily_index = {}
+        for slot in range(min(self.next_daily, daily_capacity)):
+            day, channel, _, _, _ = DAILY.unpack_from(self.mm, self.daily_offset + slot * DAILY.size)
+            self.daily_index[(day, _decode_name(channel))] = slot
+
+        # The last state of each channel, and the wall time it was entered.
+        # Intervals that started before the journal was opened are not
+        # known to have lasted, so they are not counted.
+        self.last_state = {}
+
+    def __valid_header(self, fd):
+        data = os.read(fd, HEADER.size)
+        if len(data) != HEADER.size:
+            return False
+        magic, version, capacity, daily_capacity, _, _ = HEADER.unpack(data)
+        return (magic == MAGIC and version == VERSION and capacity == self.capacity
+            and daily_capacity == self.daily_capacity)
+
+    def __write_header(self):
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, self.capacity, self.daily_capacity,
+            self.next_seq, self.next_daily)
+
+    # Record a transition of a channel. old_state is None for the first
+    # state of a channel. Returns the record's sequence number, or None if
+    # the journal is closed (a transition made late in the shutdown is not
+    # recorded).
+    def append(self, channel, old_state, new_state, cause = CAUSE_UNKNOWN):
+        mono = monotonic()
+        wall = self.clock()
+
+        with self.lock:
+            if self.mm is None:
+                return None
+            seq = self.next_seq
+            RECORD.pack_into(self.mm, self.records_offset + (seq % self.capacity) * RECORD.size,
+                seq, mono, wall, _encode_name(channel),
+                NO_STATE if old_state is None else old_state, new_state, cause)
+            self.next_seq = seq + 1
+
+            self.__account(channel, wall, 1)
+            self.last_state[channel] = (new_state, wall)
+
+            self.__write_header()
+        return seq
+
+    # Close the interval of every channel that is powered, and write the
+    # journal to the disk
+    def close(self):
+        with self.lock:
+            if self.mm is None:
+                return
+            now = self.clock()
+            for channel in list(self.last_state.keys()):
+                self.__account(channel, now, 0)
+            self.last_state = {}
+            self.mm.flush()
+            self.mm.close()
+            self.mm = None
+
+    # Add the time since the last transition of a channel (if it was
+    # powered) to its daily totals, split at midnight. Must be called with
+    # the lock held.
+    def __account(self, channel, now, transitions):
+        state, start = self.last_state.get(channel, (None, now))
+        if transitions:
+            self.__add_daily(datetime.date.fromtimestamp(now).toordinal(), channel, transitions, 0, False)
+
+        if not _is_powered(state) or now <= start:
+            return
+
+        for day, seconds in _split_days(start, now):
+            self.__add_daily(day, channel, 0, seconds, state == POWER_STATE_LOCKED)
+        self.last_state[channel] = (state, now)
+
+    def __add_daily(self, day, channel, transitions, seconds, locked):
+        key = (day, channel)
+        slot = self.daily_index.get(key)
+        if slot is None:
+            # Take the next slot, dropping the oldest totals once all are used
+            slot = self.next_daily % self.daily_capacity
+            if self.next_daily >= self.daily_capacity:
+                old_day, old_channel, _, _, _ = DAILY.unpack_from(self.mm, self.daily_offset + slot * DAILY.size)
+                self.daily_index.pop((old_day, _decode_name(old_channel)), None)
+            self.next_daily += 1
+            self.daily_index[key] = slot
+            DAILY.pack_into(self.mm, self.daily_offset + slot * DAILY.size, day, _encode_name(channel), 0, 0.0, 0.0)
+
+        offset = self.daily_offset + slot * DAILY.size
+        _, name, count, powered, locked_time = DAILY.unpack_from(self.mm, offset)
+        DAILY.pack_into(self.mm, offset, day, name, count + transitions, powered + seconds,
+            locked_time + (seconds if locked else 0))
+
+    def __read(self, seq):
+        record = RECORD.unpack_from(self.mm, self.records_offset + (seq % self.capacity) * RECORD.size)
+        seq, mono, wall, channel, old_state, new_state, cause = record
+        return dict(seq = seq, monotonic = mono, time = wall, channel = _decode_name(channel),
+            oldState = None if old_state == NO_STATE else str_power_state(old_state),
+            newState = str_power_state(new_state), cause = str_cause(cause))
+
+    # Sequence number of the first record whose wall time is not before
+    # the given one. Records are appended in time order, so this is a binary
+    # search.
+    def __find(self, first, last, wall):
+        while first < last:
+            mid = (first + last) // 2
+            _, _, mid_wall = struct.unpack_from("<Qdd", self.mm, self.records_offset + (mid % self.capacity) * RECORD.size)
+            if mid_wall < wall:
+                first = mid + 1
+            else:
+                last = mid
+        return first
+
+    # Return the records in the given wall time range, optionally of a
+    # single channel, in time order. Results are paginated: at most limit
+    # records are returned, and "next" is the cursor for the following
+    # page (passed as after), or None if there are no more records.
+    def query(self, start = None, end = None, channel = None, after = None, limit = 100):
+        limit = max(1, min(limit, QUERY_LIMIT))
+        records = []
+
+        with self.lock:
+            last = self.next_seq
+            first = max(0, last - self.capacity)
+            if after is not None:
+                first = max(first, after + 1)
+            if start is not None:
+                first = self.__find(first, last, start)
+
+            seq = first
+            while seq < last and len(records) < limit:
+                record = self.__read(seq)
+                seq += 1
+                if end is not None and record["time"] >= end:
+                    seq = last
+                    break
+                if channel is None or record["channel"] == channel:
+                    records.append(record)
+
+        return dict(records = records, next = records[-1]["seq"] if seq < last else None)
+
+    # Return the daily totals, optionally of a single channel, in date
+    # order. The time the channels have been powered since their last
+    # transition is included.
+    def daily_totals(self, channel = None):
+        totals = {}
+        with self.lock:
+            for (day, name), slot in self.daily_index.items():
+                if channel is None or name == channel:
+                    _, _, count, powered, locked = DAILY.unpack_from(self.mm, self.daily_offset + slot * DAILY.size)
+                    totals[(day, name)] = [count, powered, locked]
+
+            # The open intervals
+            now = self.clock()
+            for name, (state, start) in self.last_state.items():
+                if (channel is None or name == channel) and _is_powered(state):
+                    for day, seconds in _split_days(start, now):
+                        total = totals.setdefault((day, name), [0, 0.0, 0.0])
+                        total[1] += seconds
+                        if state == POWER_STATE_LOCKED:
+                            total[2] += seconds
+
+        return [dict(date = datetime.date.fromordinal(day).isoformat(), channel = name,
+                transitions = count, poweredSeconds = powered, lockedSeconds = locked)
+            for (day, name), (count, powered, locked) in sorted(totals.items())]
@@ -0,0 +1,164 @@
+import math
+from threading import Lock
+from octoprint_powerbutton.power_hub import LED_COLOR_OFF
+
+# Shortest delay between two frames of a pattern, in seconds
+MIN_FRAME_DELAY = 0.001
+
+# LED patterns. frame(t) returns the color the LED should have t seconds
+# after the pattern was started, and the time (in seconds) until it may
+# change next, or None if it never changes.
+
+class StaticPattern:
+
+    def __init__(self, color):
+        self.color = color
+
+    def frame(self, t):
+        return self.color, None
+
+class BlinkPattern:
+
+    def __init__(self, color, off_color = LED_COLOR_OFF, period = 1.0, duty = 0.5):
+        self.color = color
+        self.off_color = off_color
+        self.period = period
+        self.duty = duty
+
+    def frame(self, t):
+        phase = t % self.period
+        on_time = self.period * self.duty
+        if phase < on_time:
+            return self.color, on_time - phase
+        return self.off_color, self.period - phase
+
+# Fades the LED in and out. The brightness is made by software PWM, in
+# steps (levels) of the PWM period; the LED is only written when it is
+# switched on or off within a PWM period, so full off and full on cost
+# nothing.
+class BreathePattern:
+
+    def __init__(self, color, period = 3.0, pwm_period = 0.02, steps = 10):
+        self.color = color
+        self.period = period
+        self.pwm_period = pwm_period
+        self.steps = steps
+
+    def frame(self, t):
+        pwm_start = math.floor(t / self.pwm_period) * self.pwm_period
+        offset = t - pwm_start
+        remaining = self.pwm_period - offset
+
+        # The brightness (0..steps) over this PWM period
+        brightness = (1 - math.cos(2 * math.pi * pwm_start / self.period)) / 2
+        level = int(round(brightness * self.steps))
+
+        on_time = self.pwm_period * level / self.steps
+        if offset < on_time:
+            return self.color, on_time - offset
+        return LED_COLOR_OFF, remaining
+
+# Blinks at a rate that follows a countdown: progress() returns the
+# percentage of time left (100..0, None if the countdown is over), and the
+# blink period goes from max_period at 100% to min_period at 0%.
+class CountdownPattern:
+
+    def __init__(self, color, progress, off_color = LED_COLOR_OFF, min_period = 0.2, max_period = 2.0):
+        self.color = color
+        self.off_color = off_color
+        self.progress = progress
+        self.min_period = min_period
+        self.max_period = max_period
+        self.on = False
+
+    def frame(self, t):
+        percent = self.progress()
+        if percent is None:
+            return self.color, None
+
+        # The pattern is stateful, since the period changes over time: each
+        # frame toggles the LED and waits for half of the current period
+        self.on = not self.on
+        period = self.min_period + (self.max_period - self.min_period) * max(0, min(percent, 100)) / 100.0
+        return self.color if self.on else self.off_color, period / 2
+
+# Runs the LED patterns of any number of channels on the scheduler, so all
+# the animations share one thread and no thread is created per pattern.
+# A pattern only wakes the scheduler when its color may change, and the
+# color is only written when it does. Setting a new pattern for a channel
+# cancels all the pending work of the previous one.
+class LedAnimator:
+
+    def __init__(self, scheduler, write):
+        # write(channel, color) sets the LED color of a channel, None for
+        # the color of its power state
+        self.scheduler = scheduler
+        self.write = write
+        self.lock = Lock()
+        self.patterns = {}  # channel -> (pattern, start time, task, generation)
+        self.colors = {}    # channel -> last color written
+        self.generation = 0
+
+    # Start a pattern on a channel, or return the channel to its power
+    # state color with None. Setting the pattern that is already running
+    # does nothing.
+    def set_pattern(self, channel, pattern):
+        with self.lock:
+            current = self.patterns.get(channel)
+            if current is not None and current[0] is pattern:
+                return
+            self.__cancel(channel)
+
+            if pattern is None:
+                self.__write(channel, None)
+                return
+
+            self.generation += 1
+            self.patterns[channel] = (pattern, self.scheduler.now(), None, self.generation)
+            self.__run(channel, self.generation)
+
+    def get_pattern(self, channel):
+        with self.lock:
+            current = self.patterns.get(channel)
+            return current[0] if current is not None else None
+
+    # Stop all the patterns, and forget the colors written (e.g. when the
+    # LEDs are taken over by a new power controller)
+    def stop(self):
+        with self.lock:
+            for channel in list(self.patterns.keys()):
+                self.__cancel(channel)
+                self.__write(channel, None)
+            self.colors = {}
+
+    def __cancel(self, channel):
+        current = self.patterns.pop(channel, None)
+        if current is not None and current[2] is not None:
+            self.scheduler.cancel(current[2])
+
+    def __write(self, channel, color):
+        if channel not in self.colors or self.colors[channel] != color:
+            self.colors[channel] = color
+            self.write(channel, color)
+
+    def __on_frame(self, channel, generation):
+        with self.lock:
+            self.__run(channel, generation)
+
+    # Show the current frame of a channel's pattern, and schedule the next
+    # one. Must be called with the lock held.
+    def __run(self, channel, generation):
+        current = self.patterns.get(channel)
+        if current is None or current[3] != generation:
+            # The pattern has been replaced after this frame was scheduled
+            return
+
+        pattern, start, _, _ = current
+        now = self.scheduler.now()
+        color, delay = pattern.frame(now - start)
+        self.__write(channel, color)
+
+        task = None
+        if delay is not None:
+            task = self.scheduler.call_at(now + max(delay, MIN_FRAME_DELAY), self.__on_frame, channel, generation)
+        self.patterns[channel] = (pattern, start, task, generation)
@@ -0,0 +1,114 @@
+import bisect
+from threading import Lock
+
+# Default histogram buckets (upper bounds), in seconds
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Counter:
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = Lock()
+        self.value = 0
+
+    def inc(self, n = 1):
+        with self.lock:
+            self.value += n
+
+    def to_json(self):
+        return dict(type = "counter", help = self.help, value = self.value)
+
+    def to_prometheus(self):
+        return [
+            "# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s counter" % self.name,
+            "%s %s" % (self.name, self.value)
+        ]
+
+# A histogram with fixed buckets. Observing a value is a binary search and
+# a few additions, so it can be used on hot paths.
+class Histogram:
+
+    def __init__(self, name, help, buckets = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.lock = Lock()
+        self.counts = [0] * (len(self.buckets) + 1)   # Last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = None
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def to_json(self):
+        with self.lock:
+            counts = list(self.counts)
+            total, count, max_value = self.sum, self.count, self.max
+
+        cumulative = []
+        acc = 0
+        for bound, n in zip(list(self.buckets) + ["+Inf"], counts):
+            acc += n
+            cumulative.append([bound, acc])
+
+        return dict(type = "histogram", help = self.help, buckets = cumulative,
+            sum = total, count = count, max = max_value)
+
+    def to_prometheus(self):
+        data = self.to_json()
+        lines = [
+            "# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s histogram" % self.name
+        ]
+        for bound, n in data["buckets"]:
+            lines.append('%s_bucket{le="%s"} %d' % (self.name, bound if bound == "+Inf" else repr(float(bound)), n))
+        lines.append("%s_sum %r" % (self.name, data["sum"]))
+        lines.append("%s_count %d" % (self.name, data["count"]))
+        return lines
+
+# Holds all the metrics of the plugin. Metrics are created on first use,
+# and looking one up again by name returns the same object.
+class MetricsRegistry:
+
+    def __init__(self):
+        self.lock = Lock()
+        self.metrics = {}
+
+    def counter(self, name, help):
+        return self.__get_or_create(Counter, name, help)
+
+    def histogram(self, name, help, buckets = DEFAULT_BUCKETS):
+        return self.__get_or_create(Histogram, name, help, buckets)
+
+    def __get_or_create(self, cls, name, *args):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = cls(name, *args)
+                self.metrics[name] = metric
+            assert(isinstance(metric, cls))
+            return metric
+
+    def to_json(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return dict((m.name, m.to_json()) for m in metrics)
+
+    # Render all the metrics in the Prometheus text exposition format
+    def to_prometheus(self):
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key = lambda m: m.name)
+
+        lines = []
+        for m in metrics:
+            lines.extend(m.to_prometheus())
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,84 @@
+from threading import Lock
+from octoprint_powerbutton.metrics import MetricsRegistry
+from octoprint_powerbutton.scheduler import monotonic
+
+# Default time window for merging notification bursts, in seconds
+COALESCE_WINDOW = 0.05
+
+# Sends power state push messages from the scheduler thread. Each message
+# has a key (the power channel it describes). Requests for a notification
+# only mark the key as dirty, so the calling thread never waits for the
+# message to go out. All the requests within the coalescing window are
+# merged into one message per key, built from the state at the time it is
+# sent, and a message identical to the last one sent for its key is
+# dropped.
+class StateNotifier:
+
+    def __init__(self, scheduler, build_payload, send, window = COALESCE_WINDOW, metrics = None):
+        # build_payload(key) returns the message for a key (or None),
+        # send(message) sends it
+        self.scheduler = scheduler
+        self.build_payload = build_payload
+        self.send = send
+        self.window = window
+
+        metrics = metrics or MetricsRegistry()
+        self.lock_wait = metrics.histogram("powerbutton_notify_lock_wait_seconds",
+            "Time a notification request waited for the notifier lock")
+        self.lock_hold = metrics.histogram("powerbutton_notify_lock_hold_seconds",
+            "Time a notification request held the notifier lock")
+        self.sent = metrics.counter("powerbutton_notifications_sent_total",
+            "Number of power state push messages sent")
+        self.dropped = metrics.counter("powerbutton_notifications_dropped_total",
+            "Number of power state push messages dropped as duplicates")
+        self.send_time = metrics.histogram("powerbutton_notification_send_seconds",
+            "Time spent sending a power state push message")
+
+        self.lock = Lock()
+        self.task = None
+        self.dirty = {}         # key -> force
+        self.last_payload = {}
+
+    # Request a notification. If force is True, the message is sent even if
+    # it is identical to the last one (e.g. a new client asked for it).
+    def notify(self, key, force = False):
+        t = monotonic()
+        with self.lock:
+            acquired = monotonic()
+            self.dirty[key] = self.dirty.get(key, False) or force
+            if self.task is None:
+                self.task = self.scheduler.call_later(self.window, self.__flush)
+        released = monotonic()
+
+        self.lock_wait.observe(acquired - t)
+        self.lock_hold.observe(released - acquired)
+
+    # Forget the last messages sent, so the next ones are always sent
+    def reset(self):
+        with self.lock:
+            self.last_payload = {}
+
+    def __flush(self):
+        with self.lock:
+            self.task = None
+            dirty = self.dirty
+            self.dirty = {}
+
+        for key, force in dirty.items():
+            payload = self.build_payload(key)
+            if payload is None:
+                continue
+
+            with self.lock:
+                duplicate = payload == self.last_payload.get(key) and not force
+                if not duplicate:
+                    self.last_payload[key] = payload
+
+            if duplicate:
+                self.dropped.inc()
+                continue
+
+            t = monotonic()
+            self.send(payload)
+            self.send_time.observe(monotonic() - t)
+            self.sent.inc()
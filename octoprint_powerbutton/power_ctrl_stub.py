@@ -1,36 +1,22 @@
+
 import types
 from octoprint_powerbutton.power_states import *
+from octoprint_powerbutton.power_hub import PowerHub
 
-class StubPowerController:
+class StubPowerController(PowerHub):
 
-    def __init__(self, logger = None, cb = None):
-        assert(cb is None or callable(cb))
-        self.cb = cb
+    def __init__(self, logger = None, cb = None, channels = (), metrics = None, power_off = None,
+            initial_states = None):
+        PowerHub.__init__(self, cb, {}, channels, metrics, power_off, initial_states)
         self.logger = logger
-        self.set_power_state(POWER_STATE_OFF)
+        self._set_initial_states(dict((name, POWER_STATE_OFF) for name in self.channels))
 
-    def shutdown(self):
+    def shutdown(self, timeout = None, unexport = False):
         if self.logger:
             self.logger.info("StubPowerController: shutdown")
-        pass
-
-
-    def get_power_state(self):
-        if self.logger:
-            self.logger.info("StubPowerController: get_power_state")
-        return self.power_state
-
-    def set_power_state(self, new_state):
-        assert_power_state(new_state)
+        return True
 
+    def _write_outputs(self, outputs):
         if self.logger:
-            self.logger.info("StubPowerController: set_power_state(%s)" % str_power_state(new_state))
-        
-
-        # Set the new power state
-        self.power_state = new_state
-
-        # If a callback is set, let it know
-        if (self.cb is not None):
-            self.cb(new_state)
-
+            for channel, _ in outputs:
+                self.logger.info("StubPowerController: set_power_state(%s, %s)" % (channel.name, str_power_state(channel.power_state)))
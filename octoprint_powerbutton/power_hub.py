@@ -0,0 +1,314 @@
+from collections import OrderedDict
+from threading import Lock, Event
+import time
+from octoprint_powerbutton.power_states import *
+from octoprint_powerbutton.metrics import MetricsRegistry
+from octoprint_powerbutton.scheduler import monotonic
+from octoprint_powerbutton.gestures import GestureRecognizer, GESTURE_SHORT, GESTURE_LONG
+
+# Name of the channel configured by the top-level (single channel) settings.
+# This is the channel that powers the printer.
+PRIMARY_CHANNEL = "printer"
+
+LED_COLOR_OFF = 0
+LED_COLOR_RED = 1
+LED_COLOR_GREEN = 2
+LED_COLOR_YELLOW = 3
+
+# Button sampling interval, for inputs without edge events
+POLL_INTERVAL = 0.05
+
+# Actions the button gestures can be mapped to
+ACTION_NONE = "none"
+ACTION_TOGGLE = "toggle"    # Toggle between on and off (nothing if locked)
+ACTION_ON = "on"
+ACTION_OFF = "off"          # Turn off, even if locked
+
+BUTTON_ACTIONS = (ACTION_NONE, ACTION_TOGGLE, ACTION_ON, ACTION_OFF)
+DEFAULT_GESTURE_ACTIONS = { GESTURE_SHORT: ACTION_TOGGLE, GESTURE_LONG: ACTION_OFF }
+
+def prop_or_default(dict, prop, default = None):
+    return dict[prop] if prop in dict else default
+
+# A single power channel: a relay with an optional button and LED pair.
+# The channel object also serves as a power controller for that channel
+# alone (get_power_state/set_power_state).
+class PowerChannel:
+
+    def __init__(self, hub, name, settings):
+        self.hub = hub
+        self.name = name
+        self.gpio_relay = prop_or_default(settings, "gpio_relay")
+        self.gpio_button = prop_or_default(settings, "gpio_button")
+        self.gpio_red = prop_or_default(settings, "gpio_red")
+        self.gpio_green = prop_or_default(settings, "gpio_green")
+        self.led_polarity = prop_or_default(settings, "led_polarity", True)
+        self.relay_polarity = prop_or_default(settings, "relay_polarity", True)
+        self.button_polarity = prop_or_default(settings, "button_polarity", False)
+
+        self.power_state = None
+
+        # The LED color set by set_led_color (None for the color of the
+        # power state), and the last (physical) LED levels written
+        self.led_color = None
+        self.led_levels = None
+
+        # Classifies the button presses
+        self.gestures = GestureRecognizer(lambda gesture, detected: hub._on_gesture(self, gesture, detected),
+            hub.button_timing)
+
+    def has_leds(self):
+        return self.gpio_red is not None and self.gpio_green is not None
+
+    def get_power_state(self):
+        return self.power_state
+
+    def set_power_state(self, new_state, cause = CAUSE_UNKNOWN):
+        self.hub.set_power_states({ self.name: new_state }, cause = cause)
+
+    # Calculate the (physical) levels of the relay, red and green pins for
+    # a power state
+    def output_levels(self, state):
+        if state == POWER_STATE_ON:
+            relay, color = True, LED_COLOR_GREEN
+        elif state == POWER_STATE_LOCKED:
+            relay, color = True, LED_COLOR_YELLOW
+        else:
+            relay, color = False, LED_COLOR_RED
+
+        if self.led_color is not None:
+            color = self.led_color
+
+        red = ((color == LED_COLOR_RED) or (color == LED_COLOR_YELLOW)) ^ (not self.led_polarity)
+        green = ((color == LED_COLOR_GREEN) or (color == LED_COLOR_YELLOW)) ^ (not self.led_polarity)
+        return (relay ^ (not self.relay_polarity), bool(red), bool(green))
+
+# Base class of the power controllers. Holds any number of channels, the
+# first of which is PRIMARY_CHANNEL (configured by the settings passed
+# directly to the controller). State changes of several channels are
+# applied together in a single call to the backend's _write_outputs, and
+# the button presses of all the channels are tracked by the backend's
+# single input thread.
+class PowerHub:
+
+    def __init__(self, cb = None, settings = {}, channels = (), metrics = None, power_off = None,
+            initial_states = None):
+        # power_off(channel name, cause, started) turns a channel off for the
+        # button instead of the hub (e.g. to disconnect the printer first).
+        # initial_states (a dict of channel name to state) are the power
+        # states taken over from a previous controller (see
+        # _set_initial_states).
+        assert(cb is None or callable(cb))
+        self.cb = cb
+        self.power_off = power_off
+        self.initial_states = initial_states or {}
+        self.lock = Lock()
+
+        # Set by retire() when the controller is being replaced, and by
+        # hand_over() to the controller that replaces it
+        self.retired = False
+        self.successor = None
+        self.handed_over = Event()
+
+        metrics = metrics or MetricsRegistry()
+        self.write_time = metrics.histogram("powerbutton_output_write_seconds",
+            "Time spent writing the relay and LED outputs of a state change")
+        self.button_latency = metrics.histogram("powerbutton_button_to_relay_seconds",
+            "Time from a button press being detected to the relay being written")
+        self.button_gestures = metrics.counter("powerbutton_button_gestures_total",
+            "Number of button gestures recognized")
+
+        # The button settings (gesture timing and the actions of the
+        # gestures) are common to all the channels
+        self.channels = OrderedDict()
+        self.set_button(prop_or_default(settings, "button"))
+
+        self.channels[PRIMARY_CHANNEL] = PowerChannel(self, PRIMARY_CHANNEL, settings)
+        for channel_settings in channels:
+            name = channel_settings["name"]
+            assert(name not in self.channels)
+            self.channels[name] = PowerChannel(self, name, channel_settings)
+
+    # Change the button settings of all the channels: a dict of the gesture
+    # timing, with the actions of the gestures under "actions". Applied to
+    # a running controller, without touching the pins.
+    def set_button(self, button):
+        button = dict(button or {})
+        actions = dict(DEFAULT_GESTURE_ACTIONS)
+        actions.update(button.pop("actions", None) or {})
+        self.gesture_actions = actions
+        self.button_timing = button
+        for channel in self.channels.values():
+            channel.gestures.set_timing(button)
+
+    # Stop the backend's threads (waiting for at most timeout seconds) and
+    # release the hardware. Returns True if all the threads have exited.
+    def shutdown(self, timeout = None, unexport = False):
+        return True
+
+    # Stop changing the power states, for the controller that replaces
+    # this one, and return them (a dict of channel name to state). Called
+    # after shutdown. The state changes made from then on (by threads that
+    # still hold this controller) wait for hand_over, and are made on the
+    # new controller, so none is lost.
+    def retire(self):
+        with self.lock:
+            self.retired = True
+            return dict((name, channel.power_state) for name, channel in self.channels.items()
+                if channel.power_state is not None)
+
+    # Pass the state changes made on this retired controller on to the one
+    # that replaces it (None if there is none, and they are dropped)
+    def hand_over(self, successor):
+        self.successor = successor
+        self.handed_over.set()
+
+    def channel(self, name):
+        return self.channels[name]
+
+    def channel_names(self):
+        return list(self.channels.keys())
+
+    # The controller interface, applied to the primary channel
+    def get_power_state(self):
+        return self.channels[PRIMARY_CHANNEL].power_state
+
+    def set_power_state(self, new_state, cause = CAUSE_UNKNOWN):
+        self.set_power_states({ PRIMARY_CHANNEL: new_state }, cause = cause)
+
+    # Set the power state of several channels at once. States are given as
+    # a dict of channel name to state. If started is given, it is the
+    # (monotonic) time of the button event that caused the change. cause
+    # is one of the CAUSE_* constants, and is passed on to the callback.
+    def set_power_states(self, states, started = None, cause = CAUSE_UNKNOWN):
+        changed = None
+        with self.lock:
+            if not self.retired:
+                changed = self.__set_states(states, started)
+
+        # A retired controller passes the changes on
+        if changed is None:
+            self.handed_over.wait()
+            successor = self.successor
+            if successor is not None:
+                successor.set_power_states(dict((name, state) for name, state in states.items()
+                    if name in successor.channels), started, cause)
+            return
+
+        # If a callback is set, let it know
+        if self.cb is not None:
+            for channel, old_state, new_state in changed:
+                self.cb(new_state, channel.name, old_state, cause)
+
+    # Change the states and write the outputs, returning the (channel, old
+    # state, new state) of the channels that have changed. Must be called
+    # with the lock held.
+    def __set_states(self, states, started):
+        changed = []
+        for name, new_state in states.items():
+            assert_power_state(new_state)
+            channel = self.channels[name]
+
+            # If state hasn't change, do nothing
+            if new_state != channel.power_state:
+                changed.append((channel, channel.power_state, new_state))
+                channel.power_state = new_state
+
+        if changed:
+            t = monotonic()
+            outputs = [(channel, channel.output_levels(new_state)) for channel, _, new_state in changed]
+            self._write_outputs(outputs)
+            for channel, levels in outputs:
+                channel.led_levels = levels[1:]
+            end = monotonic()
+            self.write_time.observe(end - t)
+            if started is not None:
+                self.button_latency.observe(end - started)
+        return changed
+
+    # Set the power states of the channels when the controller starts. The
+    # channels whose states were taken over from a previous controller get
+    # them silently: the backend has already set their pins to the levels of
+    # these states, and nothing is reported. The other channels are set to
+    # their default states (a dict of channel name to state) with
+    # CAUSE_STARTUP.
+    def _set_initial_states(self, defaults):
+        with self.lock:
+            outputs = []
+            for name, channel in self.channels.items():
+                if name in self.initial_states:
+                    channel.power_state = self.initial_states[name]
+                    outputs.append((channel, channel.output_levels(channel.power_state)))
+            self._write_outputs(outputs)
+            for channel, levels in outputs:
+                channel.led_levels = levels[1:]
+
+        self.set_power_states(dict((name, state) for name, state in defaults.items()
+            if name not in self.initial_states), cause = CAUSE_STARTUP)
+
+    # The (relay, red, green) levels a channel starts with: those of the
+    # state taken over from a previous controller, or of the given state
+    def _initial_levels(self, channel, default_state = POWER_STATE_OFF):
+        return channel.output_levels(self.initial_states.get(channel.name, default_state))
+
+    # Set the LED color of a channel (one of the LED_COLOR_* constants),
+    # regardless of its power state, or return to the color of the power
+    # state with None. Used for LED animations, so the pins are only written
+    # if their levels change.
+    def set_led_color(self, name, color):
+        with self.lock:
+            channel = self.channels[name]
+            channel.led_color = color
+            if channel.power_state is None or not channel.has_leds():
+                return
+
+            levels = channel.output_levels(channel.power_state)
+            if levels[1:] != channel.led_levels:
+                self._write_outputs([(channel, levels)])
+                channel.led_levels = levels[1:]
+
+    # Write the pin levels of the given channels. Receives a list of
+    # (channel, (relay, red, green)) tuples. Implemented by the backends.
+    def _write_outputs(self, outputs):
+        pass
+
+    # Called by the input thread of the backend when the button of a
+    # channel changes state. Times are taken from scheduler.monotonic.
+    def _button_changed(self, channel, pressed, now):
+        channel.gestures.edge(pressed, now)
+
+    # Called by the input thread to detect the time based gestures. Returns
+    # the time (in seconds) until this should be called again, or None if
+    # there's nothing to wait for.
+    def _button_check(self, now):
+        timeout = None
+        for channel in self.channels.values():
+            remaining = channel.gestures.poll(now)
+            if remaining is not None and (timeout is None or remaining < timeout):
+                timeout = remaining
+        return timeout
+
+    # Handle a button gesture. detected is the (monotonic) time the gesture
+    # was made.
+    def _on_gesture(self, channel, gesture, detected):
+        self.button_gestures.inc()
+        action = self.gesture_actions.get(gesture, ACTION_NONE)
+
+        if action == ACTION_TOGGLE:
+            # If not locked, toggle between ON and OFF
+            if channel.get_power_state() == POWER_STATE_ON:
+                self.__button_off(channel, detected)
+            elif channel.get_power_state() == POWER_STATE_OFF:
+                self.set_power_states({ channel.name: POWER_STATE_ON }, detected, CAUSE_BUTTON)
+        elif action == ACTION_ON:
+            if channel.get_power_state() == POWER_STATE_OFF:
+                self.set_power_states({ channel.name: POWER_STATE_ON }, detected, CAUSE_BUTTON)
+        elif action == ACTION_OFF:
+            # Force turn off
+            self.__button_off(channel, detected)
+
+    def __button_off(self, channel, detected):
+        if self.power_off is not None:
+            self.power_off(channel.name, CAUSE_BUTTON, detected)
+        else:
+            self.set_power_states({ channel.name: POWER_STATE_OFF }, detected, CAUSE_BUTTON)
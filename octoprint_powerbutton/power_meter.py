@@ -0,0 +1,266 @@
+import array
+import errno
+import math
+import os
+import stat
+import time
+from threading import Thread, Event, Lock
+
+# Default sampling interval, in seconds
+SAMPLE_INTERVAL = 0.25
+
+# Number of raw samples kept
+RAW_CAPACITY = 1200
+
+# The downsampled history: resolution (seconds) and number of buckets kept
+# of each level. 1 s buckets for an hour, 1 min buckets for a day, 1 h
+# buckets for a month.
+LEVELS = ((1, 3600), (60, 1440), (3600, 720))
+
+# Default (and maximal) number of points returned by a query
+QUERY_POINTS = 300
+MAX_QUERY_POINTS = 3600
+
+# Power sensors. read() returns the current power draw in watts, or None if
+# it isn't available. Sensors are selected by the power_meter.sensor
+# setting, from SENSORS.
+
+# Reads the power from a file holding a number, scaled by scale (e.g.
+# 0.000001 for a hwmon power1_input, in microwatts). The file is opened
+# for every sample, so it may be replaced by its writer. It may also be a
+# named pipe, written by another process one value per line, which is kept
+# open; the last complete line is used.
+class FileSensor:
+
+    def __init__(self, path, scale = 1.0):
+        self.path = path
+        self.scale = scale
+        self.fd = None
+        self.pending = b""
+        self.value = None
+
+    def read(self):
+        if self.fd is None:
+            fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+            if not stat.S_ISFIFO(os.fstat(fd).st_mode):
+                try:
+                    return self.__parse(os.read(fd, 64))
+                finally:
+                    os.close(fd)
+            self.fd = fd
+
+        # Drain the pipe, and keep the last complete line
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                break
+            if not data:
+                # No writer; the value written last is kept
+                break
+            lines = (self.pending + data).split(b"\n")
+            self.pending = lines.pop()
+            for line in reversed(lines):
+                if line.strip():
+                    self.value = self.__parse(line)
+                    break
+        return self.value
+
+    def __parse(self, data):
+        try:
+            value = float(data.strip()) * self.scale
+        except ValueError:
+            return None
+        return None if math.isnan(value) or math.isinf(value) else value
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+SENSORS = { "file": FileSensor }
+
+def create_sensor(name, path, scale = 1.0):
+    if name not in SENSORS:
+        raise ValueError("Unknown power sensor: %s" % name)
+    return SENSORS[name](path, scale)
+
+# One resolution of the downsampled history: a ring of fixed-size buckets,
+# each holding the min, sum, max and count of the samples in its time
+# span. A slot is reused by the bucket that comes size buckets later.
+class _Level:
+
+    def __init__(self, resolution, size):
+        self.resolution = resolution
+        self.size = size
+        self.buckets = array.array('d', [-1.0] * size)
+        self.min = array.array('d', [0.0] * size)
+        self.sum = array.array('d', [0.0] * size)
+        self.max = array.array('d', [0.0] * size)
+        self.count = array.array('L', [0] * size)
+
+    def add(self, t, value):
+        bucket = math.floor(t / self.resolution)
+        slot = int(bucket) % self.size
+        if self.buckets[slot] != bucket:
+            self.buckets[slot] = bucket
+            self.min[slot] = self.sum[slot] = self.max[slot] = value
+            self.count[slot] = 1
+        else:
+            if value < self.min[slot]:
+                self.min[slot] = value
+            if value > self.max[slot]:
+                self.max[slot] = value
+            self.sum[slot] += value
+            self.count[slot] += 1
+
+    # The (time, min, mean, max) of the buckets between two times
+    def points(self, start, end):
+        points = []
+        first = math.floor(start / self.resolution)
+        last = math.floor(end / self.resolution)
+        bucket = max(first, last - self.size + 1)
+        while bucket <= last:
+            slot = int(bucket) % self.size
+            if self.buckets[slot] == bucket:
+                points.append((bucket * self.resolution, self.min[slot],
+                    self.sum[slot] / self.count[slot], self.max[slot]))
+            bucket += 1
+        return points
+
+# The power samples: the latest raw samples in a ring, and their min, mean
+# and max over 1 s, 1 min and 1 h buckets. All the storage is allocated up
+# front, so the memory used does not grow with the uptime, and adding a
+# sample is O(1). Queries pick the finest resolution that covers the
+# requested time window in a bounded number of points.
+class PowerHistory:
+
+    def __init__(self, raw_capacity = RAW_CAPACITY, levels = LEVELS):
+        self.lock = Lock()
+        self.raw_capacity = raw_capacity
+        self.raw_time = array.array('d', [0.0] * raw_capacity)
+        self.raw_value = array.array('d', [0.0] * raw_capacity)
+        self.raw_count = 0
+        self.levels = [_Level(resolution, size) for resolution, size in levels]
+        self.latest = None
+
+    # Add a sample (t in wall time seconds, value in watts)
+    def add(self, t, value):
+        with self.lock:
+            slot = self.raw_count % self.raw_capacity
+            self.raw_time[slot] = t
+            self.raw_value[slot] = value
+            self.raw_count += 1
+            for level in self.levels:
+                level.add(t, value)
+            self.latest = (t, value)
+
+    # Return the samples between two times, in at most max_points points,
+    # as a dict with the resolution used (seconds, 0 for the raw samples)
+    # and a list of (time, min, mean, max) points
+    def query(self, start, end, max_points = QUERY_POINTS):
+        max_points = max(1, min(max_points, MAX_QUERY_POINTS))
+        with self.lock:
+            raw = self.__raw(start, end, max_points)
+            if raw is not None:
+                return dict(resolution = 0, points = raw)
+
+            # Use the first level that still holds the start of the window,
+            # and covers it in few enough points
+            now = self.latest[0] if self.latest is not None else end
+            for level in self.levels:
+                covered = level.resolution * level.size >= now - start or level is self.levels[-1]
+                # (The window may overlap one more bucket at each end)
+                if covered and (end - start) / level.resolution <= max_points - 2:
+                    return dict(resolution = level.resolution, points = level.points(start, end))
+
+            # Not even the coarsest level fits, return its latest points
+            level = self.levels[-1]
+            return dict(resolution = level.resolution,
+                points = level.points(max(start, end - level.resolution * (max_points - 1)), end))
+
+    # The raw samples between two times, or None if there are more than
+    # max_points, or if the window starts before the oldest raw sample kept.
+    # The ring is scanned from the newest sample, so no more than
+    # max_points samples of the window are looked at.
+    def __raw(self, start, end, max_points):
+        count = min(self.raw_count, self.raw_capacity)
+        first = self.raw_count - count
+        if count == 0 or (self.raw_count > self.raw_capacity and self.raw_time[first % self.raw_capacity] > start):
+            return None
+        points = []
+        for i in range(self.raw_count - 1, first - 1, -1):
+            slot = i % self.raw_capacity
+            t = self.raw_time[slot]
+            if t < start:
+                break
+            if t <= end:
+                if len(points) == max_points:
+                    return None
+                v = self.raw_value[slot]
+                points.append((t, v, v, v))
+        points.reverse()
+        return points
+
+# Samples a power sensor on its own thread (sensors may block, e.g. on a
+# bus), feeding a PowerHistory. on_sample(value) is called after every
+# sample, with None when the sensor fails.
+class PowerMeter:
+
+    def __init__(self, sensor, interval = SAMPLE_INTERVAL, clock = time.time, on_sample = None, logger = None,
+            history = None):
+        self.sensor = sensor
+        self.interval = interval
+        self.clock = clock
+        self.on_sample = on_sample
+        self.logger = logger
+        self.history = history or PowerHistory()
+        self.failing = False
+
+        # The last value read, None if the sensor failed
+        self.value = None
+
+        self.stopped = Event()
+        self.thread = Thread(target = self.__thread, name = "powerbutton-power-meter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Stop sampling, waiting for the thread for at most timeout seconds.
+    # Returns True if it has exited.
+    def stop(self, timeout = None):
+        self.stopped.set()
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def __sample(self):
+        try:
+            value = self.sensor.read()
+        except (IOError, OSError) as e:
+            # Log a failure once, not on every sample
+            if not self.failing and self.logger:
+                self.logger.warn("Cannot read the power sensor: %s" % e)
+            self.failing = True
+            self.sensor.close()
+            return None
+
+        if self.failing and self.logger:
+            self.logger.info("Power sensor readable again")
+        self.failing = False
+        if value is not None:
+            self.history.add(self.clock(), value)
+        return value
+
+    def __thread(self):
+        try:
+            while not self.stopped.is_set():
+                value = self.value = self.__sample()
+                if self.on_sample is not None:
+                    self.on_sample(value)
+                self.stopped.wait(self.interval)
+        except Exception:
+            if self.logger:
+                self.logger.exception("Power meter failed")
+        finally:
+            self.sensor.close()
@@ -16,3 +16,17 @@ def str_power_state(s):
 
 def assert_power_state(s):
     assert(s == POWER_STATE_OFF or s == POWER_STATE_ON or s == POWER_STATE_LOCKED)
+
+# Causes of power state changes
+
+CAUSE_UNKNOWN = 0
+CAUSE_STARTUP = 1       # Initial state of a (new) power controller
+CAUSE_BUTTON = 2
+CAUSE_API = 3
+CAUSE_EVENT = 4         # Print events
+CAUSE_AUTO_OFF = 5
+
+CAUSE_NAMES = ("unknown", "startup", "button", "api", "event", "auto_off")
+
+def str_cause(c):
+    return CAUSE_NAMES[c] if 0 <= c < len(CAUSE_NAMES) else "unknown"
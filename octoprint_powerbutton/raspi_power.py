@@ -1,174 +1,335 @@
 import types
+import os
 import os.path
+import select
 from threading import Thread
 import time
 from octoprint_powerbutton.power_states import *
+from octoprint_powerbutton.scheduler import monotonic
+from octoprint_powerbutton.power_hub import PowerHub, prop_or_default, \
+    LED_COLOR_OFF, LED_COLOR_RED, LED_COLOR_GREEN, LED_COLOR_YELLOW, POLL_INTERVAL
 
+# Default location of the sysfs GPIO interface. Can be overridden with the
+# "sysfs_gpio" setting (e.g. to run against a fake tree).
 SYSFS_GPIO = '/sys/class/gpio'
 
-LED_COLOR_OFF = 0
-LED_COLOR_RED = 1
-LED_COLOR_GREEN = 2
-LED_COLOR_YELLOW = 3
-
-SHORT_PERIOD = 15
-LONG_PERIOD = 50
-
-def prop_or_default(dict, prop, default = None):
-    return dict[prop] if prop in dict else default
-
-class RaspiPowerControl:
-
-    def __init__(self, cb = None, settings = {}):
-        self.gpio_relay = prop_or_default(settings, "gpio_relay")
-        self.gpio_button = prop_or_default(settings, "gpio_button")
-        self.gpio_red = prop_or_default(settings, "gpio_red")
-        self.gpio_green = prop_or_default(settings, "gpio_green")
-        self.led_polarity = prop_or_default(settings, "led_polarity", True)
-        self.relay_polarity = prop_or_default(settings, "relay_polarity", True)
-        self.button_polarity = prop_or_default(settings, "button_polarity", False)
-
-        assert(cb is None or callable(cb))
-        self.cb = cb
+# Maximal time to wait for newly exported pins to become configurable, and
+# the interval for checking them
+EXPORT_TIMEOUT = 2.0
+EXPORT_POLL_INTERVAL = 0.005
+
+# Default maximal time to wait for the button thread to exit on shutdown
+SHUTDOWN_TIMEOUT = 1.0
+
+# Write data at offset 0 of a file descriptor. os.pwrite is not available
+# on older Python versions, in which case seek+write is used.
+if hasattr(os, 'pwrite'):
+    def _write_at_start(fd, data):
+        os.pwrite(fd, data, 0)
+else:
+    def _write_at_start(fd, data):
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, data)
+
+# A handle to an exported output pin. The value file is opened once and
+# kept open, and the last written level is cached so writes that do not
+# change the pin level are skipped. Once closed, writes are ignored (a
+# button thread that didn't exit on shutdown may still switch a channel).
+class GpioOutput:
+
+    def __init__(self, pin, sysfs_gpio = SYSFS_GPIO):
+        self.pin = pin
+        self.value = None
+        self.fd = os.open(os.path.join(sysfs_gpio, "gpio%d/value" % pin), os.O_RDWR)
+
+    # Read the current level of the pin, and cache it
+    def read(self):
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        self.value = os.read(self.fd, 2).startswith(b'1')
+        return self.value
+
+    def write(self, value):
+        value = bool(value)
+        if value == self.value or self.fd is None:
+            return False
+
+        _write_at_start(self.fd, b"1\n" if value else b"0\n")
+        self.value = value
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+# Power controller using the sysfs GPIO interface. Drives any number of
+# channels (see PowerHub), with one thread monitoring all the buttons.
+class RaspiPowerControl(PowerHub):
+
+    def __init__(self, cb = None, settings = {}, channels = (), metrics = None, power_off = None,
+            initial_states = None):
+        PowerHub.__init__(self, cb, settings, channels, metrics, power_off, initial_states)
+        self.keep_relay_state = prop_or_default(settings, "keep_relay_state", True)
+        self.sysfs_gpio = prop_or_default(settings, "sysfs_gpio", SYSFS_GPIO)
+
+        for channel in self.channels.values():
+            # Set by __setup_GPIO to True if the relay was already configured
+            # as an output and switched on (e.g. OctoPrint was restarted)
+            channel.relay_was_on = False
+
+            # Output pin handles, created by __setup_GPIO
+            channel.relay_pin = None
+            channel.red_pin = None
+            channel.green_pin = None
+
+        # Set to True by __setup_GPIO if the kernel supports edge events
+        # on all the button pins
+        self.button_edge = False
+
+        # A pipe used for waking the button thread up on shutdown
+        self.wake_r, self.wake_w = os.pipe()
 
         # Setup all the assigned GPIO pons
         self.__setup_GPIO()
 
-        # Set the initial power state to OFF
-        self.power_state = None
-        self.set_power_state(POWER_STATE_OFF)
+        # Set the initial power state to OFF, unless the relay is kept on (or
+        # the state is taken over from a previous controller)
+        self._set_initial_states(dict((channel.name, POWER_STATE_ON if channel.relay_was_on else POWER_STATE_OFF)
+            for channel in self.channels.values()))
 
         # Start the button thread
         self.running = True
-        self.button_thread = Thread(target = self.__button_thread)
+        self.button_thread = Thread(target = self.__button_thread, name = "powerbutton-button")
+        self.button_thread.daemon = True
         self.button_thread.start()
 
-    def shutdown(self):
+    # Stop the button thread, waiting for it for at most timeout seconds,
+    # and release the pins. If unexport is True, the pins are unexported
+    # too, which leaves the relay undriven. Returns True if the thread has
+    # exited.
+    def shutdown(self, timeout = SHUTDOWN_TIMEOUT, unexport = False):
+        if not self.running:
+            return not self.button_thread.is_alive()
         self.running = False
 
-
-    def get_power_state(self):
-        return self.power_state
-
-    def set_power_state(self, new_state):
-        assert(new_state == POWER_STATE_ON or new_state == POWER_STATE_OFF or new_state == POWER_STATE_LOCKED)
-
-        # If state hasn't change, do nothing
-        if (new_state == self.power_state):
-            return
-
-        # Set the new power state
-        self.power_state = new_state
-
-        # Apply it
-        if self.power_state == POWER_STATE_ON:
-            self.__set_relay(True)
-            self.__set_LED_color(LED_COLOR_GREEN)
-        elif self.power_state == POWER_STATE_LOCKED:
-            self.__set_relay(True)
-            self.__set_LED_color(LED_COLOR_YELLOW)
-        else:
-            self.__set_relay(False)
-            self.__set_LED_color(LED_COLOR_RED)
-
-        # If a callback is set, let it know
-        if (self.cb is not None):
-            self.cb(new_state)
-
-    # Export a GPIO pin
-    def __export(self, pin):
-        if os.path.exists(os.path.join(SYSFS_GPIO, 'gpio%d' % pin)):
-            # Already exported
-            return
+        # Wake the button thread if it's blocked waiting for an edge
+        os.write(self.wake_w, b'x')
+
+        # Release the pin handles, so the pins can be taken by a new
+        # controller
+        self.button_thread.join(timeout)
+        stopped = not self.button_thread.is_alive()
+        for channel in self.channels.values():
+            for pin in [channel.relay_pin, channel.red_pin, channel.green_pin]:
+                if pin is not None:
+                    pin.close()
+
+        if unexport:
+            self.__unexport(self.__pins())
+
+        # The thread might still use the pipe if it didn't exit
+        if stopped:
+            os.close(self.wake_r)
+            os.close(self.wake_w)
+        return stopped
+
+    # All the pins used by the channels
+    def __pins(self):
+        pins = []
+        for channel in self.channels.values():
+            pins.extend([pin for pin in [channel.gpio_relay, channel.gpio_red, channel.gpio_green, channel.gpio_button]
+                if pin is not None])
+        return pins
+
+    # Export GPIO pins. All the pins that are not exported yet are exported
+    # at once, and then waited for until their direction file becomes
+    # writable (the files are created, and their permissions set, by the
+    # kernel and udev asynchronously).
+    def __export(self, pins):
+        new_pins = [pin for pin in pins if not os.path.exists(os.path.join(self.sysfs_gpio, 'gpio%d' % pin))]
 
         # Write to the export file. Will throw if no file exists (no GPIO
         # subsystem) or not writeable
-        file(os.path.join(SYSFS_GPIO, "export"), 'w').write('%d\n' % pin)
-
-        # Small delay to allow the change to settle, before trying to
-        # make further modifications
-        time.sleep(0.1)
-
-    # Setup a GPIO pin as in (input = true) or outpu (input = false)
-    def __set_direction(self, pin, input):
-        s = "in" if input == True else "out"
-        file(os.path.join(SYSFS_GPIO, "gpio%d/direction" % pin), 'w').write("%s\n" % s)
-
-    # Set the value of an output pin
-    def __set_value(self, pin, value):
-        s = "1" if value == True else "0"
-        file(os.path.join(SYSFS_GPIO, "gpio%d/value" % pin), 'w').write("%s\n" % s)
+        for pin in new_pins:
+            with open(os.path.join(self.sysfs_gpio, "export"), 'w') as f:
+                f.write('%d\n' % pin)
+
+        deadline = time.time() + EXPORT_TIMEOUT
+        for pin in new_pins:
+            direction_file = os.path.join(self.sysfs_gpio, "gpio%d/direction" % pin)
+            while not os.access(direction_file, os.W_OK):
+                if time.time() > deadline:
+                    raise IOError("Timeout waiting for GPIO %d to be exported" % pin)
+                time.sleep(EXPORT_POLL_INTERVAL)
+
+    def __unexport(self, pins):
+        for pin in pins:
+            try:
+                with open(os.path.join(self.sysfs_gpio, "unexport"), 'w') as f:
+                    f.write('%d\n' % pin)
+            except (IOError, OSError):
+                pass
+
+    def __get_direction(self, pin):
+        with open(os.path.join(self.sysfs_gpio, "gpio%d/direction" % pin)) as f:
+            return f.read().strip()
+
+    # Setup a GPIO pin as in (input = true) or outpu (input = false). Nothing
+    # is written if the pin is already set that way. When a pin is changed
+    # to an output, it is set to the given initial level in the same write.
+    # Returns True if the direction was changed.
+    def __set_direction(self, pin, input, initial = False):
+        current = self.__get_direction(pin)
+        if input:
+            if current == "in":
+                return False
+            s = "in"
+        else:
+            if current in ("out", "low", "high"):
+                return False
+            s = "high" if initial else "low"
+
+        with open(os.path.join(self.sysfs_gpio, "gpio%d/direction" % pin), 'w') as f:
+            f.write("%s\n" % s)
+        return True
+
+    # Configure the pin to generate interrupts on both edges. Returns False
+    # if the kernel (or the pin) does not support edge events.
+    def __set_edge(self, pin):
+        try:
+            fd = os.open(os.path.join(self.sysfs_gpio, "gpio%d/edge" % pin), os.O_WRONLY)
+        except OSError:
+            return False
+
+        try:
+            os.write(fd, b"both\n")
+            return True
+        except OSError:
+            return False
+        finally:
+            os.close(fd)
+
+    # Setup a pin as an output with the given initial level (unless it is
+    # already an output), and return a handle to it
+    def __setup_output(self, pin, initial):
+        changed = self.__set_direction(pin, False, initial)
+        handle = GpioOutput(pin, self.sysfs_gpio)
+        if changed:
+            handle.value = initial
+        return handle
 
     def __setup_GPIO(self):
-        if self.gpio_relay is not None:
-            self.__export(self.gpio_relay)
-            self.__set_direction(self.gpio_relay, False)
-            self.__set_value(self.gpio_relay, False)
-
-        if self.gpio_red is not None:
-            self.__export(self.gpio_red)
-            self.__set_direction(self.gpio_red, False)
-            self.__set_value(self.gpio_red, False)
-
-        if self.gpio_green is not None:
-            self.__export(self.gpio_green)
-            self.__set_direction(self.gpio_green, False)
-            self.__set_value(self.gpio_green, False)
-
-        if self.gpio_button is not None:
-            self.__export(self.gpio_button)
-            self.__set_direction(self.gpio_button, True)
-
-    def __set_LED_color(self, color):
-        if self.gpio_red is None or self.gpio_green is None:
-            return
-
-        red_value = ((color == LED_COLOR_RED) or (color == LED_COLOR_YELLOW)) ^ (not self.led_polarity)
-        green_value = ((color == LED_COLOR_GREEN) or (color == LED_COLOR_YELLOW)) ^ (not self.led_polarity)
-
-        self.__set_value(self.gpio_red, red_value)
-        self.__set_value(self.gpio_green, green_value)
-
-    def __set_relay(self, state):
-        if self.gpio_relay is None:
-            return
-
-        self.__set_value(self.gpio_relay ^ (not self.relay_polarity), state)
+        self.__export(self.__pins())
+
+        edge = True
+        for channel in self.channels.values():
+            # A channel taken over from a previous controller starts at the
+            # levels of its state, so its relay is not switched
+            taken_over = channel.name in self.initial_states
+            relay, red, green = self._initial_levels(channel)
+
+            if channel.gpio_relay is not None:
+                relay_off = not channel.relay_polarity
+                channel.relay_pin = self.__setup_output(channel.gpio_relay, relay)
+
+                # If the relay was already an output, either keep its level or
+                # turn it off
+                if channel.relay_pin.value is None:
+                    if taken_over:
+                        channel.relay_pin.write(relay)
+                    elif self.keep_relay_state:
+                        channel.relay_was_on = channel.relay_pin.read() != relay_off
+                    else:
+                        channel.relay_pin.write(relay_off)
+
+            if channel.has_leds():
+                channel.red_pin = self.__setup_output(channel.gpio_red, red if taken_over else not channel.led_polarity)
+                channel.green_pin = self.__setup_output(channel.gpio_green, green if taken_over else not channel.led_polarity)
+
+            if channel.gpio_button is not None:
+                self.__set_direction(channel.gpio_button, True)
+                edge = self.__set_edge(channel.gpio_button) and edge
+
+        self.button_edge = edge
+
+    # Write the relay and LED pins of the given channels in one go. All the
+    # relays are written first, LEDs follow immediately, and pins whose level
+    # hasn't changed are not written at all.
+    def _write_outputs(self, outputs):
+        writes = []
+        led_writes = []
+
+        for channel, (relay, red, green) in outputs:
+            if channel.relay_pin is not None:
+                writes.append((channel.relay_pin, relay))
+            if channel.red_pin is not None:
+                led_writes.append((channel.red_pin, red))
+                led_writes.append((channel.green_pin, green))
+
+        for pin, value in writes + led_writes:
+            pin.write(value)
 
     def __button_thread(self):
-        if self.gpio_button is None:
+        channels = [channel for channel in self.channels.values() if channel.gpio_button is not None]
+        if not channels:
             return
-        
-        count = 0
-        state = 0
-        gpio_value_file = os.path.join(SYSFS_GPIO, "gpio%d/value" % self.gpio_button)
-        
-        while(self.running):
-            # Read the button value
-            v = (file(gpio_value_file).read().startswith('0')) ^ (not self.button_polarity)
-            
-            if not v:
-                # Button released
-                if (count > 1 and count <= SHORT_PERIOD):
-                    self.__notify_button_press(True)
-            elif (count == LONG_PERIOD):
-                self.__notify_button_press(False)
-
-            if v:
-                count += 1
-            else:
-                count = 0
 
-            time.sleep(0.05)
+        # Keep the value files of all the buttons open
+        fds = {}
+        try:
+            for channel in channels:
+                fd = os.open(os.path.join(self.sysfs_gpio, "gpio%d/value" % channel.gpio_button), os.O_RDONLY)
+                fds[fd] = channel
 
-    def __notify_button_press(self, short):
-        if short:
-            # Short press. If not locked, toggle between ON and OFF
-            if self.get_power_state() == POWER_STATE_ON:
-                self.set_power_state(POWER_STATE_OFF)
-            elif self.get_power_state() == POWER_STATE_OFF:
-                self.set_power_state(POWER_STATE_ON)
+            if self.button_edge:
+                self.__button_thread_edge(fds)
+            else:
+                self.__button_thread_polling(fds)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    # Read the (logical) button state from an open value file descriptor
+    def __read_button(self, fd, channel):
+        os.lseek(fd, 0, os.SEEK_SET)
+        return (os.read(fd, 2).startswith(b'0')) ^ (not channel.button_polarity)
+
+    # Block on the value files until the kernel reports an edge. The thread
+    # sleeps in poll() while the buttons are idle, and only uses a timeout
+    # while a gesture is in progress (e.g. to detect a long press).
+    def __button_thread_edge(self, fds):
+        poller = select.poll()
+        for fd in fds:
+            poller.register(fd, select.POLLPRI | select.POLLERR)
+        poller.register(self.wake_r, select.POLLIN)
+
+        # Reading the value clears the pending edge state
+        now = monotonic()
+        for fd, channel in fds.items():
+            self._button_changed(channel, self.__read_button(fd, channel), now)
+
+        timeout = self._button_check(now)
+        while(self.running):
+            events = poller.poll(None if timeout is None else max(0, timeout) * 1000)
+            if not self.running:
+                break
+
+            now = monotonic()
+            for fd, _ in events:
+                if fd in fds:
+                    channel = fds[fd]
+                    self._button_changed(channel, self.__read_button(fd, channel), now)
+
+            timeout = self._button_check(now)
+
+    # Periodically sample the button values. Used when the kernel does not
+    # support edge events. Waits on the wake pipe between the samples, so a
+    # shutdown does not wait for the interval to end.
+    def __button_thread_polling(self, fds):
+        while(self.running):
+            now = monotonic()
+            for fd, channel in fds.items():
+                self._button_changed(channel, self.__read_button(fd, channel), now)
+            self._button_check(now)
 
-        else:
-            # Long press. Force turn off
-            self.set_power_state(POWER_STATE_OFF)
+            select.select([self.wake_r], [], [], POLL_INTERVAL)
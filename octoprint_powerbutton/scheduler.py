@@ -0,0 +1,189 @@
+import heapq
+import itertools
+import time
+from threading import Thread, Condition
+
+# A monotonic clock, in seconds. time.monotonic is only available on
+# Python 3, so on older versions clock_gettime is called directly.
+try:
+    from time import monotonic
+except ImportError:
+    import ctypes
+    import ctypes.util
+
+    CLOCK_MONOTONIC = 1
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    try:
+        _librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno = True)
+        _clock_gettime = _librt.clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+        def monotonic():
+            t = _timespec()
+            if _clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(t)) != 0:
+                raise OSError(ctypes.get_errno(), "clock_gettime failed")
+            return t.tv_sec + t.tv_nsec * 1e-9
+    except (OSError, AttributeError):
+        monotonic = time.time
+
+# Compact the heap when more than this fraction of its entries is cancelled
+COMPACT_RATIO = 0.5
+
+class ScheduledTask:
+
+    def __init__(self, scheduler, deadline, seq, fn, args):
+        self.scheduler = scheduler
+        self.deadline = deadline
+        self.seq = seq
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.deadline, self.seq) < (other.deadline, other.seq)
+
+    def cancel(self):
+        self.scheduler.cancel(self)
+
+# Runs all the time-based work of the plugin on a single thread. Tasks are
+# kept in a heap ordered by their (monotonic) deadline. Cancelled tasks are
+# only marked, and dropped when they reach the top of the heap (or when the
+# heap is compacted), so both scheduling and cancelling are O(log n).
+class Scheduler:
+
+    def __init__(self, clock = monotonic, logger = None, name = "powerbutton-scheduler"):
+        self.clock = clock
+        self.logger = logger
+        self.name = name
+
+        self.cond = Condition()
+        self.heap = []
+        self.cancelled_count = 0
+        self.seq = itertools.count()
+        self.running = False
+        self.thread = None
+
+    # Start the scheduler thread. A scheduler that isn't started can be
+    # driven manually by calling run_pending.
+    def start(self):
+        with self.cond:
+            if self.running:
+                return
+            self.running = True
+
+        self.thread = Thread(target = self.__thread, name = self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Stop the scheduler thread, and wait for it to exit for at most
+    # timeout seconds. The pending tasks are dropped. Returns True if the
+    # thread has exited.
+    def stop(self, timeout = None):
+        with self.cond:
+            self.running = False
+            for task in self.heap:
+                task.cancelled = True
+            self.heap = []
+            self.cancelled_count = 0
+            self.cond.notify()
+
+        if self.thread is not None:
+            self.thread.join(timeout)
+            return not self.thread.is_alive()
+        return True
+
+    def now(self):
+        return self.clock()
+
+    # Run fn(*args) at the given deadline (in clock time)
+    def call_at(self, deadline, fn, *args):
+        with self.cond:
+            task = ScheduledTask(self, deadline, next(self.seq), fn, args)
+            heapq.heappush(self.heap, task)
+
+            # Wake the thread up if the new task is now the first one
+            if self.heap[0] is task:
+                self.cond.notify()
+        return task
+
+    # Run fn(*args) after delay seconds
+    def call_later(self, delay, fn, *args):
+        return self.call_at(self.clock() + delay, fn, *args)
+
+    def cancel(self, task):
+        with self.cond:
+            if task.cancelled:
+                return
+            task.cancelled = True
+            self.cancelled_count += 1
+
+            if self.cancelled_count > len(self.heap) * COMPACT_RATIO:
+                self.heap = [t for t in self.heap if not t.cancelled]
+                heapq.heapify(self.heap)
+                self.cancelled_count = 0
+
+    # Cancel a task, and schedule its function again at a new deadline
+    def reschedule(self, task, deadline):
+        self.cancel(task)
+        return self.call_at(deadline, task.fn, *task.args)
+
+    # Number of tasks waiting to run
+    def pending(self):
+        with self.cond:
+            return len(self.heap) - self.cancelled_count
+
+    # Run all the tasks whose deadline has passed. Returns the deadline of
+    # the next task, or None if there are no tasks left.
+    def run_pending(self, now = None):
+        while True:
+            with self.cond:
+                task, next_deadline = self.__pop_due(self.clock() if now is None else now)
+            if task is None:
+                return next_deadline
+            self.__run_task(task)
+
+    # Pop the first task if it is due. Must be called with the lock held.
+    # Returns (task, None) or (None, next deadline).
+    def __pop_due(self, now):
+        while self.heap and self.heap[0].cancelled:
+            heapq.heappop(self.heap)
+            self.cancelled_count -= 1
+
+        if not self.heap:
+            return None, None
+
+        if self.heap[0].deadline <= now:
+            task = heapq.heappop(self.heap)
+
+            # Mark it, so cancelling a task that has already run is a no-op
+            task.cancelled = True
+            return task, None
+
+        return None, self.heap[0].deadline
+
+    def __run_task(self, task):
+        try:
+            task.fn(*task.args)
+        except Exception:
+            if self.logger:
+                self.logger.exception("Exception in scheduled task %r" % task.fn)
+
+    def __thread(self):
+        while True:
+            with self.cond:
+                while self.running:
+                    task, next_deadline = self.__pop_due(self.clock())
+                    if task is not None:
+                        break
+                    if next_deadline is None:
+                        self.cond.wait()
+                    else:
+                        self.cond.wait(max(0, next_deadline - self.clock()))
+
+                if not self.running:
+                    return
+
+            self.__run_task(task)
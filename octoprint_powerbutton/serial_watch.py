@@ -0,0 +1,224 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import sys
+from threading import Thread, Lock
+from octoprint_powerbutton.scheduler import monotonic
+
+# Where udev links the USB serial devices, by their identity. A printer
+# port that isn't configured (auto-detection) is ready when a new device
+# appears here, or when a known one is here.
+SERIAL_BY_ID = "/dev/serial/by-id"
+
+# Delays between the readiness checks when nothing happens, in seconds.
+# The delay doubles after each check, and starts over on an inotify event.
+RETRY_INITIAL = 0.1
+RETRY_MAX = 2.0
+
+# inotify, through libc. Without it (or if it fails), the watch falls back
+# to polling the port with stat.
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+    _inotify_init1 = _libc.inotify_init1
+    _inotify_init1.argtypes = [ctypes.c_int]
+    _inotify_add_watch = _libc.inotify_add_watch
+    _inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+except (OSError, AttributeError, TypeError):
+    _inotify_init1 = None
+
+def _fs_path(path):
+    if isinstance(path, bytes):
+        return path
+    return path.encode(sys.getfilesystemencoding() or "utf-8")
+
+# Check that a serial port can be opened. Opening the port (without
+# making it the controlling terminal, and without waiting for the
+# carrier) is the only reliable sign that the driver is done with it and
+# that udev has applied its permissions.
+def port_openable(path):
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    except OSError:
+        return False
+    os.close(fd)
+    return True
+
+# Waits, on its own thread, for a serial port to appear and become
+# openable, and then calls on_ready(port, True). If it isn't ready within
+# timeout seconds, on_ready(port, False) is called instead. With port None,
+# waits for a device in the by-id directory that wasn't there when the
+# watch started, or for one of known_devices (by-id names, e.g. the devices
+# the printer was connected to before), and the port passed to on_ready is
+# None (the caller auto-detects it). A device that goes away and comes back
+# counts as new.
+#
+# The directories the port may appear in are watched with inotify, so the
+# port is checked as soon as it appears. A port that appears but can't be
+# opened yet is checked again with a backoff, as is the port when inotify
+# is not available.
+class SerialPortWatch:
+
+    def __init__(self, port, on_ready, timeout, logger = None, by_id_dir = SERIAL_BY_ID,
+            use_inotify = True, openable = port_openable, known_devices = ()):
+        self.port = port
+        self.on_ready = on_ready
+        self.timeout = timeout
+        self.logger = logger
+        self.by_id_dir = by_id_dir
+        self.openable = openable
+        self.known_devices = frozenset(known_devices)
+
+        # The devices already there, that don't count (other USB serial
+        # devices, or the printer's if it didn't go away)
+        self.old_devices = self.__devices() if port is None else set()
+
+        self.lock = Lock()
+        self.cancelled = False
+        self.inotify_fd = None
+        self.watched = set()
+        if use_inotify and _inotify_init1 is not None:
+            fd = _inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self.inotify_fd = fd
+            elif self.logger:
+                self.logger.warn("inotify is not available (errno %d), polling the serial port" % ctypes.get_errno())
+
+        # Wakes the thread up when cancelled
+        self.wake_r, self.wake_w = os.pipe()
+
+        self.thread = Thread(target = self.__thread, name = "powerbutton-serial-watch")
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Stop watching. on_ready is not called after cancel returns, unless it
+    # is already running.
+    def cancel(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            if self.wake_w is not None:
+                os.write(self.wake_w, b"x")
+
+    # Wait for the watch thread to exit. Returns True if it has.
+    def join(self, timeout = None):
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    # The directory the port is expected in
+    def __port_dir(self):
+        return os.path.dirname(self.port) if self.port is not None else self.by_id_dir
+
+    # The names in the by-id directory
+    def __devices(self):
+        try:
+            return set(os.listdir(self.by_id_dir))
+        except OSError:
+            return set()
+
+    # Return True if the port is ready
+    def __check(self):
+        if self.port is not None:
+            return os.path.exists(self.port) and self.openable(self.port)
+
+        names = self.__devices()
+        self.old_devices &= names
+        return any(self.openable(os.path.join(self.by_id_dir, name)) for name in sorted(names)
+            if name not in self.old_devices or name in self.known_devices)
+
+    # Watch the port's directory, and its parents that exist (so the
+    # directory is noticed when it is created). Called again after every
+    # event, as directories come and go.
+    def __update_watches(self):
+        path = os.path.abspath(self.__port_dir())
+        while True:
+            if path not in self.watched and os.path.isdir(path):
+                wd = _inotify_add_watch(self.inotify_fd, _fs_path(path), IN_CREATE | IN_MOVED_TO | IN_ATTRIB)
+                if wd >= 0:
+                    self.watched.add(path)
+                elif ctypes.get_errno() != errno.ENOENT and self.logger:
+                    self.logger.warn("Cannot watch %s (errno %d)" % (path, ctypes.get_errno()))
+
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+
+        # A directory that has been removed has lost its watch
+        self.watched = set(p for p in self.watched if os.path.isdir(p))
+
+    # Wait for an inotify event, a cancellation or the timeout. Returns True
+    # if there was an event.
+    def __wait(self, timeout):
+        fds = [self.wake_r]
+        if self.inotify_fd is not None:
+            fds.append(self.inotify_fd)
+
+        try:
+            readable, _, _ = select.select(fds, [], [], max(0, timeout))
+        except (select.error, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                return False
+            raise
+
+        if self.inotify_fd is not None and self.inotify_fd in readable:
+            # The events themselves don't matter, the port is checked again
+            try:
+                while os.read(self.inotify_fd, 4096):
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+            return True
+        return False
+
+    def __thread(self):
+        try:
+            deadline = monotonic() + self.timeout
+            delay = RETRY_INITIAL
+            while True:
+                if self.inotify_fd is not None:
+                    # Watch before checking, so an appearance between the
+                    # check and the wait is not missed
+                    self.__update_watches()
+
+                ready = self.__check()
+                now = monotonic()
+                if ready or now >= deadline:
+                    break
+
+                # Something changed: check again soon, as a port that has
+                # just appeared may take a while to become openable
+                if self.__wait(min(delay, deadline - now)):
+                    delay = RETRY_INITIAL
+                else:
+                    delay = min(delay * 2, RETRY_MAX)
+                if self.cancelled:
+                    return
+        except Exception:
+            if self.logger:
+                self.logger.exception("Serial port watch failed")
+            ready = False
+        finally:
+            with self.lock:
+                if self.inotify_fd is not None:
+                    os.close(self.inotify_fd)
+                os.close(self.wake_r)
+                os.close(self.wake_w)
+                self.inotify_fd = self.wake_r = self.wake_w = None
+                cancelled = self.cancelled
+                self.cancelled = True
+
+        if not cancelled:
+            self.on_ready(self.port, ready)
@@ -7,6 +7,9 @@
 $(function() {
 	var POWER_BUTTON_PLUGIN = "powerbutton"
 
+	// The power channel shown by the navbar switch
+	var PRIMARY_CHANNEL = "printer"
+
 	/* Plugin states */
 	var STATE_UNKNOWN = 'unknown'          // Unknown state
 	var STATE_ON = 'on'                    // Powered on
@@ -17,18 +20,35 @@ $(function() {
 
 	var CONNECT_BTN_TOOLTIP = "To connect to the printer, first turn its power on"
 
+	// Number of completed command results kept for commands whose request
+	// hasn't returned yet
+	var MAX_COMPLETED_COMMANDS = 32
+
 	// Enable tooltips
 	$(document).tooltip()
 
-	// Helper function - Convert a progress range of 0 - 100 to 0 to 12
-	// Used for showing a progress bar for auto-off function
-	function calcAutoOffProgressIndicator(progress) {
-		if (progress >= 100)
-			return 12;
-		if (progress <= 0)
-			return 0;
-			
-		return Math.round((progress / 100.0)*12);
+	// Circumference of the auto-power-off countdown ring (see the navbar
+	// template)
+	var AUTO_OFF_RING_LENGTH = 2 * Math.PI * 9.27
+
+	// Show the auto-power-off countdown on the ring. The remaining part of
+	// the ring is drawn once, and the browser animates it down to nothing
+	// by the deadline (a CSS transition), so no timer or server message is
+	// needed while counting down.
+	function animateAutoOffRing(remaining, interval) {
+		var ring = $('#power-button-top .auto-off-progress')[0]
+		if (!ring)
+			return
+
+		var fraction = Math.max(0, Math.min(remaining / interval, 1))
+		ring.style.strokeDasharray = AUTO_OFF_RING_LENGTH
+		ring.style.transition = 'none'
+		ring.style.strokeDashoffset = -AUTO_OFF_RING_LENGTH * (1 - fraction)
+
+		// Apply the starting point before starting the transition
+		window.getComputedStyle(ring).strokeDashoffset
+		ring.style.transition = 'stroke-dashoffset ' + Math.max(0, remaining) + 's linear'
+		ring.style.strokeDashoffset = -AUTO_OFF_RING_LENGTH
 	}
 
 	// Create a ViewModel
@@ -39,7 +59,17 @@ $(function() {
 
 		self.printerStateViewModel = parameters[0];
 		self.switchState = ko.observable(STATE_UNKNOWN)
-		self.autoPowerOffProgress = ko.observable(null)
+
+		// The auto-power-off countdown (null when not engaged): its deadline
+		// in local time (ms) and its interval (s)
+		self.autoPowerOff = ko.observable(null)
+
+		// The power drawn by the printer (W), null without a power meter
+		self.power = ko.observable(null)
+		self.powerTitle = ko.pureComputed(function() {
+			var power = self.power()
+			return (power === null || power === undefined)? '' : 'Printer power: ' + power + ' W'
+		}, self)
 
 		self.checked = ko.pureComputed(function() {
 			var state = self.switchState()
@@ -54,16 +84,16 @@ $(function() {
 
 		self.cssOption = ko.pureComputed(function() {
 			var state = self.switchState()
-			var progress = self.autoPowerOffProgress()
+			var autoOff = self.autoPowerOff()
 
 			if (state === STATE_OFF_PENDING || state === STATE_ON_PENDING)
 				return 'slider-wait'
 			else if (state === STATE_ON_LOCKED)
 				return 'slider-lock'
 			else {
-				if (progress)
+				if (autoOff)
 					// Auto-off
-					return 'slider-auto' + calcAutoOffProgressIndicator(progress)
+					return 'slider-auto'
 				else
 					// On
 					return ''
@@ -87,43 +117,42 @@ $(function() {
 		// Subscribe to switch changes (clicks)
 		$('#power-button-top input').click(function(v) {
 			var v = $(this)[0].checked
-			var disconnectPromise = $.Deferred()
 
 			if (v) {
 				self.switchState(STATE_ON_PENDING)
-				disconnectPromise.resolve()
 			}
 			else {
 				self.switchState(STATE_OFF_PENDING)
 
-				// Disable the "connect" button
+				// Disable the "connect" button. The server disconnects the
+				// printer before switching off.
 				disableConnetcButton(true)
-
-				// When switching off, disconnect first
-				OctoPrint.connection.disconnect()
-					.done(function() { disconnectPromise.resolve(); })
 			}
 
-			disconnectPromise.done(function() {
-				OctoPrint.plugins.powerbuttonplugin.requestPowerState(v, function(error) {
-					if (error) {
-						// TODO: Show error message
-	
-						// Failure
-						if (self.switchState() === STATE_OFF_PENDING)
-							self.switchState(STATE_ON)
-						else if (self.switchState() === STATE_ON_PENDING)
-							self.switchState(STATE_OFF)
+			OctoPrint.plugins.powerbuttonplugin.requestPowerState(v, function(error) {
+				if (error) {
+					new PNotify({
+						title: "Power Switch Failed",
+						text: "The printer power could not be switched " + (v? "on" : "off") + ": " + error,
+						type: "error"
+					})
+
+					// Failure. The printer is still on, so it can be
+					// connected again.
+					if (self.switchState() === STATE_OFF_PENDING) {
+						self.switchState(STATE_ON)
+						disableConnetcButton(false)
 					}
-	
-				})
-			})			
+					else if (self.switchState() === STATE_ON_PENDING)
+						self.switchState(STATE_OFF)
+				}
+			})
 		})
 
 		// Install a click handler on the power button, to alter
 		// the button behavior when in auto-off mode
 		$('#power-button-slider').click(function(e) {
-			if (self.autoPowerOffProgress()) {
+			if (self.autoPowerOff()) {
 				// In auto-off mode, clicking the power button cancels the
 				// mode and does not cause the switch to toggle.
 				e.preventDefault();
@@ -142,35 +171,83 @@ $(function() {
 		self.onDataUpdaterPluginMessage = function(plugin, message) {
 			if (plugin === "powerbutton") {
 
-				if (message.powerState === "on") {
-					self.switchState(STATE_ON)
+				if (message.commandResult) {
+					// Completion of a power command
+					OctoPrint.plugins.powerbuttonplugin.commandCompleted(message.commandResult)
+					return
+				}
 
-					// Enable the "connect" button
-					disableConnetcButton(false)
+				// The switch only shows the primary channel
+				if (message.channel && message.channel !== PRIMARY_CHANNEL)
+					return
 
-				}
-				else if (message.powerState === "off") {
-					self.switchState(STATE_OFF)
+				self.showPowerState(message)
+			}
+		}
 
-					// Disable the "connect" button
-					disableConnetcButton(true)
-				}
-				else if (message.powerState === "locked") {
-					self.switchState(STATE_ON_LOCKED)
-				}
-				else if (message.powerState === "auto_off") {
-					self.switchState(STATE_ON)
-				}
-				else
-					console.error("PowerButton plugin: Power state error")
+		// Show a power state, given as in the power state message
+		self.showPowerState = function(message) {
+			if (message.powerState === "on") {
+				self.switchState(STATE_ON)
 
-				// Update the "autoOffProgress" field
-				self.autoPowerOffProgress(message.autoOffProgress)
+				// Enable the "connect" button
+				disableConnetcButton(false)
+
+			}
+			else if (message.powerState === "off") {
+				self.switchState(STATE_OFF)
+
+				// Disable the "connect" button
+				disableConnetcButton(true)
+			}
+			else if (message.powerState === "locked") {
+				self.switchState(STATE_ON_LOCKED)
 			}
+			else if (message.powerState === "auto_off") {
+				self.switchState(STATE_ON)
+			}
+			else
+				console.error("PowerButton plugin: Power state error")
+
+			self.showAutoPowerOff(message)
+			self.power(message.power)
+		}
+
+		// Start (or stop) showing the auto-power-off countdown. The message
+		// has its deadline and the time it was sent, both in server time.
+		self.showAutoPowerOff = function(message) {
+			if (!message.autoOffDeadline || !message.autoOffInterval) {
+				self.autoPowerOff(null)
+				return
+			}
+
+			// The remaining time is taken from the server, so the countdown
+			// does not depend on the client clock being set
+			var remaining = message.autoOffDeadline - message.serverTime
+			var deadline = Date.now() + remaining * 1000
+			var current = self.autoPowerOff()
+			if (current && current.interval === message.autoOffInterval && Math.abs(current.deadline - deadline) < 1000)
+				return
+
+			self.autoPowerOff({ deadline: deadline, interval: message.autoOffInterval })
+			animateAutoOffRing(remaining, message.autoOffInterval)
 		}
 
 		self.onUserLoggedIn = function() {
-			OctoPrint.plugins.powerbuttonplugin.refreshPowerState()
+			// Read the current state, without making the server broadcast
+			// it to all the clients
+			OctoPrint.plugins.powerbuttonplugin.getStatus().done(function(status) {
+				var channel = status.channels[PRIMARY_CHANNEL]
+				if (!channel)
+					return
+
+				self.showPowerState({
+					powerState: channel.powerState,
+					autoOffDeadline: channel.autoOffDeadline,
+					autoOffInterval: channel.autoOffInterval,
+					serverTime: status.serverTime
+				})
+			})
 		}
 
     }
@@ -192,36 +269,72 @@ $(function() {
 		} else {
 			factory(window.OctoPrintClient);
 		}
-
-		// Preload images
-		var loadImg = new Image()
-		images = []
-		loadImg.src = "/plugin/powerbutton/static/img/wait_circle.gif";
-		for(var i = 0; i <=12; i++) {
-			var loadImg = new Image()
-			loadImg.src = "/plugin/powerbutton/static/img/auto" + i + ".png"
-			images.push(loadImg)
-		}
 	})(window || this, function(OctoPrintClient) {
 
 		var PowerButtonPluginClient = function(base) {
 			this.base = base;
+
+			// Callbacks of power commands waiting for completion, and
+			// results of commands that completed before their request
+			// returned, both by command ID
+			this.pendingCommands = {}
+			this.completedCommands = {}
+			this.completedOrder = []
 		};
 	
-		// Request the server to apply a new power state
+		// Request the server to apply a new power state. Switching off
+		// disconnects the printer first (on the server). The callback is
+		// called when the command is completed, with an error message on
+		// failure.
 		PowerButtonPluginClient.prototype.requestPowerState = function(newState, cb) {
+			var self = this
 			
 			// Issue an API request
-			OctoPrint.ajaxWithData("POST", "api/plugin/" + POWER_BUTTON_PLUGIN, JSON.stringify({
-				command: "power",
-				newState: newState? "on" : "off"
-			}), {
+			OctoPrint.ajaxWithData("POST", "api/plugin/" + POWER_BUTTON_PLUGIN, JSON.stringify(newState?
+				{ command: "power", newState: "on" } : { command: "power_off" }), {
 				contentType: "application/json"
-			}).done(function() {
-				cb(null)
+			}).done(function(response) {
+				var id = response.commandId
+				var result = self.completedCommands[id]
+
+				if (result) {
+					delete self.completedCommands[id]
+					cb(result.success? null : result.error)
+				}
+				else
+					self.pendingCommands[id] = cb
+			}).fail(function(jqXHR, textStatus) {
+				cb(jqXHR.responseText || textStatus || "Request failed")
 			})
 		};
 
+		// Called on a command completion message from the server
+		PowerButtonPluginClient.prototype.commandCompleted = function(result) {
+			var self = this
+
+			result.ids.forEach(function(id) {
+				var cb = self.pendingCommands[id]
+
+				if (cb) {
+					delete self.pendingCommands[id]
+					cb(result.success? null : result.error)
+				}
+				else {
+					// Might be a command of another client. Keep only the
+					// most recent results.
+					self.completedCommands[id] = result
+					self.completedOrder.push(id)
+					if (self.completedOrder.length > MAX_COMPLETED_COMMANDS)
+						delete self.completedCommands[self.completedOrder.shift()]
+				}
+			})
+		}
+
+		// Get the status of all the power channels. Returns a promise.
+		PowerButtonPluginClient.prototype.getStatus = function() {
+			return OctoPrint.get("api/plugin/" + POWER_BUTTON_PLUGIN)
+		}
+
 		// Request the server to refresh (resend) the current power state
 		PowerButtonPluginClient.prototype.refreshPowerState = function() {
 			// Issue an API request
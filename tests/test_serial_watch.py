@@ -0,0 +1,154 @@
+# Tests of SerialPortWatch, with a pty standing in for the printer's
+# serial device, linked into a temp directory as udev would link it.
+#
+#   python -m unittest discover tests
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from threading import Event, Timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from octoprint_powerbutton.serial_watch import SerialPortWatch
+from octoprint_powerbutton.scheduler import monotonic
+
+# Time for the device to appear after the watch starts, and the longest a
+# test waits, in seconds
+APPEAR_DELAY = 0.3
+TIMEOUT = 5.0
+
+class SerialPortWatchTest(unittest.TestCase):
+
+    use_inotify = True
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix = "powerbutton-serial-")
+        self.by_id_dir = os.path.join(self.dir, "serial", "by-id")
+        self.ptys = []
+        self.watch = None
+        self.ready = Event()
+        self.result = None
+
+    def tearDown(self):
+        if self.watch is not None:
+            self.watch.cancel()
+            self.watch.join(TIMEOUT)
+        for master, slave in self.ptys:
+            os.close(master)
+            os.close(slave)
+        shutil.rmtree(self.dir)
+
+    # Link a new pty to path, creating its directory
+    def add_device(self, path):
+        master, slave = os.openpty()
+        self.ptys.append((master, slave))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        os.symlink(os.ttyname(slave), path)
+
+    def add_device_later(self, path):
+        timer = Timer(APPEAR_DELAY, self.add_device, [path])
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def start(self, port, timeout = TIMEOUT, **kwargs):
+        self.started = monotonic()
+        self.watch = SerialPortWatch(port, self.on_ready, timeout, by_id_dir = self.by_id_dir,
+            use_inotify = self.use_inotify, **kwargs)
+
+    def on_ready(self, port, ready):
+        self.result = (port, ready, monotonic() - self.started)
+        self.ready.set()
+
+    # Wait for on_ready, and return (port, ready, seconds since the start)
+    def wait(self):
+        self.assertTrue(self.ready.wait(TIMEOUT), "on_ready not called")
+        self.assertTrue(self.watch.join(TIMEOUT), "watch thread still running")
+        return self.result
+
+    def test_port_already_there(self):
+        port = os.path.join(self.dir, "ttyACM0")
+        self.add_device(port)
+        self.start(port)
+        self.assertEqual(self.wait()[:2], (port, True))
+
+    def test_port_appears(self):
+        port = os.path.join(self.dir, "ttyACM0")
+        self.start(port)
+        self.add_device_later(port)
+        _, ready, elapsed = self.wait()
+        self.assertTrue(ready)
+        self.assertTrue(elapsed >= APPEAR_DELAY)
+
+    # The port's directory doesn't exist either when the watch starts
+    def test_port_appears_in_new_directory(self):
+        port = os.path.join(self.by_id_dir, "usb-Printer-if00")
+        self.start(port)
+        self.add_device_later(port)
+        self.assertTrue(self.wait()[1])
+
+    # A port that exists but can't be opened yet is checked again
+    def test_port_not_openable(self):
+        port = os.path.join(self.dir, "ttyACM0")
+        self.add_device(port)
+        openable = Event()
+        Timer(APPEAR_DELAY, openable.set).start()
+        self.start(port, openable = lambda path: openable.is_set())
+        _, ready, elapsed = self.wait()
+        self.assertTrue(ready)
+        self.assertTrue(elapsed >= APPEAR_DELAY)
+
+    def test_timeout(self):
+        port = os.path.join(self.dir, "ttyACM0")
+        self.start(port, timeout = APPEAR_DELAY)
+        _, ready, elapsed = self.wait()
+        self.assertFalse(ready)
+        self.assertTrue(elapsed >= APPEAR_DELAY)
+
+    def test_cancel(self):
+        self.start(os.path.join(self.dir, "ttyACM0"))
+        self.watch.cancel()
+        self.assertTrue(self.watch.join(TIMEOUT))
+        self.assertFalse(self.ready.is_set())
+
+    # Auto-detection: a device that was already there (another USB serial
+    # device) doesn't make the port ready, a new one does
+    def test_auto_detect_new_device(self):
+        self.add_device(os.path.join(self.by_id_dir, "usb-Other_Device-if00"))
+        self.start(None)
+        self.add_device_later(os.path.join(self.by_id_dir, "usb-Printer-if00"))
+        port, ready, elapsed = self.wait()
+        self.assertEqual((port, ready), (None, True))
+        self.assertTrue(elapsed >= APPEAR_DELAY)
+
+    def test_auto_detect_old_device_only(self):
+        self.add_device(os.path.join(self.by_id_dir, "usb-Other_Device-if00"))
+        self.start(None, timeout = APPEAR_DELAY * 2)
+        self.assertEqual(self.wait()[:2], (None, False))
+
+    # A device the printer was connected to before is ready as soon as it
+    # is there
+    def test_auto_detect_known_device(self):
+        self.add_device(os.path.join(self.by_id_dir, "usb-Other_Device-if00"))
+        self.add_device(os.path.join(self.by_id_dir, "usb-Printer-if00"))
+        self.start(None, known_devices = ["usb-Printer-if00"])
+        self.assertEqual(self.wait()[:2], (None, True))
+
+    # A device that goes away (the printer is reset) and comes back is new
+    def test_auto_detect_device_comes_back(self):
+        path = os.path.join(self.by_id_dir, "usb-Printer-if00")
+        self.add_device(path)
+        self.start(None)
+        os.unlink(path)
+        self.add_device_later(path)
+        self.assertEqual(self.wait()[:2], (None, True))
+
+# The same, polling the port with stat
+class SerialPortWatchPollingTest(SerialPortWatchTest):
+
+    use_inotify = False
+
+if __name__ == "__main__":
+    unittest.main()